@@ -0,0 +1,237 @@
+# This module archives the processed emails and the emails without service that are removed from the state store
+# in compressed segment files in ./state/archive, so they don't grow the state store without limit.
+# A segment is a gzip file of JSON lines, every write appends one gzip member to the current segment
+# and a new segment is started once it is larger than segment_mb or older than segment_hours.
+# The state store indexes every archived email by the time it was received, its subject and its services,
+# a lookup only decompresses the members it needs. Segments over the retention limits are deleted.
+#
+# Usage: python archive.py [--subject SUBJECT] [--service SERVICE] [--days 7] [--json]
+
+import gzip
+import json
+from argparse import ArgumentParser
+from configparser import SectionProxy
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import groupby
+from pathlib import Path
+from time import time
+from typing import Iterator
+
+from configfile import read_config_section
+from models import Email
+from statestore import ArchiveSegment, StateStore, StoredMail
+
+ARCHIVE_DIRECTORY = Path("state/archive")
+
+DAY_SECONDS = 86400
+
+# Mails are archived while the run waits for them, level 3 compresses mail text
+# about 2.5 times faster than the default of 6 to segments about a fifth larger
+COMPRESS_LEVEL = 3
+
+
+@dataclass
+class ArchivedMail:
+    """An email in the archive with the time it was received, its state when it was archived
+    ('processed' or 'without-service') and the names of the services it set"""
+
+    received: float
+    state: str
+    email: Email
+    services: list[str] = field(default_factory=list)
+
+    def to_json(self) -> str:
+        return json.dumps({"received": self.received, "state": self.state, "services": self.services,
+                           "from_field": self.email.from_field, "subject": self.email.subject, "body": self.email.body,
+                           "truncated": self.email.truncated, "message_id": self.email.message_id}, ensure_ascii=False)
+
+    @staticmethod
+    def from_json(line: str) -> "ArchivedMail":
+        record: dict = json.loads(line)
+
+        return ArchivedMail(record["received"], record["state"],
+                            Email(record["from_field"], record["subject"], record["body"], record.get("truncated", False), record.get("message_id", "")),
+                            record["services"])
+
+
+def read_segment(segment_path: Path, member_offset: int = 0) -> Iterator[str]:
+    """This yields the lines of the segment from the gzip member at member_offset on, decompressing it
+    while it's read. A member that was cut off by a crash while it was written ends the segment."""
+
+    try:
+        with segment_path.open("rb") as segment_file:
+            segment_file.seek(member_offset)
+            with gzip.open(segment_file, "rt", encoding="utf-8") as lines:
+                yield from lines
+    except (FileNotFoundError, EOFError, gzip.BadGzipFile):
+        return
+
+
+class MailArchive:
+    """The segments of the mail archive with the limits they are rotated and deleted at, a limit of 0 disables it"""
+
+    def __init__(self, store: StateStore, directory: Path = ARCHIVE_DIRECTORY, segment_bytes: int = 16 * 1024 * 1024, segment_seconds: float = DAY_SECONDS,
+                 retention_seconds: float = 90 * DAY_SECONDS, max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.store: StateStore = store
+        self.directory: Path = directory
+        self.segment_bytes: int = segment_bytes
+        self.segment_seconds: float = segment_seconds
+        self.retention_seconds: float = retention_seconds
+        self.max_bytes: int = max_bytes
+
+    def get_current_segment(self, now: float) -> ArchiveSegment:
+        """This returns the segment the next emails are appended to, a new one if the newest is over a limit.
+        A segment whose file doesn't have the size in the index wasn't written completely and isn't appended to."""
+
+        segments: list[ArchiveSegment] = self.store.get_archive_segments()
+        if segments:
+            segment: ArchiveSegment = segments[-1]
+            segment_path: Path = self.directory / segment.name
+            if ((self.segment_bytes <= 0 or segment.size < self.segment_bytes)
+                    and (self.segment_seconds <= 0 or now - segment.started < self.segment_seconds)
+                    and segment_path.exists() and segment_path.stat().st_size == segment.size):
+                return segment
+
+        return ArchiveSegment(f"mails-{int(now * 1000)}.jsonl.gz", now, now, 0)
+
+    def append(self, archived_mails: list[ArchivedMail], now: float | None = None) -> None:
+        """This appends the emails as one gzip member to the current segment and indexes them in the state store"""
+
+        if not archived_mails:
+            return
+
+        now = time() if now is None else now
+        segment: ArchiveSegment = self.get_current_segment(now)
+        member: bytes = gzip.compress("".join(f"{archived_mail.to_json()}\n" for archived_mail in archived_mails).encode("utf-8", "surrogatepass"), compresslevel=COMPRESS_LEVEL)
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with (self.directory / segment.name).open("ab") as segment_file:
+            member_offset: int = segment_file.tell()
+            segment_file.write(member)
+
+        segment.size = member_offset + len(member)
+        segment.newest = now
+        self.store.save_archive_member(segment, member_offset, [
+            (line, archived_mail.received, archived_mail.state, archived_mail.email.subject, service)
+            for line, archived_mail in enumerate(archived_mails)
+            for service in archived_mail.services or [None]])
+
+    def iter_mails(self, received_after: float | None = None) -> Iterator[ArchivedMail]:
+        """This yields every archived email that was received after received_after, in the order they were archived.
+        The segments are decompressed while they are read, only one line at a time is in memory."""
+
+        for segment in self.store.get_archive_segments():
+            if received_after is not None and segment.newest < received_after:
+                continue
+            for line in read_segment(self.directory / segment.name):
+                archived_mail: ArchivedMail = ArchivedMail.from_json(line)
+                if received_after is None or archived_mail.received >= received_after:
+                    yield archived_mail
+
+    def find_mails(self, subject: str | None = None, service: str | None = None,
+                   received_after: float | None = None, received_before: float | None = None) -> Iterator[ArchivedMail]:
+        """This yields the archived emails with the subject, that set the service and were received in the time range.
+        They are looked up in the index, only the gzip members with matching emails are decompressed."""
+
+        locations: list[tuple[str, int, int]] = self.store.find_archived_mails(subject, service, received_after, received_before)
+        for (segment_name, member_offset), member_locations in groupby(locations, key=lambda location: location[:2]):
+            lines: set[int] = {location[2] for location in member_locations}
+            last_line: int = max(lines)
+            # The following members are read as well, so reading stops after the last line that's needed
+            for line_number, line in enumerate(read_segment(self.directory / segment_name, member_offset)):
+                if line_number in lines:
+                    yield ArchivedMail.from_json(line)
+                if line_number >= last_line:
+                    break
+
+    def apply_retention(self, now: float | None = None) -> list[str]:
+        """This deletes the segments whose newest email is older than the retention and then the oldest ones
+        while the archive is larger than max_bytes, the current segment is kept. It returns the deleted segments."""
+
+        now = time() if now is None else now
+        segments: list[ArchiveSegment] = self.store.get_archive_segments()
+        archive_bytes: int = sum(segment.size for segment in segments)
+        deleted_segments: list[str] = []
+
+        for segment in segments[:-1]:
+            if ((self.retention_seconds <= 0 or now - segment.newest < self.retention_seconds)
+                    and (self.max_bytes <= 0 or archive_bytes <= self.max_bytes)):
+                break
+            (self.directory / segment.name).unlink(missing_ok=True)
+            archive_bytes -= segment.size
+            deleted_segments.append(segment.name)
+
+        self.store.delete_archive_segments(deleted_segments)
+
+        return deleted_segments
+
+
+def build_mail_archive(store: StateStore) -> MailArchive | None:
+    """This creates the mail archive with the limits from the 'Archive' section, None is returned if archive_mails is False"""
+
+    archive_config: SectionProxy = read_config_section("Archive")
+    if not archive_config.getboolean("archive_mails", True):
+        return None
+
+    return MailArchive(store, ARCHIVE_DIRECTORY,
+                       int(archive_config.getfloat("segment_mb", 16.0) * 1024 * 1024),
+                       archive_config.getfloat("segment_hours", 24.0) * 3600,
+                       archive_config.getfloat("retention_days", 90.0) * DAY_SECONDS,
+                       int(archive_config.getfloat("max_size_mb", 512.0) * 1024 * 1024))
+
+
+def archive_stored_mails(stored_emails: list[StoredMail], state: str, mail_archive: MailArchive, services: list[list[str]] | None = None) -> None:
+    """This appends the emails in the passed state to the archive, services has the names of the services every email set"""
+
+    services = services if services is not None else [[] for _ in stored_emails]
+    mail_archive.append([ArchivedMail(stored_email.received, state, stored_email.email, email_services)
+                         for stored_email, email_services in zip(stored_emails, services)])
+
+
+def archive_old_mails_without_service(store: StateStore, mail_archive: MailArchive, now: float | None = None, batch_size: int = 500) -> int:
+    """This moves the emails without service that were received more than without_service_days ago
+    from the state store to the archive, so they aren't evaluated anymore, and returns how many were moved"""
+
+    without_service_days: float = read_config_section("Archive").getfloat("without_service_days", 30.0)
+    if without_service_days <= 0:
+        return 0
+
+    now = time() if now is None else now
+    moved: int = 0
+    for stored_emails in store.iter_mails(("without-service",), batch_size, received_before=now - without_service_days * DAY_SECONDS):
+        with store.transaction():
+            archive_stored_mails(stored_emails, "without-service", mail_archive)
+            store.delete_mails([stored_email.id for stored_email in stored_emails if stored_email.id is not None])
+        moved += len(stored_emails)
+
+    return moved
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Prints the archived emails")
+    argument_parser.add_argument("--subject", help="only the emails with exactly this subject")
+    argument_parser.add_argument("--service", help="only the emails that set this service")
+    argument_parser.add_argument("--days", type=float, help="only the emails received in the last days")
+    argument_parser.add_argument("--json", action="store_true", help="print the emails as JSON lines")
+    arguments = argument_parser.parse_args()
+
+    store = StateStore()
+    mail_archive = MailArchive(store)
+    received_after: float | None = time() - arguments.days * DAY_SECONDS if arguments.days is not None else None
+    if arguments.subject is None and arguments.service is None:
+        archived_mails: Iterator[ArchivedMail] = mail_archive.iter_mails(received_after)
+    else:
+        archived_mails = mail_archive.find_mails(arguments.subject, arguments.service, received_after)
+
+    for archived_mail in archived_mails:
+        if arguments.json:
+            print(archived_mail.to_json())
+        else:
+            print(f"{datetime.fromtimestamp(archived_mail.received):%Y-%m-%d %H:%M:%S} {archived_mail.state:<15} "
+                  f"{archived_mail.email.subject}  {', '.join(archived_mail.services)}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
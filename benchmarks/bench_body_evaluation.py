@@ -0,0 +1,106 @@
+# This benchmark measures the cost of evaluating the ok/warn/crit RegEx of many
+# WordPress plugin service configs (from the template) against one update mail
+#
+# Usage: python benchmarks/bench_body_evaluation.py [--plugins 200] [--configs 200] [--repeat 5]
+
+import sys
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from pathlib import Path
+from re import search
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rules import BodyScan, ServiceRule, load_service_rules
+
+TEMPLATE_PATH = Path(__file__).resolve().parent.parent / "config/services/Wordpress_Pluging_Template.cfg.tl"
+
+
+def build_mail_body(plugin_count: int) -> str:
+    """This builds a WordPress update mail where every tenth plugin couldn't be updated"""
+
+    updated_plugins: list[str] = [f"- Plugin-{plugin_number} ({plugin_number}.0.1)" for plugin_number in range(plugin_count) if plugin_number % 10]
+    failed_plugins: list[str] = [f"- Plugin-{plugin_number} ({plugin_number}.0.0)" for plugin_number in range(plugin_count) if not plugin_number % 10]
+
+    return ("Hallo! Auf deiner Website wurden einige Plugins aktualisiert.\n\n"
+            "Diese Plugins sind jetzt auf dem neuesten Stand:\n" + "\n".join(updated_plugins) + "\n\n"
+            "Diese Plugins konnten nicht aktualisiert werden:\n" + "\n".join(failed_plugins) + "\n")
+
+
+def build_service_rules(config_count: int) -> list[ServiceRule]:
+    """This instantiates the WordPress template once per plugin"""
+
+    template: str = TEMPLATE_PATH.read_text()
+    service_configs = []
+    for plugin_number in range(config_count):
+        cfgparser = ConfigParser()
+        cfgparser.read_string(template.replace("EXACT_PLUGING_NAME", f"Plugin-{plugin_number}"))
+        service_configs.append((f"Plugin-{plugin_number}.cfg", cfgparser["Service"]))
+
+    return load_service_rules(service_configs)
+
+
+def evaluate_naive(service_rules: list[ServiceRule], body: str) -> list:
+    """This evaluates the rules like before, with every RegEx searched over the whole body"""
+
+    results = []
+    for service_rule in service_rules:
+        config = service_rule.config
+        ok_match = search(config.get("ok_regex"), body) if config.get("ok_regex") else None
+        warn_match = search(config.get("warn_regex"), body) if config.get("warn_regex") else None
+        crit_match = search(config.get("crit_regex"), body) if config.get("crit_regex") else None
+        search("", body)
+        relevant_match = crit_match or warn_match or ok_match
+        results.append(relevant_match.group(1) if relevant_match else None)
+
+    return results
+
+
+def evaluate_rules(service_rules: list[ServiceRule], body: str) -> list:
+    """This evaluates the rules with one shared body scan"""
+
+    body_scan = BodyScan(body)
+    results = []
+    for service_rule in service_rules:
+        evaluation = service_rule.evaluate(body_scan)
+        results.append(evaluation[1] if evaluation else None)
+
+    return results
+
+
+def measure(function, service_rules: list[ServiceRule], body: str, repeat: int) -> float:
+    """This returns the best time of repeat runs in seconds"""
+
+    best_time: float = float("inf")
+    for _ in range(repeat):
+        start: float = perf_counter()
+        function(service_rules, body)
+        best_time = min(best_time, perf_counter() - start)
+
+    return best_time
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Measures the per-mail cost of evaluating the body RegEx of many service configs")
+    argument_parser.add_argument("--plugins", type=int, nargs="+", default=[20, 100, 500])
+    argument_parser.add_argument("--configs", type=int, nargs="+", default=[20, 100, 500])
+    argument_parser.add_argument("--repeat", type=int, default=5)
+    arguments = argument_parser.parse_args()
+
+    print(f"{'plugins':>8} {'configs':>8} {'naive ms/mail':>14} {'rules ms/mail':>14} {'speedup':>8}")
+    for plugin_count in arguments.plugins:
+        body: str = build_mail_body(plugin_count)
+        for config_count in arguments.configs:
+            service_rules: list[ServiceRule] = build_service_rules(config_count)
+
+            # Both ways must find the same results
+            assert evaluate_naive(service_rules, body) == evaluate_rules(service_rules, body)
+
+            naive_time: float = measure(evaluate_naive, service_rules, body, arguments.repeat)
+            rules_time: float = measure(evaluate_rules, service_rules, body, arguments.repeat)
+            print(f"{plugin_count:>8} {config_count:>8} {naive_time * 1000:>14.3f} {rules_time * 1000:>14.3f} {naive_time / rules_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# This benchmark compares the html.parser tokenizer with BeautifulSoup on HTML notification
+# mails and measures decoding a batch of them in the process pool of mail2text, with and without starting the pool
+#
+# Usage: python benchmarks/bench_html_extraction.py [--mails 200] [--workers 0 2 4] [--repeat 3]
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mail2text
+from htmltext import extract_text, extract_text_with_bs4
+
+SYNOLOGY_MAIL = """<html><head><style>td {{ font-family: Arial; }}</style></head><body>
+<table><tr><td><b>Hyper Backup</b></td></tr>
+<tr><td>Dear user,<br>Backup task Daily-{number} on NAS-{number} has completed successfully.</td></tr>
+<tr><td>Start time: 2026-10-17 01:00:00<br/>End time: 2026-10-17 01:{number:02d}:00</td></tr>
+<tr><td>Sincerely,<br>Synology DiskStation</td></tr></table></body></html>"""
+
+VEEAM_MAIL = """<!DOCTYPE html><html><body><table>
+<tr><td colspan="2">Backup job: Daily-{number}</td></tr>
+<tr><td>Success</td><td>{number} of {number} VMs processed</td></tr>
+""" + "".join(f"<tr><td>VM{vm_number}</td><td>Success</td><td>12.{vm_number} GB</td><td>0:0{vm_number % 10}:00</td></tr>\n" for vm_number in range(30)) + """
+<!-- Veeam Backup &amp; Replication --></table>
+<p>Veeam Backup &amp; Replication 12.1.2.172 &copy; Veeam Software</p></body></html>"""
+
+WORDPRESS_MAIL = """<html><body><p>Hallo! Auf deiner Website https://example{number}.org wurden einige Plugins aktualisiert.</p>
+<p>Diese Plugins sind jetzt auf dem neuesten Stand:</p><ul>
+""" + "".join(f"<li>Plugin-{plugin_number} ({plugin_number}.0.1)</li>\n" for plugin_number in range(20)) + """</ul>
+<script>var tracking = "<p>not text</p>";</script></body></html>"""
+
+
+def build_payloads(mail_count: int) -> list[bytes]:
+    """This builds mail_count HTML payloads, alternating between the three mail types"""
+
+    templates: list[str] = [SYNOLOGY_MAIL, VEEAM_MAIL, WORDPRESS_MAIL]
+
+    return [templates[number % 3].format(number=number).encode() for number in range(mail_count)]
+
+
+def measure(function, payloads: list[bytes], repeat: int) -> float:
+    """This returns the best time of repeat runs in seconds"""
+
+    best_time: float = float("inf")
+    for _ in range(repeat):
+        start: float = perf_counter()
+        function(payloads)
+        best_time = min(best_time, perf_counter() - start)
+
+    return best_time
+
+
+def extract_with(extractor):
+    return lambda payloads: [extractor(payload) for payload in payloads]
+
+
+def check_same_texts(expected_texts: list[str], texts: list[str], extractor_name: str) -> None:
+    """This stops the benchmark at the first mail whose text differs from the expected one,
+    an assert would be skipped when the benchmark runs with python -O"""
+
+    for mail_number, (expected_text, text) in enumerate(zip(expected_texts, texts, strict=True)):
+        if text != expected_text:
+            raise SystemExit(f"{extractor_name} returns another text for mail {mail_number}:\n{text!r}\ninstead of\n{expected_text!r}")
+
+
+def decode_in_pool(workers: int):
+    """This returns a function that decodes the payloads like fetch_text_parts does with the given pool size"""
+
+    def decode(payloads: list[bytes]) -> list[str]:
+        return mail2text.map_decoding(extract_text, [(payload,) for payload in payloads])
+
+    mail2text.get_decode_pool_settings = lambda: (workers, 2)
+    mail2text.enable_decode_pool()
+    mail2text.decode_pool = None
+
+    return decode
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Compares the HTML to text extractors and the decode pool")
+    argument_parser.add_argument("--mails", type=int, default=200)
+    argument_parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    argument_parser.add_argument("--repeat", type=int, default=3)
+    arguments = argument_parser.parse_args()
+
+    payloads: list[bytes] = build_payloads(arguments.mails)
+
+    # Both extractors must return the same text
+    bs4_texts: list[str] = extract_with(extract_text_with_bs4)(payloads)
+    check_same_texts(bs4_texts, extract_with(extract_text)(payloads), "htmlparser")
+
+    bs4_time: float = measure(extract_with(extract_text_with_bs4), payloads, arguments.repeat)
+    htmlparser_time: float = measure(extract_with(extract_text), payloads, arguments.repeat)
+    print(f"{'extractor':<12} {'ms/mail':>8}")
+    print(f"{'bs4':<12} {bs4_time / len(payloads) * 1000:>8.3f}")
+    print(f"{'htmlparser':<12} {htmlparser_time / len(payloads) * 1000:>8.3f}  {bs4_time / htmlparser_time:.1f}x faster")
+
+    # A single run of main.py pays for starting the pool, the daemon only once for all of its runs
+    print(f"\n{'workers':>8} {'cold ms':>9} {'warm ms':>9}")
+    for workers in arguments.workers:
+        decode = decode_in_pool(workers)
+        start: float = perf_counter()
+        check_same_texts(bs4_texts, decode(payloads), f"the pool of {workers} workers")
+        cold_time: float = perf_counter() - start
+        print(f"{workers:>8} {cold_time * 1000:>9.1f} {measure(decode, payloads, arguments.repeat) * 1000:>9.1f}")
+        if mail2text.decode_pool is not None:
+            mail2text.decode_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# This benchmark runs every stage of Mail2CheckMk against the in-process IMAP stand-in (plain and TLS)
+# with a synthetic mail corpus and measures the latency and throughput of every stage.
+# It sweeps the number of mails, the body size and the number of service configs
+# and can save the results as JSON to compare them with the results of another commit.
+#
+# Usage: python benchmarks/bench_pipeline.py [--mails 100 1000] [--body-sizes 2048] [--configs 20 200]
+#                                            [--transports plain tls] [--repeat 3] [--json results.json] [--baseline old.json]
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from configparser import ConfigParser, SectionProxy
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from itertools import count
+from pathlib import Path
+from re import Match
+from time import perf_counter, time
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mail2text
+from main import run_mailbox_pipeline
+import service2checkmk
+from imapparse import parse_fetch_items
+from imapserver import IMAPStandIn, create_self_signed_context
+from mailcorpus import generate_corpus
+from models import Email, Service
+from rules import BodyScan, ServiceRule, SubjectIndex, build_rule_guard, build_subject_index
+from statestore import StateStore
+from textmail2service import create_service_object
+
+REPOSITORY_PATH = Path(__file__).resolve().parent.parent
+TEMPLATE_PATH = REPOSITORY_PATH / "config/services/Wordpress_Pluging_Template.cfg.tl"
+# The WordPress mails of the corpus mention plugins out of this many
+PLUGIN_COUNT = 100
+# Every measured run writes to a new state store
+STORE_NUMBERS = count(1)
+
+# Service configs for the other kinds of mails of the corpus, they are used in every run
+EXTRA_SERVICE_CONFIGS: dict[str, str] = {
+    "Synology.cfg": """[Service]
+email_subject_regex = \\[(NAS-\\d+)\\] Hyper Backup
+name = EMAIL_SUBJECT_REGEX Hyper Backup
+ok_regex = Backup task Daily on NAS-\\d+ (has completed successfully)
+crit_regex = Backup task Daily on NAS-\\d+ (has failed)
+ok_details = Hyper Backup on EMAIL_SUBJECT_REGEX REGEX_GROUP
+crit_details = Hyper Backup on EMAIL_SUBJECT_REGEX REGEX_GROUP
+""",
+    "Veeam.cfg": """[Service]
+email_subject_regex = Backup job: (Daily-\\d+)
+name = Veeam EMAIL_SUBJECT_REGEX
+ok_regex = Status: (Success)
+crit_regex = Status: (Failed)
+ok_details = Veeam job EMAIL_SUBJECT_REGEX REGEX_GROUP
+crit_details = Veeam job EMAIL_SUBJECT_REGEX REGEX_GROUP
+crit_cycle = 48
+""",
+    "Sicherung.cfg": """[Service]
+email_subject_regex = Sicherung für (Gerät \\d+)
+name = Sicherung EMAIL_SUBJECT_REGEX
+ok_regex = (erfolgreich) abgeschlossen
+ok_details = Die Sicherung von EMAIL_SUBJECT_REGEX war REGEX_GROUP
+""",
+}
+
+
+@dataclass
+class StageResult:
+    """The best time of one stage for one point of the sweep"""
+
+    transport: str
+    mails: int
+    body_size: int
+    configs: int
+    stage: str
+    seconds: float
+    mails_per_second: float
+    ms_per_mail: float
+
+
+def measure(function: Callable[[], object], repeat: int) -> tuple[float, object]:
+    """This returns the best time of repeat runs in seconds and the result of the last run"""
+
+    best_time: float = float("inf")
+    result: object = None
+    for _ in range(repeat):
+        start: float = perf_counter()
+        result = function()
+        best_time = min(best_time, perf_counter() - start)
+
+    return best_time, result
+
+
+def write_config(port: int, use_ssl: bool) -> SectionProxy:
+    """This writes the config.cfg of the benchmark in the working directory and returns its 'Mail' section.
+    Mails are neither archived nor deleted, so every repetition fetches the same mails."""
+
+    cfgparser = ConfigParser()
+    cfgparser.read_dict({
+        "Mail": {
+            "host": "127.0.0.1",
+            "port": str(port),
+            "use_ssl": str(use_ssl),
+            "user": "bench",
+            "password": "bench",
+            "inbox": "INBOX",
+            "incremental_sync": "False",
+            "archive_processed_mails": "False",
+            "delete_processed_mails": "False",
+            "headers_first": "True",
+            "fetch_text_parts_only": "True",
+        },
+        "Rules": {
+            "guard_rules": "off",
+        },
+    })
+    Path("config").mkdir(exist_ok=True)
+    with open("config/config.cfg", "w") as config_file:
+        cfgparser.write(config_file)
+
+    return cfgparser["Mail"]
+
+
+def write_service_configs(config_count: int) -> SubjectIndex:
+    """This writes config_count instances of the WordPress template and the extra configs
+    to config/services in the working directory and returns their subject index"""
+
+    service_directory = Path("config/services")
+    service_directory.mkdir(parents=True, exist_ok=True)
+    for service_file in service_directory.glob("*.cfg"):
+        service_file.unlink()
+
+    template: str = TEMPLATE_PATH.read_text()
+    for plugin_number in range(config_count):
+        (service_directory / f"Plugin-{plugin_number}.cfg").write_text(template.replace("EXACT_PLUGING_NAME", f"Plugin-{plugin_number}"))
+    for config_name, config_text in EXTRA_SERVICE_CONFIGS.items():
+        (service_directory / config_name).write_text(config_text)
+
+    return build_subject_index()
+
+
+def connect(mail_config: SectionProxy) -> mail2text.IMAPServer:
+    return mail2text.login_to_imap(mail2text.connect_to_imap_server(mail_config), mail_config)
+
+
+def connect_and_log_in(mail_config: SectionProxy) -> None:
+    imap_server = connect(mail_config)
+    imap_server.logout()
+
+
+def fetch_raw(imap_server: mail2text.IMAPServer, uids: list[str]) -> list[bytes]:
+    """This downloads every mail completely without decoding it"""
+
+    raw_mails: list[bytes] = []
+    for message_set in mail2text.build_message_sets(uids, 500):
+        status, data = imap_server.uid("FETCH", message_set, "(UID RFC822)")
+        raw_mails += [items.get("RFC822") or b"" for items in parse_fetch_items(data).values()]
+
+    return raw_mails
+
+
+def fetch_text_parts(imap_server: mail2text.IMAPServer, mail_config: SectionProxy, subject_index: SubjectIndex) -> list[Email]:
+    """This fetches the mails like a run does: the headers first and then only the text parts of routed mails"""
+
+    return [email for email_batch in mail2text.receive_emails(imap_server, mail_config, None, subject_index) for email in email_batch.emails]
+
+
+def route_subjects(emails: list[Email], subject_index: SubjectIndex) -> list[list[tuple[ServiceRule, Match]]]:
+    return [subject_index.match(email.subject) for email in emails]
+
+
+def evaluate_bodies(emails: list[Email], routes: list[list[tuple[ServiceRule, Match]]]) -> list[Service]:
+    """This evaluates the body RegEx of every routed rule with one shared body scan per mail"""
+
+    services: list[Service] = []
+    received: float = time()
+    for email, matches in zip(emails, routes):
+        if not matches:
+            continue
+        body_scan = BodyScan(email.body)
+        for service_rule, subject_match in matches:
+            service: Service | None = create_service_object(service_rule, email, subject_match, received, body_scan)
+            if service is not None:
+                services.append(service)
+
+    return services
+
+
+def write_state(emails: list[Email], services: list[Service], stores: list[StateStore]) -> StateStore:
+    """This saves the mails and services in a new state store like a run does and returns the store"""
+
+    store = StateStore(Path(f"state/bench-{next(STORE_NUMBERS)}.sqlite3"))
+    stores.append(store)
+    store.add_mails(emails, state="without-service")
+    store.save_services(services)
+
+    return store
+
+
+def run_end_to_end(mail_config: SectionProxy, subject_index: SubjectIndex) -> None:
+    """This runs the whole pipeline with a new state store and writes the output file"""
+
+    store = StateStore(Path(f"state/bench-{next(STORE_NUMBERS)}.sqlite3"))
+    rule_guard = build_rule_guard()
+    imap_server = connect(mail_config)
+
+    run_mailbox_pipeline(imap_server, mail_config, None, store, subject_index, rule_guard)
+    service2checkmk.write_and_clean_up(store, Path("state/checkmk-output.txt"))
+
+    imap_server.logout()
+    rule_guard.close()
+    store.close()
+
+
+def benchmark_point(transport: str, mail_config: SectionProxy, raw_mail_count: int, body_size: int, config_count: int, repeat: int) -> list[StageResult]:
+    """This measures every stage for one point of the sweep, the mails have to be loaded already"""
+
+    subject_index: SubjectIndex = write_service_configs(config_count)
+    imap_server = connect(mail_config)
+    stores: list[StateStore] = []
+    timings: dict[str, float] = {}
+
+    timings["connect_login"], _ = measure(lambda: connect_and_log_in(mail_config), repeat)
+    timings["search"], uids = measure(lambda: mail2text.get_message_numbers_from_inbox(imap_server, mail_config, None), repeat)
+    timings["fetch_raw"], raw_mails = measure(lambda: fetch_raw(imap_server, uids), repeat)
+    timings["mime_decode"], _ = measure(lambda: [mail2text.parse_email(raw_mail) for raw_mail in raw_mails], repeat)
+    timings["fetch_text_parts"], emails = measure(lambda: fetch_text_parts(imap_server, mail_config, subject_index), repeat)
+    timings["subject_routing"], routes = measure(lambda: route_subjects(emails, subject_index), repeat)
+    timings["body_evaluation"], services = measure(lambda: evaluate_bodies(emails, routes), repeat)
+    timings["state_writes"], store = measure(lambda: write_state(emails, services, stores), repeat)
+    timings["output"], _ = measure(lambda: service2checkmk.write_output_file(store.render_services(), Path("state/checkmk-output.txt")), repeat)
+    timings["end_to_end"], _ = measure(lambda: run_end_to_end(mail_config, subject_index), repeat)
+
+    for store in stores:
+        store.close()
+    imap_server.logout()
+
+    # Connecting doesn't depend on the mails, its time is per connection
+    return [StageResult(transport, raw_mail_count, body_size, config_count, stage, seconds,
+                        raw_mail_count / seconds if seconds and stage != "connect_login" else 0.0,
+                        seconds / raw_mail_count * 1000 if stage != "connect_login" else seconds * 1000)
+            for stage, seconds in timings.items()]
+
+
+def get_commit() -> str:
+    """This returns the commit the benchmark ran on, so saved results can be told apart"""
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results: list[StageResult], baseline_results: dict[tuple, float]) -> None:
+    """This prints the results as a table, with the change against the baseline if one was passed"""
+
+    print(f"{'transport':<9} {'mails':>6} {'body':>6} {'configs':>7} {'stage':<17} {'seconds':>9} {'mails/s':>10} {'ms/mail':>9}"
+          + (f" {'vs baseline':>11}" if baseline_results else ""))
+    for result in results:
+        line: str = (f"{result.transport:<9} {result.mails:>6} {result.body_size:>6} {result.configs:>7} {result.stage:<17} "
+                     f"{result.seconds:>9.4f} {result.mails_per_second:>10.0f} {result.ms_per_mail:>9.3f}")
+        baseline_seconds: float | None = baseline_results.get((result.transport, result.mails, result.body_size, result.configs, result.stage))
+        if baseline_seconds:
+            line += f" {(result.seconds / baseline_seconds - 1) * 100:>+10.1f}%"
+        print(line)
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Measures every stage of Mail2CheckMk against a local IMAP server")
+    argument_parser.add_argument("--mails", type=int, nargs="+", default=[100, 1000])
+    argument_parser.add_argument("--body-sizes", type=int, nargs="+", default=[2048, 32768])
+    argument_parser.add_argument("--configs", type=int, nargs="+", default=[20, 100])
+    argument_parser.add_argument("--transports", nargs="+", choices=["plain", "tls"], default=["plain", "tls"])
+    argument_parser.add_argument("--repeat", type=int, default=3)
+    argument_parser.add_argument("--json", type=Path, help="save the results to this JSON file")
+    argument_parser.add_argument("--baseline", type=Path, help="compare with the results of a JSON file of an earlier run")
+    arguments = argument_parser.parse_args()
+
+    baseline_results: dict[tuple, float] = {}
+    if arguments.baseline:
+        for result in json.loads(arguments.baseline.read_text())["results"]:
+            baseline_results[(result["transport"], result["mails"], result["body_size"], result["configs"], result["stage"])] = result["seconds"]
+
+    results: list[StageResult] = []
+    original_directory: Path = Path.cwd()
+
+    # mail2text, rules and the state store use paths relative to the working directory
+    with tempfile.TemporaryDirectory(prefix="mail2checkmk-bench-") as working_directory:
+        os.chdir(working_directory)
+        try:
+            for transport in arguments.transports:
+                ssl_context = create_self_signed_context(Path(working_directory)) if transport == "tls" else None
+                if transport == "tls" and ssl_context is None:
+                    print("openssl isn't installed, skipping the TLS runs", file=sys.stderr)
+                    continue
+
+                with IMAPStandIn(ssl_context) as imap_stand_in:
+                    mail_config: SectionProxy = write_config(imap_stand_in.port, transport == "tls")
+                    for mail_count in arguments.mails:
+                        for body_size in arguments.body_sizes:
+                            imap_stand_in.load_mails(generate_corpus(mail_count, body_size, PLUGIN_COUNT))
+                            for config_count in arguments.configs:
+                                results += benchmark_point(transport, mail_config, mail_count, body_size, config_count, arguments.repeat)
+        finally:
+            os.chdir(original_directory)
+
+    print_results(results, baseline_results)
+
+    if arguments.json:
+        arguments.json.write_text(json.dumps({
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "results": [asdict(result) for result in results],
+        }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
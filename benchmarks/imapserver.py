@@ -0,0 +1,408 @@
+# This module is a small in-process IMAP4rev1 server for the benchmarks. It keeps the mailboxes in memory
+# and answers the commands mail2text sends (CAPABILITY, LOGIN, SELECT, UID SEARCH/FETCH/MOVE/COPY/STORE/EXPUNGE,
+# IDLE, NOOP, LOGOUT) including BODYSTRUCTURE, HEADER.FIELDS and partial section fetches, plain or over TLS.
+# Everything a mail needs for a FETCH is prepared when it is loaded, so the benchmarks measure the client.
+
+import re
+import ssl
+import subprocess
+import threading
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from email import message_from_bytes
+from email.header import decode_header, make_header
+from email.message import Message
+from pathlib import Path
+from shutil import which
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+
+CAPABILITIES = "IMAP4rev1 IDLE MOVE UIDPLUS"
+FETCH_ITEM_PATTERN = re.compile(r"BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?|RFC822\.SIZE|RFC822|BODYSTRUCTURE|UID|FLAGS", re.IGNORECASE)
+SEARCH_TOKEN_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"|\(|\)|[^\s()]+')
+
+
+def quote(value: str | None) -> str:
+    """This returns the value as an IMAP quoted string or NIL"""
+
+    if value is None:
+        return "NIL"
+
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def unquote(token: str) -> str:
+    if token.startswith('"') and token.endswith('"'):
+        return re.sub(r"\\(.)", r"\1", token[1:-1])
+
+    return token
+
+
+@dataclass
+class StoredMessage:
+    """A mail of a mailbox with everything a FETCH can ask for"""
+
+    uid: int
+    raw: bytes
+    subject: str
+    header_fields: list[tuple[str, bytes]]
+    body_structure: bytes
+    sections: dict[str, bytes]
+    flags: set[str] = field(default_factory=set)
+
+
+def split_header_fields(raw: bytes) -> list[tuple[str, bytes]]:
+    """This returns the lowercase name and the raw (folded) lines of every header field"""
+
+    header_block: bytes = re.split(rb"\r?\n\r?\n", raw, maxsplit=1)[0]
+    header_fields: list[tuple[str, bytes]] = []
+
+    for line in header_block.splitlines(keepends=True):
+        if line[:1] in (b" ", b"\t") and header_fields:
+            name, lines = header_fields[-1]
+            header_fields[-1] = (name, lines + line)
+        else:
+            header_fields.append((line.split(b":", 1)[0].strip().decode(errors="replace").lower(), line))
+
+    return [(name, lines if lines.endswith(b"\n") else lines + b"\r\n") for name, lines in header_fields]
+
+
+def build_body_structure(part: Message, section: str, sections: dict[str, bytes], message_root: bool = True) -> str:
+    """This returns the BODYSTRUCTURE of the part and adds the raw body of every leaf part to sections"""
+
+    if part.is_multipart():
+        child_structures: str = "".join(build_body_structure(child_part, f"{section}.{part_number}" if section else str(part_number), sections, False)
+                                        for part_number, child_part in enumerate(part.get_payload(), start=1))
+        return f"({child_structures} {quote(part.get_content_subtype().upper())})"
+
+    if message_root:
+        section = f"{section}.1" if section else "1"
+
+    payload = part.get_payload()
+    body: bytes = payload.encode("ascii", "surrogateescape") if isinstance(payload, str) else b""
+    sections[section] = body
+
+    parameters: list[tuple[str, str]] = (part.get_params() or [])[1:]
+    parameter_list: str = "(" + " ".join(f"{quote(name.upper())} {quote(str(value))}" for name, value in parameters) + ")" if parameters else "NIL"
+    encoding: str = str(part.get("Content-Transfer-Encoding", "7bit")).upper()
+    structure: str = (f"{quote(part.get_content_maintype().upper())} {quote(part.get_content_subtype().upper())} {parameter_list} "
+                      f"NIL NIL {quote(encoding)} {len(body)}")
+
+    if part.get_content_maintype() == "text":
+        # Text parts have their number of lines after the size
+        line_count: int = body.count(b"\n")
+        structure += f" {line_count}"
+    elif part.get_content_type() == "message/rfc822":
+        # The envelope and body structure of attached messages aren't built, they are only described as basic parts
+        return f"({structure})"
+
+    disposition: str | None = part.get_content_disposition()
+    disposition_list: str = f"({quote(disposition.upper())} NIL)" if disposition else "NIL"
+
+    return f"({structure} NIL {disposition_list} NIL)"
+
+
+def prepare_message(uid: int, raw: bytes) -> StoredMessage:
+    """This parses a raw mail once and keeps every part a FETCH may ask for"""
+
+    message: Message = message_from_bytes(raw)
+    sections: dict[str, bytes] = {}
+    body_structure: str = build_body_structure(message, "", sections)
+
+    try:
+        subject: str = str(make_header(decode_header(message.get("Subject", ""))))
+    except (LookupError, UnicodeDecodeError):
+        subject = str(message.get("Subject", ""))
+
+    return StoredMessage(uid, raw, subject, split_header_fields(raw), body_structure.encode("utf-8", "surrogateescape"), sections)
+
+
+class Mailbox:
+    """The messages of one mailbox sorted by UID"""
+
+    def __init__(self, uidvalidity: int) -> None:
+        self.uidvalidity: int = uidvalidity
+        self.next_uid: int = 1
+        self.uids: list[int] = []
+        self.messages: dict[int, StoredMessage] = {}
+
+    def append(self, raw: bytes) -> None:
+        self.append_prepared(prepare_message(self.next_uid, raw))
+
+    def append_prepared(self, message: StoredMessage) -> None:
+        message = StoredMessage(self.next_uid, message.raw, message.subject, message.header_fields, message.body_structure, message.sections)
+        self.uids.append(self.next_uid)
+        self.messages[self.next_uid] = message
+        self.next_uid += 1
+
+    def remove(self, uids: set[int]) -> None:
+        self.uids = [uid for uid in self.uids if uid not in uids]
+        for uid in uids:
+            self.messages.pop(uid, None)
+
+    def get_sequence_number(self, uid: int) -> int:
+        return bisect_left(self.uids, uid) + 1
+
+    def parse_uid_set(self, uid_set: str) -> set[int]:
+        """This returns the existing UIDs of a set like '1:5,7,9:*'"""
+
+        highest_uid: int = self.uids[-1] if self.uids else 0
+        uids: set[int] = set()
+
+        for uid_range in uid_set.split(","):
+            start, _, end = uid_range.partition(":")
+            first: int = highest_uid if start == "*" else int(start)
+            last: int = first if not end else highest_uid if end == "*" else int(end)
+            first, last = min(first, last), max(first, last)
+            if last - first > len(self.uids):
+                uids.update(uid for uid in self.uids if first <= uid <= last)
+            else:
+                uids.update(uid for uid in range(first, last + 1) if uid in self.messages)
+
+        return uids
+
+
+class IMAPRequestHandler(StreamRequestHandler):
+    """This handles one client connection"""
+
+    server: "IMAPStandInServer"
+    # Responses are buffered and flushed once per command, small unbuffered writes
+    # would add the delayed ACK of the client to every command
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        if self.server.ssl_context is not None:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        super().setup()
+        self.selected: Mailbox | None = None
+
+    def send(self, data: bytes) -> None:
+        self.wfile.write(data)
+
+    def handle(self) -> None:
+        self.send(b"* OK [CAPABILITY " + CAPABILITIES.encode() + b"] IMAP stand-in ready\r\n")
+        self.wfile.flush()
+
+        try:
+            while True:
+                line: bytes = self.rfile.readline()
+                if not line:
+                    return
+
+                tag, _, rest = line.decode(errors="replace").rstrip("\r\n").partition(" ")
+                command, _, arguments = rest.partition(" ")
+                if not self.run_command(tag, command.upper(), arguments):
+                    return
+                self.wfile.flush()
+        except (OSError, ssl.SSLError):
+            return
+
+    def run_command(self, tag: str, command: str, arguments: str) -> bool:
+        """This answers one command and returns False if the connection should be closed"""
+
+        with self.server.lock:
+            match command:
+                case "CAPABILITY":
+                    self.send(f"* CAPABILITY {CAPABILITIES}\r\n".encode())
+                case "LOGIN":
+                    user, password = (unquote(token) for token in SEARCH_TOKEN_PATTERN.findall(arguments)[:2])
+                    if (user, password) != (self.server.user, self.server.password):
+                        self.send(f"{tag} NO [AUTHENTICATIONFAILED] invalid credentials\r\n".encode())
+                        return True
+                case "SELECT" | "EXAMINE":
+                    self.selected = self.server.get_mailbox(unquote(arguments.strip()))
+                    self.send(f"* {len(self.selected.uids)} EXISTS\r\n* 0 RECENT\r\n"
+                              f"* OK [UIDVALIDITY {self.selected.uidvalidity}] UIDs valid\r\n"
+                              f"* OK [UIDNEXT {self.selected.next_uid}] predicted next UID\r\n".encode())
+                case "STATUS":
+                    mailbox_name, _, items = arguments.partition(" ")
+                    mailbox: Mailbox = self.server.get_mailbox(unquote(mailbox_name))
+                    self.send(f"* STATUS {mailbox_name} (MESSAGES {len(mailbox.uids)} UIDVALIDITY {mailbox.uidvalidity} UIDNEXT {mailbox.next_uid})\r\n".encode())
+                case "UID":
+                    subcommand, _, uid_arguments = arguments.partition(" ")
+                    self.run_uid_command(subcommand.upper(), uid_arguments)
+                case "EXPUNGE" | "CLOSE":
+                    self.expunge(None)
+                case "IDLE":
+                    self.send(b"+ idling\r\n")
+                    self.wfile.flush()
+                    self.server.lock.release()
+                    try:
+                        self.rfile.readline()
+                    finally:
+                        self.server.lock.acquire()
+                case "NOOP":
+                    pass
+                case "LOGOUT":
+                    self.send(f"* BYE logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+                    self.wfile.flush()
+                    return False
+                case _:
+                    self.send(f"{tag} BAD unknown command\r\n".encode())
+                    return True
+
+        self.send(f"{tag} OK {command} completed\r\n".encode())
+        return True
+
+    def run_uid_command(self, subcommand: str, arguments: str) -> None:
+        mailbox: Mailbox | None = self.selected
+        if mailbox is None:
+            return
+
+        uid_set, _, rest = arguments.partition(" ")
+        match subcommand:
+            case "SEARCH":
+                tokens: list[str] = SEARCH_TOKEN_PATTERN.findall(arguments)
+                matching_uids: set[int] = set(mailbox.uids)
+                position: int = 0
+                # The criteria of a search are combined with AND
+                while position < len(tokens):
+                    position, criterion_uids = self.search_criterion(mailbox, tokens, position)
+                    matching_uids &= criterion_uids
+                self.send(b"* SEARCH" + b"".join(b" %d" % uid for uid in sorted(matching_uids)) + b"\r\n")
+            case "FETCH":
+                self.fetch(mailbox, mailbox.parse_uid_set(uid_set), rest)
+            case "MOVE" | "COPY":
+                uids: set[int] = mailbox.parse_uid_set(uid_set)
+                target: Mailbox = self.server.get_mailbox(unquote(rest.strip()))
+                for uid in sorted(uids):
+                    target.append_prepared(mailbox.messages[uid])
+                if subcommand == "MOVE":
+                    mailbox.remove(uids)
+            case "STORE":
+                for uid in mailbox.parse_uid_set(uid_set):
+                    if "\\Deleted" in rest and not rest.startswith("-"):
+                        mailbox.messages[uid].flags.add("\\Deleted")
+            case "EXPUNGE":
+                self.expunge(mailbox.parse_uid_set(uid_set))
+
+    def search_criterion(self, mailbox: Mailbox, tokens: list[str], position: int) -> tuple[int, set[int]]:
+        """This evaluates the search criterion at the position and returns the position after it and the matching UIDs.
+        Only ALL, UID, SUBJECT and OR are understood, any other key matches every message."""
+
+        key: str = tokens[position].upper()
+        match key:
+            case "OR":
+                position, first_uids = self.search_criterion(mailbox, tokens, position + 1)
+                position, second_uids = self.search_criterion(mailbox, tokens, position)
+                return position, first_uids | second_uids
+            case "UID":
+                return position + 2, mailbox.parse_uid_set(tokens[position + 1])
+            case "SUBJECT":
+                subject_filter: str = unquote(tokens[position + 1]).lower()
+                return position + 2, {uid for uid in mailbox.uids if subject_filter in mailbox.messages[uid].subject.lower()}
+            case _:
+                return position + 1, set(mailbox.uids)
+
+    def fetch(self, mailbox: Mailbox, uids: set[int], items: str) -> None:
+        requested_items: list[re.Match] = list(FETCH_ITEM_PATTERN.finditer(items))
+
+        for uid in sorted(uids):
+            message: StoredMessage = mailbox.messages[uid]
+            response_items: list[bytes] = [b"UID %d" % uid]
+
+            for item in requested_items:
+                name: str = item.group(0).upper()
+                if name == "UID":
+                    continue
+                if name == "FLAGS":
+                    response_items.append(f"FLAGS ({' '.join(sorted(message.flags))})".encode())
+                elif name == "BODYSTRUCTURE":
+                    response_items.append(b"BODYSTRUCTURE " + message.body_structure)
+                elif name == "RFC822.SIZE":
+                    response_items.append(b"RFC822.SIZE %d" % len(message.raw))
+                elif name == "RFC822":
+                    response_items.append(b"RFC822 {%d}\r\n" % len(message.raw) + message.raw)
+                else:
+                    section: str = item.group(1).upper()
+                    if section.startswith("HEADER.FIELDS"):
+                        field_names: set[str] = {field_name.lower() for field_name in re.findall(r"[\w-]+", section[len("HEADER.FIELDS"):])}
+                        content: bytes = b"".join(lines for field_name, lines in message.header_fields if field_name in field_names) + b"\r\n"
+                    elif section == "":
+                        content = message.raw
+                    else:
+                        content = message.sections.get(section, b"")
+
+                    partial: str = ""
+                    if item.group(2) is not None:
+                        start: int = int(item.group(2))
+                        content = content[start:start + int(item.group(3))] if item.group(3) else content[start:]
+                        partial = f"<{start}>"
+                    response_items.append(f"BODY[{section}]{partial} {{{len(content)}}}\r\n".encode() + content)
+
+            self.send(b"* %d FETCH (" % mailbox.get_sequence_number(uid) + b" ".join(response_items) + b")\r\n")
+
+    def expunge(self, uids: set[int] | None) -> None:
+        mailbox: Mailbox | None = self.selected
+        if mailbox is None:
+            return
+
+        deleted_uids: set[int] = {uid for uid in (mailbox.uids if uids is None else uids) if "\\Deleted" in mailbox.messages[uid].flags}
+        for uid in sorted(deleted_uids, reverse=True):
+            self.send(b"* %d EXPUNGE\r\n" % mailbox.get_sequence_number(uid))
+        mailbox.remove(deleted_uids)
+
+
+class IMAPStandInServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, ssl_context: ssl.SSLContext | None, user: str, password: str) -> None:
+        super().__init__(("127.0.0.1", 0), IMAPRequestHandler)
+        self.ssl_context: ssl.SSLContext | None = ssl_context
+        self.user: str = user
+        self.password: str = password
+        self.lock = threading.RLock()
+        self.mailboxes: dict[str, Mailbox] = {}
+
+    def get_mailbox(self, name: str) -> Mailbox:
+        """This returns the mailbox and creates it if it doesn't exist"""
+
+        if name not in self.mailboxes:
+            self.mailboxes[name] = Mailbox(uidvalidity=len(self.mailboxes) + 1)
+
+        return self.mailboxes[name]
+
+
+class IMAPStandIn:
+    """This runs the server in a background thread of the current process, use it as a context manager"""
+
+    def __init__(self, ssl_context: ssl.SSLContext | None = None, user: str = "bench", password: str = "bench") -> None:
+        self.server = IMAPStandInServer(ssl_context, user, password)
+        self.port: int = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "IMAPStandIn":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def load_mails(self, raw_mails: list[bytes], mailbox_name: str = "INBOX") -> None:
+        """This replaces the mailbox with the raw mails, a new UIDVALIDITY makes clients resync"""
+
+        with self.server.lock:
+            mailbox = Mailbox(uidvalidity=max((mailbox.uidvalidity for mailbox in self.server.mailboxes.values()), default=0) + 1)
+            for raw_mail in raw_mails:
+                mailbox.append(raw_mail)
+            self.server.mailboxes[mailbox_name] = mailbox
+
+
+def create_self_signed_context(directory: Path) -> ssl.SSLContext | None:
+    """This creates a server TLS context with a self-signed certificate for localhost,
+    None is returned if openssl isn't installed"""
+
+    if which("openssl") is None:
+        return None
+
+    key_path: Path = directory / "imap-stand-in.key"
+    certificate_path: Path = directory / "imap-stand-in.crt"
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                    "-keyout", str(key_path), "-out", str(certificate_path)], check=True, capture_output=True)
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(certificate_path, key_path)
+
+    return ssl_context
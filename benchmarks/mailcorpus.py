@@ -0,0 +1,173 @@
+# This module generates a synthetic but realistic mail corpus for the benchmarks:
+# WordPress plugin update mails, multipart/alternative backup reports, HTML-only NAS notifications,
+# mails with large attachments and mails in other charsets with encoded subjects
+#
+# Usage: python benchmarks/mailcorpus.py [--mails 100] [--body-size 2048] [--output corpus-directory]
+
+import random
+from argparse import ArgumentParser
+from email.message import EmailMessage
+from email.policy import SMTP
+from pathlib import Path
+
+# How often every kind of mail is in the corpus
+MAIL_KINDS: dict[str, int] = {
+    "wordpress": 4,
+    "alternative": 2,
+    "html": 2,
+    "attachment": 1,
+    "charset": 1,
+}
+
+FILLER_WORDS: list[str] = ["backup", "server", "update", "erfolgreich", "Datei", "Größe", "task", "volume", "snapshot", "report"]
+
+
+def build_filler(body_size: int, rng: random.Random) -> str:
+    """This returns lines of random words that are about body_size characters long"""
+
+    lines: list[str] = []
+    length: int = 0
+    while length < body_size:
+        line: str = " ".join(rng.choice(FILLER_WORDS) for _ in range(12))
+        lines.append(line)
+        length += len(line) + 1
+
+    return "\n".join(lines)
+
+
+def build_wordpress_mail(number: int, body_size: int, plugin_count: int, rng: random.Random) -> EmailMessage:
+    """This builds a plugin update mail of the WordPress template, about every tenth plugin failed"""
+
+    updated_plugins: list[str] = []
+    failed_plugins: list[str] = []
+    for plugin_number in rng.sample(range(plugin_count), min(plugin_count, 20)):
+        if rng.random() > 0.1:
+            updated_plugins.append(f"- Plugin-{plugin_number} ({plugin_number}.{number}.1)")
+        else:
+            failed_plugins.append(f"- Plugin-{plugin_number} ({plugin_number}.{number}.0)")
+
+    body: str = ("Hallo! Auf deiner Website wurden einige Plugins aktualisiert.\n\n"
+                 "Diese Plugins sind jetzt auf dem neuesten Stand:\n" + "\n".join(updated_plugins) + "\n\n")
+    if failed_plugins:
+        body += "Diese Plugins konnten nicht aktualisiert werden:\n" + "\n".join(failed_plugins) + "\n\n"
+    body += build_filler(body_size, rng)
+
+    message = EmailMessage()
+    message["Subject"] = f"[site{number % 25}.example.org] Einige Plugins wurden automatisch aktualisiert"
+    message["From"] = f"WordPress <wordpress@site{number % 25}.example.org>"
+    message.set_content(body)
+
+    return message
+
+
+def build_alternative_mail(number: int, body_size: int, rng: random.Random) -> EmailMessage:
+    """This builds a Veeam like backup report with a text and an HTML part"""
+
+    vm_rows: list[tuple[str, str]] = [(f"VM{vm_number}", "Success" if rng.random() > 0.05 else "Failed") for vm_number in range(20)]
+    job_status: str = "Failed" if any(status == "Failed" for vm_name, status in vm_rows) else "Success"
+    filler: str = build_filler(body_size, rng)
+
+    message = EmailMessage()
+    message["Subject"] = f"[{job_status}] Backup job: Daily-{number % 40} (20 VMs)"
+    message["From"] = "Veeam Backup <veeam@backup.example.org>"
+    message.set_content(f"Backup job: Daily-{number % 40}\nStatus: {job_status}\n"
+                        + "\n".join(f"{vm_name} {status}" for vm_name, status in vm_rows) + "\n\n" + filler)
+    message.add_alternative(f"<html><body><table><tr><td>Backup job: Daily-{number % 40}</td><td>{job_status}</td></tr>"
+                            + "".join(f"<tr><td>{vm_name}</td><td>{status}</td></tr>" for vm_name, status in vm_rows)
+                            + f"</table><p>{filler.replace(chr(10), '<br>')}</p></body></html>", subtype="html")
+
+    return message
+
+
+def build_html_mail(number: int, body_size: int, rng: random.Random) -> EmailMessage:
+    """This builds a Synology like notification that only has an HTML part"""
+
+    result: str = "has completed successfully" if rng.random() > 0.1 else "has failed"
+
+    message = EmailMessage()
+    message["Subject"] = f"[NAS-{number % 10}] Hyper Backup task Daily {result}"
+    message["From"] = f"Synology <nas{number % 10}@example.org>"
+    message.set_content(f"<html><head><style>td {{ font-family: Arial; }}</style></head><body><table>"
+                        f"<tr><td><b>Hyper Backup</b></td></tr>"
+                        f"<tr><td>Backup task Daily on NAS-{number % 10} {result}.</td></tr>"
+                        f"<tr><td>{build_filler(body_size, rng).replace(chr(10), '<br>')}</td></tr>"
+                        f"</table></body></html>", subtype="html")
+
+    return message
+
+
+def build_attachment_mail(number: int, body_size: int, rng: random.Random) -> EmailMessage:
+    """This builds a report mail with a short text and a large PDF attachment, which mail2text shouldn't download"""
+
+    message = EmailMessage()
+    message["Subject"] = f"Monthly report {number}"
+    message["From"] = "Reports <reports@example.org>"
+    message.set_content(f"The monthly report is attached.\n\n{build_filler(body_size // 4, rng)}")
+    message.add_attachment(rng.randbytes(max(body_size, 1) * 64), maintype="application", subtype="pdf", filename=f"report-{number}.pdf")
+
+    return message
+
+
+def build_charset_mail(number: int, body_size: int, rng: random.Random) -> EmailMessage:
+    """This builds a mail in ISO-8859-1 or UTF-8 with an encoded subject and umlauts in the body"""
+
+    charset: str = rng.choice(["iso-8859-1", "utf-8"])
+
+    message = EmailMessage()
+    message["Subject"] = f"Sicherung für Gerät {number} abgeschlossen – Größe {rng.randint(1, 900)} GB"
+    message["From"] = "Überwachung <monitoring@example.org>"
+    message.set_content(f"Die Sicherung von Gerät {number} wurde erfolgreich abgeschlossen.\n\n{build_filler(body_size, rng)}",
+                        charset=charset, cte="quoted-printable")
+
+    return message
+
+
+def generate_mail(number: int, kind: str, body_size: int, plugin_count: int, rng: random.Random) -> bytes:
+    """This returns one raw mail of the kind with CRLF line endings like IMAP servers send them"""
+
+    match kind:
+        case "wordpress":
+            message = build_wordpress_mail(number, body_size, plugin_count, rng)
+        case "alternative":
+            message = build_alternative_mail(number, body_size, rng)
+        case "html":
+            message = build_html_mail(number, body_size, rng)
+        case "attachment":
+            message = build_attachment_mail(number, body_size, rng)
+        case "charset":
+            message = build_charset_mail(number, body_size, rng)
+        case _:
+            raise ValueError(f"unknown mail kind {kind}")
+
+    message["To"] = "monitoring@example.org"
+    message["Date"] = "Sat, 17 Oct 2026 01:00:00 +0200"
+    message["Message-ID"] = f"<{number}.{kind}@bench.example.org>"
+
+    return message.as_bytes(policy=SMTP)
+
+
+def generate_corpus(mail_count: int, body_size: int = 2048, plugin_count: int = 100, seed: int = 0) -> list[bytes]:
+    """This returns mail_count raw mails with the mix of MAIL_KINDS, the same seed always returns the same corpus"""
+
+    rng = random.Random(seed)
+    kinds: list[str] = [kind for kind, weight in MAIL_KINDS.items() for _ in range(weight)]
+
+    return [generate_mail(number, kinds[number % len(kinds)], body_size, plugin_count, rng) for number in range(mail_count)]
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Writes a synthetic mail corpus as .eml files")
+    argument_parser.add_argument("--mails", type=int, default=100)
+    argument_parser.add_argument("--body-size", type=int, default=2048)
+    argument_parser.add_argument("--plugins", type=int, default=100)
+    argument_parser.add_argument("--seed", type=int, default=0)
+    argument_parser.add_argument("--output", type=Path, default=Path("corpus"))
+    arguments = argument_parser.parse_args()
+
+    arguments.output.mkdir(parents=True, exist_ok=True)
+    for number, raw_mail in enumerate(generate_corpus(arguments.mails, arguments.body_size, arguments.plugins, arguments.seed)):
+        (arguments.output / f"{number:06d}.eml").write_bytes(raw_mail)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+# This module reads ./config/config.cfg for every other module. The file is only parsed again
+# once it changed, so the sections of one run all come from one parse
+
+from configparser import ConfigParser, SectionProxy
+from pathlib import Path
+
+CONFIG_PATH = Path("config/config.cfg")
+
+# The parsed config file with the path, modification time and size it was parsed from
+parsed_config: tuple[tuple[str, int, int], ConfigParser] | None = None
+
+
+def read_config_file() -> ConfigParser:
+    """This returns the parsed config file, a file that doesn't exist is parsed as an empty one"""
+
+    global parsed_config
+
+    try:
+        config_stat = CONFIG_PATH.stat()
+        config_version: tuple[str, int, int] = (str(CONFIG_PATH.resolve()), config_stat.st_mtime_ns, config_stat.st_size)
+    except FileNotFoundError:
+        config_version = (str(CONFIG_PATH.resolve()), 0, 0)
+
+    if parsed_config is None or parsed_config[0] != config_version:
+        cfgparser = ConfigParser()
+        cfgparser.read(CONFIG_PATH)
+        parsed_config = (config_version, cfgparser)
+
+    return parsed_config[1]
+
+
+def read_config_section(name: str) -> SectionProxy:
+    """This returns the section of the config file, if it doesn't exist the returned section only has the defaults"""
+
+    cfgparser: ConfigParser = read_config_file()
+
+    return cfgparser[name] if cfgparser.has_section(name) else cfgparser[cfgparser.default_section]
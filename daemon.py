@@ -0,0 +1,180 @@
+# This module runs Mail2CheckMk as a long running daemon e.g. as a systemd service.
+# It keeps one IMAP connection open, waits for new mails with IMAP IDLE and after
+# every run atomically writes the local check output to a file that mail2checkmk.sh prints.
+# With more than one account or mailbox they are polled every idle_timeout seconds instead
+#
+# Usage: python daemon.py
+
+import sys
+from configparser import SectionProxy
+from imaplib import IMAP4
+from pathlib import Path
+from re import match
+from select import select
+from signal import SIGTERM, signal
+from time import monotonic, sleep
+
+import prepare
+import mail2text
+import service2checkmk
+from configfile import read_config_section
+from main import run_accounts_pipeline, run_mailbox_pipeline
+from mail2text import IMAPServer
+from rules import RuleGuard, SubjectIndex, build_rule_guard, build_subject_index
+from runlock import RunLock, acquire_or_exit
+from statestore import StateStore
+
+OUTPUT_PATH = Path("state/checkmk-output.txt")
+
+
+def has_pending_data(imap_server: IMAPServer) -> bool:
+    """This returns True if decrypted data is waiting in the TLS layer, which select() doesn't see"""
+
+    pending = getattr(imap_server.sock, "pending", None)
+    return pending is not None and pending() > 0
+
+
+def wait_for_new_mail(imap_server: IMAPServer, timeout: float) -> bool:
+    """This waits with IMAP IDLE until the server reports a new mail or the timeout is over
+    and returns True if a new mail arrived. imaplib has no IDLE command before Python 3.14,
+    so the command is sent and its responses are read directly.
+    A line that imaplib already buffered together with the continuation is only seen after
+    the timeout, which only delays the mail because every wake up runs the whole pipeline."""
+
+    # The tag has to be unique for this connection, so imaplib's tag counter is used
+    tag: bytes = imap_server._new_tag()
+    imap_server.send(tag + b" IDLE\r\n")
+    if not imap_server.readline().startswith(b"+"):
+        raise IMAP4.error("the server refused IDLE")
+
+    new_mail: bool = False
+    deadline: float = monotonic() + timeout
+
+    while not new_mail:
+        remaining: float = deadline - monotonic()
+        if remaining <= 0:
+            break
+        if not has_pending_data(imap_server):
+            readable, writable, failed = select([imap_server.sock], [], [], remaining)
+            if not readable:
+                break
+
+        line: bytes = imap_server.readline()
+        if not line:
+            raise IMAP4.abort("the server closed the connection while idling")
+        new_mail = match(rb"\* \d+ (EXISTS|RECENT)", line) is not None
+
+    imap_server.send(b"DONE\r\n")
+    while True:
+        line = imap_server.readline()
+        if not line:
+            raise IMAP4.abort("the server closed the connection while idling")
+        if line.startswith(tag):
+            return new_mail
+
+
+def close_connection(imap_server: IMAPServer | None) -> None:
+    """This closes a connection that may already be broken without raising"""
+
+    if imap_server is None:
+        return
+
+    try:
+        imap_server.shutdown()
+    except OSError:
+        pass
+
+
+def stop_daemon(signal_number: int, frame) -> None:
+    """This turns SIGTERM from systemd into a normal exit, so the state store and the rule guard are closed"""
+
+    raise SystemExit(0)
+
+
+def watch_mailbox(mailbox_config: SectionProxy, sync_state: dict[str, dict[str, int]] | None, store: StateStore,
+                  subject_index: SubjectIndex, rule_guard: RuleGuard, daemon_config: SectionProxy, output_path: Path) -> None:
+    """This keeps one connection to the mailbox open and runs the pipeline whenever IDLE reports a new mail.
+    Lost connections are reopened with an exponential backoff."""
+
+    # RFC 2177 asks clients to restart IDLE at least every 29 minutes
+    idle_timeout: float = min(daemon_config.getfloat("idle_timeout", 300.0), 29 * 60)
+    socket_timeout: float = daemon_config.getfloat("socket_timeout", 120.0)
+    reconnect_backoff_max: float = daemon_config.getfloat("reconnect_backoff_max", 300.0)
+    reconnect_backoff: float = 1.0
+    imap_server: IMAPServer | None = None
+
+    try:
+        while True:
+            try:
+                imap_server = mail2text.connect_to_imap_server(mailbox_config, socket_timeout)
+                imap_server = mail2text.login_to_imap(imap_server, mailbox_config)
+                supports_idle: bool = "IDLE" in mail2text.get_capabilities(imap_server)
+
+                while True:
+                    run_mailbox_pipeline(imap_server, mailbox_config, sync_state, store, subject_index, rule_guard)
+                    service2checkmk.write_and_clean_up(store, output_path)
+                    # Only a complete run resets the backoff, a server that fails every run right after the login isn't hammered
+                    reconnect_backoff = 1.0
+
+                    if supports_idle:
+                        wait_for_new_mail(imap_server, idle_timeout)
+                    else:
+                        sleep(idle_timeout)
+                    # Makes sure the connection is still alive before the next run
+                    imap_server.noop()
+
+            except (IMAP4.error, OSError) as error:
+                print(f"IMAP connection lost: {error}, reconnecting in {reconnect_backoff:.0f}s", file=sys.stderr)
+                close_connection(imap_server)
+                imap_server = None
+                sleep(reconnect_backoff)
+                reconnect_backoff = min(reconnect_backoff * 2, reconnect_backoff_max)
+    finally:
+        close_connection(imap_server)
+
+
+def poll_accounts(account_configs: list[SectionProxy], mail_config: SectionProxy, sync_state: dict[str, dict[str, int]] | None, store: StateStore,
+                  subject_index: SubjectIndex, rule_guard: RuleGuard, daemon_config: SectionProxy, output_path: Path) -> None:
+    """This runs the pipeline for all accounts every idle_timeout seconds, because one IDLE
+    connection can only watch one mailbox. Failed accounts are retried on the next run."""
+
+    while True:
+        run_accounts_pipeline(account_configs, mail_config, sync_state, store, subject_index, rule_guard)
+        service2checkmk.write_and_clean_up(store, output_path)
+        sleep(daemon_config.getfloat("idle_timeout", 300.0))
+
+
+def run_daemon() -> None:
+    prepare.main()
+    signal(SIGTERM, stop_daemon)
+    # The daemon keeps the decode pool for all of its runs, so its start-up pays off
+    mail2text.enable_decode_pool()
+
+    # The daemon holds the run lock as long as it runs, a second daemon or a main.py run can't interfere
+    run_lock = RunLock()
+    acquire_or_exit(run_lock)
+
+    mail_config: SectionProxy = mail2text.read_config()
+    account_configs: list[SectionProxy] = mail2text.read_account_configs()
+    daemon_config: SectionProxy = read_config_section("Daemon")
+    output_path = Path(daemon_config.get("output_file", OUTPUT_PATH.as_posix()))
+    sync_state: dict[str, dict[str, int]] | None = mail2text.read_sync_state() if mail_config.getboolean("incremental_sync", True) else None
+
+    # Service configs are only read once, restart the daemon after changing them
+    store = StateStore()
+    subject_index: SubjectIndex = build_subject_index()
+    rule_guard: RuleGuard = build_rule_guard()
+
+    try:
+        if len(account_configs) == 1:
+            watch_mailbox(account_configs[0], sync_state, store, subject_index, rule_guard, daemon_config, output_path)
+        else:
+            poll_accounts(account_configs, mail_config, sync_state, store, subject_index, rule_guard, daemon_config, output_path)
+    finally:
+        rule_guard.close()
+        store.close()
+        run_lock.release()
+
+
+if __name__ == "__main__":
+    run_daemon()
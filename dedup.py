@@ -0,0 +1,149 @@
+# This module remembers the Message-IDs and the content of the mails that were already processed,
+# so the copies a flapping device or a retrying mail relay sends again are dropped. Message-IDs are
+# checked as soon as the headers are fetched, before the body is downloaded, the content once the body is there.
+# The content is remembered per service and only as long as it's the content of the newest mail that set the service,
+# so a mail that sets a service back to an earlier state is never dropped as a copy of that earlier mail.
+# The cache is bounded, kept in the state store between runs and its entries expire after a TTL.
+
+import hashlib
+from configparser import SectionProxy
+from re import compile as compile_regex
+from threading import Lock
+from time import time
+from typing import Iterable
+
+from models import Email
+
+MESSAGE_ID_PREFIX = "message-id:"
+CONTENT_PREFIX = "content:"
+
+WHITESPACE = compile_regex(r"\s+")
+
+
+def get_message_id_key(email: Email) -> str | None:
+    """This returns the cache key of the Message-ID of the email, None if it has none"""
+
+    message_id: str = email.message_id.strip().strip("<>").strip()
+    if not message_id:
+        return None
+
+    return f"{MESSAGE_ID_PREFIX}{message_id}"
+
+
+def get_content_hash(email: Email) -> str:
+    """This returns the hash of the sender, subject and body of the email, runs of whitespace
+    and line endings are normalized so a relay that reformats the mail doesn't change the hash"""
+
+    content_hash = hashlib.sha256()
+    for field in (email.from_field, email.subject, email.body):
+        content_hash.update(WHITESPACE.sub(" ", field).strip().encode("utf-8", "surrogatepass"))
+        content_hash.update(b"\0")
+
+    return content_hash.hexdigest()
+
+
+def get_content_key(service_name: str, content_hash: str) -> str:
+    """This returns the cache key of the content as the content of the newest mail that set the service"""
+
+    return f"{CONTENT_PREFIX}{service_name}:{content_hash}"
+
+
+def get_content_service(key: str) -> str | None:
+    """This returns the service name of a content key, None for other keys and the content keys of older versions without one"""
+
+    if not key.startswith(CONTENT_PREFIX):
+        return None
+
+    service_name, separator, content_hash = key[len(CONTENT_PREFIX):].rpartition(":")
+
+    return service_name if separator else None
+
+
+class DedupCache:
+    """The keys of the processed mails with the time they were first and last seen. The entries are kept
+    in least recently seen order, if there are more than max_entries the least recently seen are evicted.
+    An entry expires its TTL after it was first seen, so a device that keeps sending the same mail
+    doesn't keep its entry alive forever. Every service has at most one content key, adding another one
+    replaces it. The fetch threads check it while the main thread adds to it."""
+
+    def __init__(self, entries: dict[str, tuple[float, float]], max_entries: int, message_id_ttl: float, content_ttl: float) -> None:
+        self.max_entries: int = max_entries
+        self.message_id_ttl: float = message_id_ttl
+        self.content_ttl: float = content_ttl
+        self.entries: dict[str, tuple[float, float]] = dict(sorted(entries.items(), key=lambda entry: entry[1][1]))
+        # The content key of every service, the one seen last wins
+        self.content_keys: dict[str, str] = {}
+        for key in self.entries:
+            service_name: str | None = get_content_service(key)
+            if service_name is not None:
+                self.content_keys[service_name] = key
+        self.lock = Lock()
+
+    def get_ttl(self, key: str) -> float:
+        return self.message_id_ttl if key.startswith(MESSAGE_ID_PREFIX) else self.content_ttl
+
+    def contains(self, key: str | None, now: float | None = None) -> bool:
+        """This checks if the key was seen and didn't expire yet, a hit makes it the most recently seen entry"""
+
+        if key is None or self.get_ttl(key) <= 0:
+            return False
+
+        now = time() if now is None else now
+        with self.lock:
+            entry: tuple[float, float] | None = self.entries.pop(key, None)
+            if entry is None or now - entry[0] >= self.get_ttl(key):
+                self.forget_content_key(key)
+                return False
+            self.entries[key] = (entry[0], now)
+
+        return True
+
+    def forget_content_key(self, key: str) -> None:
+        """This drops the key from the content keys of the services if it's the one of its service"""
+
+        service_name: str | None = get_content_service(key)
+        if service_name is not None and self.content_keys.get(service_name) == key:
+            del self.content_keys[service_name]
+
+    def add(self, keys: Iterable[str | None], now: float | None = None) -> None:
+        """This remembers the keys of processed mails, keys that are already known keep their first seen time.
+        A content key replaces the content key its service had before."""
+
+        now = time() if now is None else now
+        with self.lock:
+            for key in keys:
+                if key is None or self.get_ttl(key) <= 0:
+                    continue
+                service_name: str | None = get_content_service(key)
+                if service_name is not None:
+                    replaced_key: str | None = self.content_keys.get(service_name)
+                    if replaced_key is not None and replaced_key != key:
+                        self.entries.pop(replaced_key, None)
+                    self.content_keys[service_name] = key
+                first_seen, last_seen = self.entries.pop(key, (now, now))
+                self.entries[key] = (first_seen, now)
+
+            while len(self.entries) > self.max_entries:
+                evicted_key: str = next(iter(self.entries))
+                del self.entries[evicted_key]
+                self.forget_content_key(evicted_key)
+
+    def get_entries(self, now: float | None = None) -> dict[str, tuple[float, float]]:
+        """This returns the entries that didn't expire yet, e.g. to save them in the state store"""
+
+        now = time() if now is None else now
+        with self.lock:
+            return {key: entry for key, entry in self.entries.items() if now - entry[0] < self.get_ttl(key)}
+
+
+def build_dedup_cache(entries: dict[str, tuple[float, float]], mail_config: SectionProxy) -> DedupCache | None:
+    """This creates the dedup cache with the entries saved in the state store and the size and TTLs
+    from the 'Mail' section, None is returned if dedup_cache_size is 0"""
+
+    max_entries: int = mail_config.getint("dedup_cache_size", 10000)
+    if max_entries <= 0:
+        return None
+
+    return DedupCache(entries, max_entries,
+                      mail_config.getfloat("dedup_message_id_hours", 168.0) * 3600,
+                      mail_config.getfloat("dedup_content_minutes", 15.0) * 60)
@@ -0,0 +1,191 @@
+# This module extracts the text of text/html mail parts. The default extractor is a streaming
+# tokenizer on html.parser.HTMLParser that returns exactly what
+# BeautifulSoup(payload, "html.parser").get_text(separator="\n", strip=True) returns,
+# but only keeps a stack of tag names instead of building the whole tree.
+# Beautiful Soup is only imported when the first HTML part is extracted, most runs never need it
+
+from collections import Counter
+from functools import cache
+from html.parser import HTMLParser
+from typing import Callable
+
+from configfile import read_config_section
+
+
+@cache
+def get_tag_tables() -> tuple[set[str], set[str], dict[str, str]]:
+    """This returns the tags that are closed right after they are opened, the tags whose text
+    (script, style, template, rt, rp) isn't part of get_text() and the HTML entities, all taken from bs4"""
+
+    from bs4.builder import HTMLTreeBuilder
+    from bs4.dammit import EntitySubstitution
+
+    return (set(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS), set(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS),
+            EntitySubstitution.HTML_ENTITY_TO_CHARACTER)
+
+
+class HTMLTextExtractor(HTMLParser):
+    """This collects the strings like Beautiful Soup's html.parser tree builder splits them into
+    the tree and keeps the ones get_text() returns. Every handler does what the matching handler
+    of bs4's BeautifulSoupHTMLParser does to the tree, so the strings are split and skipped the same way."""
+
+    def __init__(self, original_encoding: str | None) -> None:
+        super().__init__(convert_charrefs=False)
+        self.original_encoding: str | None = original_encoding
+        self.texts: list[str] = []
+        self.current_data: list[str] = []
+        self.open_tags: list[str] = []
+        self.open_tag_counter: Counter[str] = Counter()
+        # The positions of the open string container tags in open_tags
+        self.string_container_positions: list[int] = []
+        self.already_closed_empty_element: list[str] = []
+        self.empty_element_tags, self.string_container_tags, self.html_entities = get_tag_tables()
+
+    def end_data(self, kind: str = "text") -> None:
+        """This ends the current string, only text outside of string containers and CDATA is kept"""
+
+        if not self.current_data:
+            return
+
+        data: str = "".join(self.current_data)
+        self.current_data = []
+        if kind == "cdata" or (kind == "text" and not self.string_container_positions):
+            stripped: str = data.strip()
+            if stripped:
+                self.texts.append(stripped)
+
+    def push_tag(self, tag: str) -> None:
+        if tag in self.string_container_tags:
+            self.string_container_positions.append(len(self.open_tags))
+        self.open_tags.append(tag)
+        self.open_tag_counter[tag] += 1
+
+    def pop_tag(self) -> str:
+        tag: str = self.open_tags.pop()
+        self.open_tag_counter[tag] -= 1
+        if self.string_container_positions and self.string_container_positions[-1] == len(self.open_tags):
+            self.string_container_positions.pop()
+        return tag
+
+    def pop_to_tag(self, tag: str) -> None:
+        """This closes the most recent open tag with this name and every tag opened after it"""
+
+        if not self.open_tag_counter[tag]:
+            return
+        while self.pop_tag() != tag:
+            pass
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        self.handle_starttag(tag, attrs, handle_empty_element=False)
+        self.handle_endtag(tag)
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]], handle_empty_element: bool = True) -> None:
+        self.end_data()
+        self.push_tag(tag)
+        if tag in self.empty_element_tags and handle_empty_element:
+            self.handle_endtag(tag, check_already_closed=False)
+            self.already_closed_empty_element.append(tag)
+
+    def handle_endtag(self, tag: str, check_already_closed: bool = True) -> None:
+        if check_already_closed and tag in self.already_closed_empty_element:
+            # A redundant end tag of an empty element doesn't end the current string
+            self.already_closed_empty_element.remove(tag)
+        else:
+            self.end_data()
+            self.pop_to_tag(tag)
+
+    def handle_data(self, data: str) -> None:
+        self.current_data.append(data)
+
+    def handle_charref(self, name: str) -> None:
+        if name.startswith(("x", "X")):
+            code_point: int = int(name.lstrip("xX"), 16)
+        else:
+            code_point = int(name)
+
+        data: str | None = None
+        if code_point < 256:
+            # Numeric references below 256 are often meant as Windows-1252
+            for encoding in (self.original_encoding, "windows-1252"):
+                if not encoding:
+                    continue
+                try:
+                    data = bytearray([code_point]).decode(encoding)
+                except UnicodeDecodeError:
+                    pass
+        if not data:
+            try:
+                data = chr(code_point)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_entityref(self, name: str) -> None:
+        character: str | None = self.html_entities.get(name)
+        self.handle_data(character if character is not None else f"&{name}")
+
+    def handle_comment(self, data: str) -> None:
+        self.end_data()
+        self.current_data.append(data)
+        self.end_data("comment")
+
+    def handle_decl(self, decl: str) -> None:
+        self.end_data()
+        self.current_data.append(decl)
+        self.end_data("doctype")
+
+    def unknown_decl(self, data: str) -> None:
+        self.end_data()
+        if data.upper().startswith("CDATA["):
+            self.current_data.append(data[len("CDATA["):])
+            self.end_data("cdata")
+        else:
+            self.current_data.append(data)
+            self.end_data("declaration")
+
+    def handle_pi(self, data: str) -> None:
+        self.end_data()
+        self.current_data.append(data)
+        self.end_data("pi")
+
+
+def extract_text(payload: bytes) -> str:
+    """This decodes the HTML like Beautiful Soup does, including its encoding detection,
+    and returns its text with one string per line"""
+
+    from bs4.dammit import UnicodeDammit
+
+    dammit = UnicodeDammit(payload, known_definite_encodings=[], user_encodings=[], is_html=True, exclude_encodings=None)
+    if dammit.unicode_markup is None:
+        raise ValueError("the HTML couldn't be decoded")
+
+    extractor = HTMLTextExtractor(dammit.original_encoding)
+    extractor.feed(dammit.unicode_markup)
+    extractor.close()
+    extractor.end_data()
+
+    return "\n".join(extractor.texts)
+
+
+def extract_text_with_bs4(payload: bytes) -> str:
+    """This is the reference extractor that builds the whole Beautiful Soup tree"""
+
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(payload, "html.parser").get_text(separator="\n", strip=True)
+
+
+HTML_EXTRACTORS: dict[str, Callable[[bytes], str]] = {
+    "htmlparser": extract_text,
+    "bs4": extract_text_with_bs4,
+}
+
+
+@cache
+def get_html_extractor() -> Callable[[bytes], str]:
+    """This returns the extractor configured with html_extractor in the 'Mail' section,
+    by default the html.parser tokenizer"""
+
+    extractor_name: str = read_config_section("Mail").get("html_extractor", "htmlparser")
+
+    return HTML_EXTRACTORS.get(extractor_name, extract_text)
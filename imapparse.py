@@ -0,0 +1,219 @@
+# This module parses the responses of IMAP4 FETCH commands as imaplib returns them,
+# including BODYSTRUCTURE responses, so mail2text can fetch single MIME parts
+
+from binascii import a2b_base64, a2b_qp, Error as BinasciiError
+from dataclasses import dataclass
+from re import search, sub
+
+# A parsed response value is an atom or string (bytes), NIL (None) or a parenthesized list
+ResponseValue = bytes | None | list
+
+
+def tokenize_text(text: bytes, tokens: list[tuple[str, bytes | None]]) -> None:
+    """This splits a piece of a response line into tokens and appends them to the token list.
+    Atoms keep bracketed sections like BODY[HEADER.FIELDS (SUBJECT FROM)] in one token."""
+
+    position: int = 0
+    length: int = len(text)
+
+    while position < length:
+        character: bytes = text[position:position + 1]
+
+        if character in b" \r\n":
+            position += 1
+        elif character in b"()":
+            tokens.append((character.decode(), None))
+            position += 1
+        elif character == b'"':
+            position += 1
+            quoted = bytearray()
+            while position < length and text[position:position + 1] != b'"':
+                if text[position:position + 1] == b"\\":
+                    position += 1
+                quoted += text[position:position + 1]
+                position += 1
+            tokens.append(("string", bytes(quoted)))
+            position += 1
+        else:
+            atom_start: int = position
+            bracket_depth: int = 0
+            while position < length:
+                character = text[position:position + 1]
+                if character == b"[":
+                    bracket_depth += 1
+                elif character == b"]":
+                    bracket_depth -= 1
+                elif bracket_depth == 0 and character in b" ()":
+                    break
+                position += 1
+            tokens.append(("atom", text[atom_start:position]))
+
+
+def tokenize_fetch_response(data: list) -> list[tuple[str, bytes | None]]:
+    """This tokenizes the FETCH data imaplib returns. Literals are returned as
+    (b'<header> {<size>}', literal) tuples and the rest of the line as plain bytes."""
+
+    tokens: list[tuple[str, bytes | None]] = []
+
+    for response_part in data:
+        if isinstance(response_part, tuple):
+            header: bytes = response_part[0]
+            literal_marker = search(rb"\{\d+\}$", header)
+            tokenize_text(header[:literal_marker.start()] if literal_marker else header, tokens)
+            tokens.append(("literal", response_part[1]))
+        elif isinstance(response_part, bytes):
+            tokenize_text(response_part, tokens)
+
+    return tokens
+
+
+def parse_tokens(tokens: list[tuple[str, bytes | None]]) -> list[ResponseValue]:
+    """This turns the tokens into nested lists, NIL becomes None"""
+
+    stack: list[list[ResponseValue]] = [[]]
+
+    for kind, value in tokens:
+        match kind:
+            case "(":
+                stack.append([])
+            case ")":
+                if len(stack) > 1:
+                    closed_list = stack.pop()
+                    stack[-1].append(closed_list)
+            case "atom" if value.upper() == b"NIL":
+                stack[-1].append(None)
+            case _:
+                stack[-1].append(value)
+
+    # Unclosed lists of a truncated response are kept
+    while len(stack) > 1:
+        closed_list = stack.pop()
+        stack[-1].append(closed_list)
+
+    return stack[0]
+
+
+def parse_fetch_items(data: list) -> dict[str, dict[str, ResponseValue]]:
+    """This parses a (multi message) UID FETCH response and returns the fetched items
+    like {'17': {'UID': b'17', 'BODY[1]<0>': b'...'}} keyed by the UID of every message"""
+
+    parsed_response: list[ResponseValue] = parse_tokens(tokenize_fetch_response(data))
+    messages: dict[str, dict[str, ResponseValue]] = {}
+
+    # Every message is its sequence number followed by the list of items
+    for value in parsed_response:
+        if not isinstance(value, list):
+            continue
+
+        items: dict[str, ResponseValue] = {}
+        for item_index in range(0, len(value) - 1, 2):
+            item_name = value[item_index]
+            if isinstance(item_name, bytes):
+                items[item_name.decode(errors="replace").upper()] = value[item_index + 1]
+
+        uid = items.get("UID")
+        if isinstance(uid, bytes):
+            messages[uid.decode()] = items
+
+    return messages
+
+
+def get_fetch_item(items: dict[str, ResponseValue], item_prefix: str) -> ResponseValue:
+    """This returns the first item whose name starts with the prefix e.g. 'BODY[1]'
+    because servers echo partial fetches as BODY[1]<0>"""
+
+    for item_name, value in items.items():
+        if item_name.startswith(item_prefix):
+            return value
+
+    return None
+
+
+@dataclass
+class TextPart:
+    """A text part of a message as described by its BODYSTRUCTURE"""
+
+    section: str
+    content_type: str
+    charset: str | None
+    encoding: str
+    size: int
+
+
+def decode_structure_value(value: ResponseValue) -> str:
+    """This decodes an atom or string of a BODYSTRUCTURE to a lowercase str"""
+
+    return value.decode(errors="replace").lower() if isinstance(value, bytes) else ""
+
+
+def get_text_parts(structure: ResponseValue, section: str = "", message_root: bool = True) -> list[TextPart]:
+    """This walks the BODYSTRUCTURE like Message.walk() would and returns every
+    text/plain and text/html part that isn't an attachment with its section number"""
+
+    if not isinstance(structure, list) or not structure:
+        return []
+
+    # Multipart bodies start with the list of their parts, followed by the subtype
+    if isinstance(structure[0], list):
+        text_parts: list[TextPart] = []
+        for part_number, part in enumerate(structure, start=1):
+            if not isinstance(part, list):
+                break
+            text_parts += get_text_parts(part, f"{section}.{part_number}" if section else str(part_number), False)
+        return text_parts
+
+    # The body of a non-multipart message is always section 1
+    if message_root:
+        section = f"{section}.1" if section else "1"
+
+    main_type: str = decode_structure_value(structure[0])
+    sub_type: str = decode_structure_value(structure[1]) if len(structure) > 1 else ""
+
+    # Attached messages are walked as well, the body structure comes after the envelope
+    if main_type == "message" and sub_type == "rfc822" and len(structure) > 8:
+        return get_text_parts(structure[8], section, True)
+
+    if main_type != "text" or sub_type not in ("plain", "html") or len(structure) < 7:
+        return []
+
+    # Text parts have the number of lines before the extension data, the disposition is the second extension
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and decode_structure_value(disposition[0]) == "attachment":
+        return []
+
+    charset: str | None = None
+    parameters = structure[2]
+    if isinstance(parameters, list):
+        for parameter_index in range(0, len(parameters) - 1, 2):
+            if decode_structure_value(parameters[parameter_index]) == "charset":
+                charset = decode_structure_value(parameters[parameter_index + 1]) or None
+
+    size = structure[6]
+    return [TextPart(
+        section=section,
+        content_type=f"{main_type}/{sub_type}",
+        charset=charset,
+        encoding=decode_structure_value(structure[5]) or "7bit",
+        size=int(size) if isinstance(size, bytes) and size.isdigit() else 0,
+    )]
+
+
+def decode_transfer_encoding(payload: bytes, encoding: str, truncated: bool) -> bytes:
+    """This undoes the Content-Transfer-Encoding of a fetched part. If the part was truncated
+    by a partial fetch the incomplete base64 quantum or quoted-printable escape at the end is dropped."""
+
+    try:
+        match encoding:
+            case "base64":
+                encoded: bytes = sub(rb"[^A-Za-z0-9+/=]", b"", payload)
+                if truncated:
+                    encoded = encoded[:len(encoded) // 4 * 4]
+                return a2b_base64(encoded)
+            case "quoted-printable":
+                if truncated:
+                    payload = sub(rb"=[0-9A-Fa-f]?$", b"", payload)
+                return a2b_qp(payload)
+            case _:
+                return payload
+    except BinasciiError:
+        return payload
@@ -0,0 +1,113 @@
+# This module measures how long the stages of a run take and how many bytes were fetched,
+# so the Mail2CheckMK-000Performance service can report them as perfdata.
+# The stages of every thread add to the metrics of the current run, which start_run() resets.
+
+import resource
+import sys
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+from typing import Iterator
+
+# The stages in the order they are reported
+STAGES: list[str] = ["connect_login", "fetch", "decode", "routing", "regex", "store"]
+
+
+@dataclass
+class RunMetrics:
+    """The durations of the stages in seconds, summed over all accounts, and the bytes fetched in a run"""
+
+    started: float = field(default_factory=perf_counter)
+    stage_seconds: Counter[str] = field(default_factory=Counter)
+    # The evaluation time of every service config, keyed by its file name
+    rule_seconds: Counter[str] = field(default_factory=Counter)
+    fetch_bytes: int = 0
+
+    def get_run_seconds(self) -> float:
+        return perf_counter() - self.started
+
+
+run_metrics = RunMetrics()
+METRICS_LOCK = Lock()
+
+
+def start_run() -> None:
+    """This starts the metrics of a new run, the daemon calls it before every run"""
+
+    global run_metrics
+
+    with METRICS_LOCK:
+        run_metrics = RunMetrics()
+
+
+def add_stage_time(stage: str, seconds: float) -> None:
+    with METRICS_LOCK:
+        run_metrics.stage_seconds[stage] += seconds
+
+
+def add_rule_time(source: str, seconds: float) -> None:
+    """This adds the evaluation time of a service config to its own time and to the regex stage"""
+
+    with METRICS_LOCK:
+        run_metrics.rule_seconds[source] += seconds
+        run_metrics.stage_seconds["regex"] += seconds
+
+
+def add_fetch_bytes(byte_count: int) -> None:
+    with METRICS_LOCK:
+        run_metrics.fetch_bytes += byte_count
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """This adds the time the block takes to the stage, also if it raises"""
+
+    start: float = perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(stage, perf_counter() - start)
+
+
+def get_response_size(data: list) -> int:
+    """This returns the size of the response data imaplib returned for a command, literals included"""
+
+    size: int = 0
+    for response_part in data:
+        if isinstance(response_part, tuple):
+            size += sum(len(part) for part in response_part if isinstance(part, bytes))
+        elif isinstance(response_part, bytes):
+            size += len(response_part)
+
+    return size
+
+
+def get_peak_rss_bytes() -> int:
+    """This returns the peak resident set size of the process, which the daemon can only report since it started"""
+
+    peak_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kibibytes, macOS bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def get_import_times(module_name: str) -> list[tuple[str, int, int]]:
+    """This imports the module in a fresh interpreter with -X importtime and returns the name,
+    own import time and cumulative import time in microseconds of every module that it imports"""
+
+    import subprocess
+
+    import_process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+                                    cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+
+    import_times: list[tuple[str, int, int]] = []
+    for line in import_process.stderr.splitlines():
+        # The lines look like 'import time:       257 |       1211 |     signal' after the header line
+        fields: list[str] = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        import_times.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+
+    return import_times
@@ -1,6 +1,33 @@
 #!/usr/bin/env bash
 set -e
 
+# The output file of the daemon (daemon.py), if it exists it's printed instead of running main.py
+OUTPUT_FILE="/opt/Mail2CheckMk/state/checkmk-output.txt"
+CONFIG_FILE="/opt/Mail2CheckMk/config/config.cfg"
+
+# The daemon rewrites its output at least every idle_timeout seconds of the 'Daemon' section,
+# the output counts as stale once two of these intervals and another minute passed without an update
+idle_timeout=$(awk -F '[=:]' '
+    /^[ \t]*\[/ { in_daemon = ($0 ~ /^[ \t]*\[Daemon\]/) }
+    in_daemon && $1 ~ /^[ \t]*idle_timeout[ \t]*$/ { gsub(/[ \t\r]/, "", $2); print $2; exit }
+' "$CONFIG_FILE" 2>/dev/null || true)
+idle_timeout=${idle_timeout%%.*}
+if ! [[ "$idle_timeout" =~ ^[0-9]+$ ]]; then
+    idle_timeout=300
+fi
+MAX_OUTPUT_AGE=$(( 2 * idle_timeout + 60 ))
+
+if [ -f "$OUTPUT_FILE" ]; then
+    cat "$OUTPUT_FILE"
+    output_age=$(( $(date +%s) - $(stat -c %Y "$OUTPUT_FILE") ))
+    if [ "$output_age" -gt "$MAX_OUTPUT_AGE" ]; then
+        echo "2 Mail2CheckMK-000Daemon output_age=$output_age The daemon hasn't updated its output for $output_age seconds"
+    else
+        echo "0 Mail2CheckMK-000Daemon output_age=$output_age The daemon output is up to date"
+    fi
+    exit 0
+fi
+
 # check if the virtualenv exists
 if [ ! -d "/opt/Mail2CheckMk/.venv/bin/" ]; then
     echo "Virtual environment not found, aborting."
@@ -1,48 +1,104 @@
-# This module downloads all Emails from the configured IMAP4 server,
-# saves them as plaintext-files in ./plaintext-emails,
-# and then either moves or deletes them on the IMAP server
+# This module downloads all Emails from the configured IMAP4 servers,
+# saves them in the state store in ./state,
+# and then either moves or deletes them on the IMAP servers.
+# Every account is fetched in its own thread with its own connection
 
 from configparser import ConfigParser, SectionProxy
 from imaplib import IMAP4, IMAP4_SSL
 from email import message_from_bytes
 from email.message import Message
 from email.header import decode_header
-from dataclasses import dataclass
-from re import sub
-from time import time
-from bs4 import BeautifulSoup
-from typing import Union
+from re import search
+from pathlib import Path
+import json
+import os
+import sys
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import cache
+from queue import Queue
+from threading import Event, RLock
+from typing import Any, Callable, Iterator, Union
+
+from configfile import read_config_file
+from dedup import DedupCache, build_dedup_cache, get_message_id_key
+from models import BODY_NOT_DOWNLOADED, Email, EmailBatch
+from statestore import StateStore
+from rules import SubjectIndex, build_subject_index
+from imapparse import ResponseValue, TextPart, parse_fetch_items, get_fetch_item, get_text_parts, decode_transfer_encoding
+from htmltext import get_html_extractor
+from instrumentation import add_fetch_bytes, get_response_size, start_run, timed
+from workerpool import create_process_pool, get_pool_settings
+from runlock import hold_run_lock
 
 # SSL and Non-SSL use different classes
 # So to preserver type annotation a Union is used
 IMAPServer = Union[IMAP4, IMAP4_SSL]
 
+# UIDVALIDITY and the highest processed UID per account and mailbox
+SYNC_STATE_PATH = Path("state/imap-sync.json")
+# The sync state is shared by the threads of all accounts
+SYNC_STATE_LOCK = RLock()
+
+# The headers that are fetched before deciding if the body is needed at all
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE MESSAGE-ID)]"
+
+# The process pool large batches are decoded in, it's started the first time it's needed
+decode_pool: Executor | None = None
+# Starting the decode pool costs more than it saves in a single run, only the daemon enables it because it keeps it for all of its runs
+decode_pool_enabled: bool = False
+
 
 def read_config() -> SectionProxy:
     """This reads the config file at config/config.cfg
     and returns the config object for the 'Email' section"""
 
-    cfgparser = ConfigParser()
-    cfgparser.read("config/config.cfg")
-    mail_config = cfgparser["Mail"]
+    return read_config_file()["Mail"]
+
+
+def is_account_section(section_name: str) -> bool:
+    """This returns True for the 'Mail' section and account sections like 'Mail Backup'"""
+
+    return section_name == "Mail" or section_name.startswith("Mail ")
+
+
+def read_account_configs() -> list[SectionProxy]:
+    """This returns one config per mailbox of every account. Accounts are the 'Mail' section and every
+    section starting with 'Mail ' e.g. [Mail Backup], which inherit every option they don't set from 'Mail'.
+    The 'Mail' section is only an account itself if it has a host or there are no other accounts.
+    inbox can be a comma separated list of mailboxes, the account name is saved in the 'account' option."""
+
+    cfgparser: ConfigParser = read_config_file()
+    mail_options: dict[str, str] = dict(cfgparser["Mail"]) if cfgparser.has_section("Mail") else {}
+    account_names: list[str] = [section_name for section_name in cfgparser.sections() if is_account_section(section_name) and section_name != "Mail"]
+    if mail_options.get("host") or not account_names:
+        account_names.insert(0, "Mail")
+
+    # The values are already interpolated, so they must not be interpolated again
+    mailbox_parser = ConfigParser(interpolation=None)
+    for account_name in account_names:
+        account_options: dict[str, str] = {**mail_options, **dict(cfgparser[account_name])}
+        for mailbox in account_options.get("inbox", "INBOX").split(","):
+            mailbox_parser[f"{account_name}/{mailbox.strip()}"] = {**account_options, "account": account_name, "inbox": mailbox.strip()}
 
-    return mail_config
+    return [mailbox_parser[section_name] for section_name in mailbox_parser.sections()]
 
 
-def connect_to_imap_server(mail_config: SectionProxy) -> IMAPServer:
-    """This connects to the IMAP server using the configured connection type"""
+def connect_to_imap_server(mail_config: SectionProxy, timeout: float | None = None) -> IMAPServer:
+    """This connects to the IMAP server using the configured connection type.
+    With a timeout every blocking socket operation fails after that many seconds."""
 
     imap_host = mail_config.get("host", "localhost")
     imap_port = mail_config.getint("port", 143)
     use_ssl = mail_config.getboolean("use_ssl", False)
     use_starttls = mail_config.getboolean("use_starttls", False)
 
-    if use_ssl:
-        imap_server = IMAP4_SSL(host=imap_host, port=imap_port)
-    else:
-        imap_server = IMAP4(host=imap_host, port=imap_port)
-        if use_starttls:
-            imap_server.starttls()
+    with timed("connect_login"):
+        if use_ssl:
+            imap_server = IMAP4_SSL(host=imap_host, port=imap_port, timeout=timeout)
+        else:
+            imap_server = IMAP4(host=imap_host, port=imap_port, timeout=timeout)
+            if use_starttls:
+                imap_server.starttls()
 
     return imap_server
 
@@ -53,56 +109,159 @@ def login_to_imap(imap_server: IMAPServer, mail_config: SectionProxy) -> IMAPSer
     
     imap_user = mail_config.get("user", "testuser")
     imap_password = mail_config.get("password", "testpass")
-    imap_server.login(user=imap_user, password=imap_password)
+    with timed("connect_login"):
+        imap_server.login(user=imap_user, password=imap_password)
 
     return imap_server
 
 
-def get_message_numbers_from_inbox(imap_server: IMAPServer, mail_config: SectionProxy) -> list[str]:
-    """This gets all emails/message id's/numbers from the passed IMAP server
-    from the configured Inbox mailbox and returns them in a list"""
+def get_capabilities(imap_server: IMAPServer) -> set[str]:
+    """This asks the logged in IMAP server for its capabilities, because servers may
+    advertise more (e.g. MOVE) after the login than imaplib saw when connecting"""
 
-    imap_server.select(mail_config.get("inbox", "INBOX"))
-    
-    status, message_numbers = imap_server.search(None, "ALL")
+    status, data = imap_server.capability()
+    if status != "OK" or not data or not data[0]:
+        return set(imap_server.capabilities)
 
-    message_number_list = message_numbers[0].split() if message_numbers else []
+    return set(data[0].decode().upper().split())
 
-    return message_number_list
 
-@dataclass
-class Email:
-    """A Email object must have the from-field, the subject and the email body defined"""
+def read_sync_state() -> dict[str, dict[str, int]]:
+    """This reads the persisted sync state of every account and mailbox"""
 
-    from_field: str
-    subject: str
-    body: str
+    if not SYNC_STATE_PATH.exists():
+        return {}
 
+    try:
+        return json.loads(SYNC_STATE_PATH.read_text())
+    except ValueError:
+        # A broken state file only costs one full resync
+        return {}
 
-def decode_any_content_type(message: Message) -> str | None:
-    """This decodes any message or part of any content type and returns the message body
-    if possible"""
 
-    content_type = message.get_content_type()
-    payload = message.get_payload(decode=True)
-    if not payload:
-        return None
+def save_sync_state(sync_state: dict[str, dict[str, int]]) -> None:
+    """This atomically replaces the sync state file so a crash can't leave it half written"""
+
+    with SYNC_STATE_LOCK:
+        temporary_path = SYNC_STATE_PATH.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(sync_state, indent=2, sort_keys=True))
+        os.replace(temporary_path, SYNC_STATE_PATH)
+
+
+def get_sync_key(mail_config: SectionProxy) -> str:
+    """This returns the key of the configured account and mailbox in the sync state"""
+
+    return (f'{mail_config.get("user", "testuser")}@{mail_config.get("host", "localhost")}:'
+            f'{mail_config.getint("port", 143)}/{mail_config.get("inbox", "INBOX")}')
+
+
+def get_uidvalidity(imap_server: IMAPServer, mailbox: str) -> int:
+    """This returns the UIDVALIDITY of the selected mailbox, which the server
+    sends as a response code when selecting it"""
+
+    typ, data = imap_server.response("UIDVALIDITY")
+    if not data or data[0] is None:
+        status, data = imap_server.status(mailbox, "(UIDVALIDITY)")
+        uidvalidity_match = search(rb"UIDVALIDITY (\d+)", data[0] or b"")
+        return int(uidvalidity_match.group(1)) if uidvalidity_match else 0
+
+    return int(data[0])
+
+
+def build_subject_search(subject_filters: list[str]) -> str:
+    """This builds a SEARCH criteria that matches any of the subject filters
+    e.g. 'OR OR SUBJECT "a" SUBJECT "b" SUBJECT "c"'"""
+
+    subject_criteria: list[str] = []
+    for subject_filter in subject_filters:
+        escaped_filter = subject_filter.replace("\\", "\\\\").replace('"', '\\"')
+        subject_criteria.append(f'SUBJECT "{escaped_filter}"')
+
+    return "OR " * (len(subject_criteria) - 1) + " ".join(subject_criteria)
+
+
+def get_message_numbers_from_inbox(imap_server: IMAPServer, mail_config: SectionProxy, sync_state: dict[str, dict[str, int]] | None = None, subject_filters: list[str] | None = None) -> list[str]:
+    """This gets the UIDs of all emails from the passed IMAP server
+    from the configured Inbox mailbox and returns them in a list.
+    UIDs are used instead of sequence numbers so a concurrent expunge
+    can't shift the numbers between fetching and deleting.
+    If a sync state is passed only UIDs above the last processed one are returned,
+    unless the UIDVALIDITY of the mailbox changed, which forces a full resync.
+    If subject filters are passed only mails whose subject contains any of them are returned."""
+
+    mailbox: str = mail_config.get("inbox", "INBOX")
+    imap_server.select(mailbox)
+
+    subject_search: str = f" {build_subject_search(subject_filters)}" if subject_filters else ""
+
+    if sync_state is None:
+        status, message_numbers = imap_server.uid("SEARCH", f"ALL{subject_search}")
+        return message_numbers[0].split() if message_numbers and message_numbers[0] else []
+
+    sync_key: str = get_sync_key(mail_config)
+    uidvalidity: int = get_uidvalidity(imap_server, mailbox)
+    mailbox_state: dict[str, int] | None = sync_state.get(sync_key)
+
+    if mailbox_state is None or mailbox_state["uidvalidity"] != uidvalidity:
+        mailbox_state = {"uidvalidity": uidvalidity, "last_uid": 0}
+        with SYNC_STATE_LOCK:
+            sync_state[sync_key] = mailbox_state
+
+    last_uid: int = mailbox_state["last_uid"]
+    status, message_numbers = imap_server.uid("SEARCH", f"UID {last_uid + 1}:*{subject_search}")
+
+    message_number_list = message_numbers[0].split() if message_numbers and message_numbers[0] else []
+
+    # "<n>:*" always contains the highest UID of the mailbox even if it's below n
+    return [uid for uid in message_number_list if int(uid) > last_uid]
+
+
+def update_sync_state(sync_state: dict[str, dict[str, int]], mail_config: SectionProxy, message_nums: list[str]) -> None:
+    """This records the highest processed UID of the configured mailbox and saves the sync state"""
+
+    if not message_nums:
+        return
+
+    with SYNC_STATE_LOCK:
+        mailbox_state: dict[str, int] = sync_state[get_sync_key(mail_config)]
+        mailbox_state["last_uid"] = max(mailbox_state["last_uid"], max(int(uid) for uid in message_nums))
+        save_sync_state(sync_state)
+
+def decode_payload(content_type: str, payload: bytes, charset: str, errors: str = "strict") -> str | None:
+    """This decodes the transfer decoded payload of a part with the passed content type
+    and returns the text if possible"""
 
-    charset = message.get_charset() or "utf-8"
-    
     # If the message body just uses plaintext we dan decode it, but
-    # if html is used we let Beatifulsoup handle decoding.
+    # if html is used we let the html extractor handle decoding.
     try:
         match content_type:
             case "text/plain":
-                return payload.decode(charset)
+                text: str = payload.decode(charset, errors)
             case "text/html":
-                return BeautifulSoup(payload, "html.parser").get_text(separator="\n", strip=True)
+                text = get_html_extractor()(payload)
             case _:
                 return None
     except Exception:
         return None
 
+    # Mails have CRLF line endings but the service configs match "\n", like the plaintext spool
+    # of older versions returned the bodies with the universal newlines of read_text()
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def decode_any_content_type(message: Message) -> str | None:
+    """This decodes any message or part of any content type and returns the message body
+    if possible"""
+
+    content_type = message.get_content_type()
+    payload = message.get_payload(decode=True)
+    if not payload:
+        return None
+
+    charset = message.get_content_charset() or "utf-8"
+
+    return decode_payload(content_type, payload, charset)
+
 
 def parse_message_body(message: Message) -> str:
     """This parses the message body and sends it to decode_any_content_type and returns the body"""
@@ -128,71 +287,354 @@ def parse_message_body(message: Message) -> str:
     return body.strip() if body.strip() else "(no readable content)"
 
 
-def get_messages_from_message_nums(message_number_list: list[str], imap_server: IMAPServer) -> list[Email]:
-    """This downloads every email in the message number list and returns a properly formatted
-    list of parsed Email objects."""
+@cache
+def get_decode_pool_settings() -> tuple[int, int]:
+    """This returns the number of decode_workers and the decode_pool_threshold from the 'Mail' section"""
 
-    emails: list[Email] = []
+    return get_pool_settings(read_config(), "decode_workers", "decode_pool_threshold", 256)
 
-    for message_num in message_number_list:
 
-        status, data = imap_server.fetch(message_num, "(RFC822)")
-    
-        raw_email: bytes = data[0][1]
-    
-        msg = message_from_bytes(raw_email)
-    
-        subject, encoding = decode_header(msg["Subject"])[0]
-        if isinstance(subject, bytes):
-            subject = subject.decode(encoding or "utf-8")
-    
-        from_field = msg.get("From")
-    
-        body = parse_message_body(msg) 
-    
-        email = Email(
-                from_field = str(from_field),
-                subject = subject,
-                body = body
-                )
-        emails.append(email)
+def enable_decode_pool() -> None:
+    """This lets map_decoding() decode large batches in the decode pool, see decode_pool_enabled"""
+
+    global decode_pool_enabled
+
+    decode_pool_enabled = True
+
+
+def map_decoding(function: Callable[..., Any], arguments: list[tuple]) -> list[Any]:
+    """This calls the decoding function with every argument tuple and returns the results in order.
+    Once the decode pool is enabled, batches of at least decode_pool_threshold items fan out to a pool
+    of decode_workers processes, smaller ones are decoded right here because sending them to the pool costs more than it saves."""
+
+    global decode_pool
+
+    decode_workers, decode_pool_threshold = get_decode_pool_settings()
+    if not decode_pool_enabled or decode_workers < 1 or len(arguments) < max(decode_pool_threshold, 2):
+        return [function(*argument) for argument in arguments]
+
+    if decode_pool is None:
+        decode_pool = create_process_pool(decode_workers)
+
+    return list(decode_pool.map(function, *zip(*arguments), chunksize=max(1, len(arguments) // (decode_workers * 4))))
+
+
+def uid_fetch(imap_server: IMAPServer, message_set: str, fetch_items: str) -> list:
+    """This sends one UID FETCH and returns its data, the time and the size of the response are measured"""
+
+    with timed("fetch"):
+        status, data = imap_server.uid("FETCH", message_set, fetch_items)
+    add_fetch_bytes(get_response_size(data))
+
+    return data
+
+
+def build_message_sets(message_number_list: list[str], batch_size: int) -> list[str]:
+    """This splits the message numbers or UIDs into batches of at most batch_size messages
+    and folds every batch into an IMAP message set like '1:500,502,510:512'"""
+
+    message_sets: list[str] = []
+
+    for batch_start in range(0, len(message_number_list), batch_size):
+        batch: list[int] = sorted(int(num) for num in message_number_list[batch_start:batch_start + batch_size])
+
+        ranges: list[str] = []
+        range_start: int = batch[0]
+        range_end: int = batch[0]
+        for num in batch[1:]:
+            if num == range_end + 1:
+                range_end = num
+                continue
+            ranges.append(f"{range_start}:{range_end}" if range_start != range_end else str(range_start))
+            range_start = range_end = num
+        ranges.append(f"{range_start}:{range_end}" if range_start != range_end else str(range_start))
+
+        message_sets.append(",".join(ranges))
+
+    return message_sets
+
+
+def decode_subject(msg: Message) -> str:
+    """This decodes the (possibly RFC2047 encoded) subject of the message"""
+
+    if msg["Subject"] is None:
+        return ""
+
+    # Subjects that mix plain text and encoded words are split into several parts
+    subject_parts: list[str] = []
+    for subject_part, encoding in decode_header(msg["Subject"]):
+        if isinstance(subject_part, bytes):
+            subject_part = subject_part.decode(encoding or "utf-8")
+        subject_parts.append(subject_part)
+
+    return "".join(subject_parts)
+
+
+def parse_email_headers(raw_headers: bytes) -> Email:
+    """This parses the fetched header fields of a message into an Email object without a body"""
+
+    msg = message_from_bytes(raw_headers)
+
+    return Email(
+            from_field = str(msg.get("From")),
+            subject = decode_subject(msg),
+            body = BODY_NOT_DOWNLOADED,
+            message_id = str(msg.get("Message-ID", ""))
+            )
+
+
+def parse_email(raw_email: bytes) -> Email:
+    """This parses a raw RFC822 message into an Email object"""
+
+    msg = message_from_bytes(raw_email)
+
+    subject = decode_subject(msg)
+
+    from_field = msg.get("From")
+
+    body = parse_message_body(msg)
+
+    return Email(
+            from_field = str(from_field),
+            subject = subject,
+            body = body,
+            message_id = str(msg.get("Message-ID", ""))
+            )
+
+
+def fetch_text_parts(imap_server: IMAPServer, header_emails: dict[str, Email], text_parts: dict[str, list[TextPart]], body_limits: dict[str, int], batch_size: int) -> dict[str, Email]:
+    """This downloads only the text parts of the messages in body_limits with BODY.PEEK[<section>]
+    and at most the byte limit of the message per part (0 means no limit).
+    Messages with the same parts and limit are fetched together in one UID FETCH."""
+
+    fetch_groups: dict[str, list[str]] = {}
+    emails: dict[str, Email] = {}
+
+    for uid, limit in body_limits.items():
+        if not text_parts[uid]:
+            emails[uid] = Email(header_emails[uid].from_field, header_emails[uid].subject, "(no readable content)", message_id=header_emails[uid].message_id)
+            continue
+
+        partial: str = f"<0.{limit}>" if limit > 0 else ""
+        fetch_items: str = " ".join(f"BODY.PEEK[{text_part.section}]{partial}" for text_part in text_parts[uid])
+        fetch_groups.setdefault(f"(UID {fetch_items})", []).append(uid)
+
+    # Every part is decoded after all of them were downloaded, so the HTML parts can be decoded in parallel
+    decode_arguments: list[tuple[str, bytes, str, str]] = []
+    decoded_parts: dict[str, list[int]] = {}
+    truncated_uids: set[str] = set()
+
+    for fetch_items, uids in fetch_groups.items():
+        for message_set in build_message_sets(uids, batch_size):
+            data = uid_fetch(imap_server, message_set, fetch_items)
+
+            for uid, items in parse_fetch_items(data).items():
+                if uid not in body_limits:
+                    continue
+
+                limit: int = body_limits[uid]
+                decoded_parts[uid] = []
+                for text_part in text_parts[uid]:
+                    payload: ResponseValue = get_fetch_item(items, f"BODY[{text_part.section}]")
+                    if not isinstance(payload, bytes) or not payload:
+                        continue
+
+                    part_truncated: bool = limit > 0 and text_part.size > limit
+                    if part_truncated:
+                        truncated_uids.add(uid)
+                    decoded_parts[uid].append(len(decode_arguments))
+                    decode_arguments.append((text_part.content_type,
+                                             decode_transfer_encoding(payload, text_part.encoding, part_truncated),
+                                             text_part.charset or "utf-8",
+                                             # A multibyte character may have been cut in half
+                                             "ignore" if part_truncated else "strict"))
+
+    with timed("decode"):
+        html_indexes: list[int] = [index for index, argument in enumerate(decode_arguments) if argument[0] == "text/html"]
+        texts: list[str | None] = [decode_payload(*argument) if argument[0] != "text/html" else None for argument in decode_arguments]
+        for index, text in zip(html_indexes, map_decoding(decode_payload, [decode_arguments[index] for index in html_indexes])):
+            texts[index] = text
+
+    for uid, part_indexes in decoded_parts.items():
+        body: str = "\n".join(texts[index] for index in part_indexes if texts[index]).strip() or "(no readable content)"
+        truncated: bool = uid in truncated_uids
+        if truncated:
+            body += f"\n(body truncated after {body_limits[uid]} bytes)"
+
+        emails[uid] = Email(header_emails[uid].from_field, header_emails[uid].subject, body, truncated, header_emails[uid].message_id)
 
     return emails
 
-def save_emails_as_plaintext(emails: list[Email]) -> int:
-    """This saves all emails passed in as a plaintext file
-    and returns the number of emails saved this way"""
 
-    emails_saved: int = 0
-    for email in emails:
-        unix_time_string = str(time()).replace(".", ",")
+def get_body_limit(subject: str, subject_index: SubjectIndex | None, max_body_bytes: int) -> int | None:
+    """This returns the body byte limit for a mail with the passed subject, which is the largest
+    max_body_bytes of the matching service configs or the account limit if they don't set one.
+    None is returned if no service config matches the subject."""
+
+    if subject_index is None:
+        return max_body_bytes
+
+    limits: list[int] = [max_body_bytes if service_rule.max_body_bytes is None else service_rule.max_body_bytes
+                         for service_rule, subject_match in subject_index.match(subject)]
+    if not limits:
+        return None
+
+    return 0 if 0 in limits else max(limits)
+
+
+def is_duplicate_message(email: Email, dedup_cache: DedupCache | None, batch_keys: set[str]) -> bool:
+    """This checks if a mail with the same Message-ID was already processed or is earlier in the batch"""
+
+    if dedup_cache is None:
+        return False
+
+    message_id_key: str | None = get_message_id_key(email)
+    if message_id_key is None:
+        return False
+    if message_id_key in batch_keys or dedup_cache.contains(message_id_key):
+        return True
+
+    batch_keys.add(message_id_key)
+    return False
+
+
+def fetch_email_batch(message_nums: list[str], imap_server: IMAPServer, batch_size: int = 500, subject_index: SubjectIndex | None = None, fetch_text_parts_only: bool = False, max_body_bytes: int = 0,
+                      dedup_cache: DedupCache | None = None) -> EmailBatch:
+    """This downloads the emails of one batch of UIDs and returns them as parsed Email objects sorted by UID.
+    If a subject index is passed only the headers are fetched first and the body is only
+    downloaded if any service config matches the subject, the other mails keep a placeholder body
+    and their UIDs are listed in headers_only_nums so acknowledging the batch leaves them on the server.
+    With fetch_text_parts_only the BODYSTRUCTURE is fetched with the headers and only the
+    text parts are downloaded, at most max_body_bytes per part or the limit of the matching services.
+    Mails whose Message-ID the dedup cache knows are dropped as soon as their headers are there."""
+
+    message_set: str = build_message_sets(message_nums, batch_size)[0]
+    batch_keys: set[str] = set()
+
+    if subject_index is None and not fetch_text_parts_only:
+        data = uid_fetch(imap_server, message_set, "(UID RFC822)")
+        fetched_items: dict[str, dict[str, ResponseValue]] = parse_fetch_items(data)
+
+        with timed("decode"):
+            emails: list[Email] = map_decoding(parse_email, [(fetched_items[uid].get("RFC822") or b"",) for uid in sorted(fetched_items, key=int)])
+        unique_emails: list[Email] = [email for email in emails if not is_duplicate_message(email, dedup_cache, batch_keys)]
+
+        return EmailBatch(unique_emails, message_nums, duplicate_count=len(emails) - len(unique_emails))
+
+    structure_item: str = " BODYSTRUCTURE" if fetch_text_parts_only else ""
+    data = uid_fetch(imap_server, message_set, f"(UID{structure_item} {HEADER_FIELDS})")
+    fetched_items = parse_fetch_items(data)
+
+    header_emails: dict[str, Email] = {}
+    body_limits: dict[str, int] = {}
+    duplicate_count: int = 0
+    headers_only_nums: list[str] = []
+    for uid in sorted(fetched_items, key=int):
+        raw_headers: ResponseValue = get_fetch_item(fetched_items[uid], "BODY[HEADER.FIELDS")
+        header_email: Email = parse_email_headers(raw_headers if isinstance(raw_headers, bytes) else b"")
+        body_limit: int | None = get_body_limit(header_email.subject, subject_index, max_body_bytes)
+        if is_duplicate_message(header_email, dedup_cache, batch_keys):
+            # The body of a duplicate is never downloaded, if no service needs it the first copy didn't save it either
+            duplicate_count += 1
+            if body_limit is None:
+                headers_only_nums.append(uid)
+            continue
+        header_emails[uid] = header_email
+
+        if body_limit is not None:
+            body_limits[uid] = body_limit
 
-        # Remove characters that cause problems in filenames
-        filename_prefix = sub(r"[\/\0\n\r\s]", "_", email.subject)
-        with open(f"plaintext-emails/{filename_prefix}_{unix_time_string}.txt", "w") as file:
-            file.write(f"{email.from_field}\n")
-            file.write("\n")
-            file.write(f"{email.subject}\n")
-            file.write("\n")
-            file.write(email.body)
+    if fetch_text_parts_only:
+        text_parts: dict[str, list[TextPart]] = {uid: get_text_parts(fetched_items[uid].get("BODYSTRUCTURE")) for uid in header_emails}
+        header_emails.update(fetch_text_parts(imap_server, header_emails, text_parts, body_limits, batch_size))
+    elif body_limits:
+        data = uid_fetch(imap_server, build_message_sets(list(body_limits), batch_size)[0], "(UID RFC822)")
+        fetched_bodies: dict[str, dict[str, ResponseValue]] = parse_fetch_items(data)
+        with timed("decode"):
+            decoded_emails: list[Email] = map_decoding(parse_email, [(items.get("RFC822") or b"",) for items in fetched_bodies.values()])
+        for uid, email in zip(fetched_bodies, decoded_emails):
+            header_emails[uid] = email
 
-        emails_saved += 1
+    headers_only_nums.extend(uid for uid, email in header_emails.items() if email.body == BODY_NOT_DOWNLOADED)
 
-    return emails_saved
+    return EmailBatch([header_emails[uid] for uid in sorted(header_emails, key=int)], message_nums, duplicate_count=duplicate_count, headers_only_nums=headers_only_nums)
+
+
+def fetch_email_batches(message_number_list: list[str], imap_server: IMAPServer, batch_size: int = 500, subject_index: SubjectIndex | None = None, fetch_text_parts_only: bool = False, max_body_bytes: int = 0,
+                        dedup_cache: DedupCache | None = None) -> Iterator[EmailBatch]:
+    """This yields the emails in the UID list in batches of batch_size messages with fetch_email_batch().
+    The next batch is only downloaded once the previous one was consumed, so at most one batch
+    of raw and decoded mails is held in memory no matter how many mails are waiting."""
+
+    for batch_start in range(0, len(message_number_list), batch_size):
+        message_nums: list[str] = message_number_list[batch_start:batch_start + batch_size]
+        yield fetch_email_batch(message_nums, imap_server, batch_size, subject_index, fetch_text_parts_only, max_body_bytes, dedup_cache)
+
+
+def get_messages_from_message_nums(message_number_list: list[str], imap_server: IMAPServer, batch_size: int = 500, subject_index: SubjectIndex | None = None, fetch_text_parts_only: bool = False, max_body_bytes: int = 0) -> list[Email]:
+    """This downloads every email in the UID list with fetch_email_batches()
+    and returns a properly formatted list of parsed Email objects"""
+
+    return [email for email_batch in fetch_email_batches(message_number_list, imap_server, batch_size, subject_index, fetch_text_parts_only, max_body_bytes)
+            for email in email_batch.emails]
+
+
+def get_subject_filters(subject_index: SubjectIndex) -> list[str] | None:
+    """This returns the literal strings of the subject index the server can search for.
+    The search filters are None if any rule doesn't have a usable ASCII literal,
+    because the server would miss mails for that service."""
+
+    subject_filters: list[str] = []
+
+    for service_rule in subject_index.service_rules:
+        required_literal: str = service_rule.subject_literal
+        if len(required_literal) < 3 or not required_literal.isascii():
+            return None
+        if required_literal not in subject_filters:
+            subject_filters.append(required_literal)
+
+    return subject_filters
+
+def save_emails(emails: list[Email], store: StateStore) -> int:
+    """This saves all emails passed in to the state store
+    and returns the number of emails saved this way"""
+
+    return store.add_mails(emails)
 
 
 def move_emails(imap_server: IMAPServer, message_nums: list[str], mail_config: SectionProxy) -> None:
-    """This moves the messages to the configured target mailbox"""
+    """This moves the messages with the passed UIDs to the configured archive mailbox
+    or deletes them. The UIDs are folded into message sets, so only one command per set is sent:
+    UID MOVE if the server supports it, otherwise UID COPY and UID STORE followed by one expunge."""
+
+    if not message_nums:
+        return
 
     archive_mails: bool = mail_config.getboolean("archive_processed_mails")
+    if not archive_mails and not mail_config.getboolean("delete_processed_mails", True):
+        return
+
+    archive_mailbox: str = mail_config.get("archive_mailbox")
+    capabilities: set[str] = get_capabilities(imap_server)
+    message_sets: list[str] = build_message_sets(message_nums, mail_config.getint("move_batch_size", 1000))
+
+    if archive_mails and "MOVE" in capabilities:
+        for message_set in message_sets:
+            imap_server.uid("MOVE", message_set, archive_mailbox)
+        return
 
-    for msg_num in message_nums:
+    for message_set in message_sets:
         if archive_mails:
-            imap_server.copy(msg_num, mail_config.get("archive_mailbox"))
+            imap_server.uid("COPY", message_set, archive_mailbox)
 
-        imap_server.store(msg_num, "+FLAGS", r"(\Deleted)")
+        imap_server.uid("STORE", message_set, "+FLAGS", r"(\Deleted)")
 
-    imap_server.expunge()
+    # UID EXPUNGE only removes our messages and not other messages flagged as deleted
+    if "UIDPLUS" in capabilities:
+        for message_set in message_sets:
+            imap_server.uid("EXPUNGE", message_set)
+    else:
+        imap_server.expunge()
     
 
 def logout_from_imap_server(imap_server: IMAPServer) -> None:
@@ -202,18 +644,160 @@ def logout_from_imap_server(imap_server: IMAPServer) -> None:
     imap_server.close()
     imap_server.logout()
 
-def main() -> int:
+
+@cache
+def warn_headers_first_without_sync(sync_key: str) -> None:
+    """This warns once per mailbox that its mails without service are fetched again on every run"""
+
+    print(f"{sync_key}: headers_first without incremental_sync isn't supported, the mails without service stay in the mailbox "
+          f"and are fetched again on every run, once their Message-ID expired they are saved again", file=sys.stderr)
+
+
+def receive_emails(imap_server: IMAPServer, mail_config: SectionProxy, sync_state: dict[str, dict[str, int]] | None = None,
+                   subject_index: SubjectIndex | None = None, dedup_cache: DedupCache | None = None) -> Iterator[EmailBatch]:
+    """This searches the new emails and returns a generator of EmailBatch objects of fetch_batch_size mails.
+    Every batch has to be passed to acknowledge_emails() once it's safe, its duplicates included.
+    The subject index is only used if headers_first is set."""
+
+    if not mail_config.getboolean("headers_first", True):
+        subject_index = None
+    elif sync_state is None:
+        warn_headers_first_without_sync(get_sync_key(mail_config))
+    subject_filters: list[str] | None = None
+    if subject_index is not None and mail_config.getboolean("server_side_subject_filter", False):
+        subject_filters = get_subject_filters(subject_index)
+
+    message_number_list: list[str] = get_message_numbers_from_inbox(imap_server, mail_config, sync_state, subject_filters)
+    # Ascending UIDs make sure the sync state never skips a batch that wasn't acknowledged yet
+    message_number_list.sort(key=int)
+
+    return fetch_email_batches(message_number_list, imap_server, mail_config.getint("fetch_batch_size", 500), subject_index,
+                               mail_config.getboolean("fetch_text_parts_only", True),
+                               mail_config.getint("max_body_bytes", 1048576), dedup_cache)
+
+
+def acknowledge_emails(imap_server: IMAPServer, mail_config: SectionProxy, sync_state: dict[str, dict[str, int]] | None, email_batch: EmailBatch) -> None:
+    """This saves the sync state and archives or deletes the received emails on the server.
+    Mails whose body wasn't downloaded stay where they are, only the sync state moves past them,
+    so archiving or deleting a mail never loses a body that isn't saved anywhere."""
+
+    # The state is saved before the cleanup, so a crash in between doesn't lead to duplicates
+    if sync_state is not None:
+        update_sync_state(sync_state, mail_config, email_batch.message_nums)
+
+    headers_only_uids: set[int] = {int(uid) for uid in email_batch.headers_only_nums}
+    move_emails(imap_server, [uid for uid in email_batch.message_nums if int(uid) not in headers_only_uids], mail_config)
+
+
+class AccountReceiver:
+    """This fetches the mails of every account concurrently, one thread and one connection per account,
+    and yields their batches one after another from receive() to a single consumer.
+    Every thread waits until its batch was passed to acknowledge() before it acknowledges the batch
+    on its own connection and fetches the next one, so at most one batch per account is in flight."""
+
+    def __init__(self, account_configs: list[SectionProxy], sync_state: dict[str, dict[str, int]] | None,
+                 subject_index: SubjectIndex | None, max_concurrent_accounts: int = 4) -> None:
+        self.sync_state: dict[str, dict[str, int]] | None = sync_state
+        self.subject_index: SubjectIndex | None = subject_index
+        self.dedup_cache: DedupCache | None = None
+        self.max_concurrent_accounts: int = max(1, max_concurrent_accounts)
+        self.failed_accounts: list[str] = []
+        self.batches: Queue[EmailBatch | None] = Queue()
+        self.acknowledged: dict[int, Event] = {}
+        self.stopping: bool = False
+
+        self.accounts: dict[str, list[SectionProxy]] = {}
+        for mailbox_config in account_configs:
+            self.accounts.setdefault(mailbox_config.get("account", "Mail"), []).append(mailbox_config)
+
+    def fetch_account(self, account_name: str, mailbox_configs: list[SectionProxy]) -> None:
+        """This runs in the thread of the account and fetches all of its mailboxes over one connection"""
+
+        try:
+            if self.stopping:
+                return
+            imap_server: IMAPServer = connect_to_imap_server(mailbox_configs[0])
+            imap_server = login_to_imap(imap_server, mailbox_configs[0])
+
+            for mailbox_config in mailbox_configs:
+                for email_batch in receive_emails(imap_server, mailbox_config, self.sync_state, self.subject_index, self.dedup_cache):
+                    email_batch.account = account_name
+                    acknowledged = Event()
+                    self.acknowledged[id(email_batch)] = acknowledged
+                    self.batches.put(email_batch)
+                    if not self.stopping:
+                        acknowledged.wait()
+                    if self.stopping:
+                        return
+                    acknowledge_emails(imap_server, mailbox_config, self.sync_state, email_batch)
+
+            logout_from_imap_server(imap_server)
+        except Exception as error:
+            # A broken account must not stop the other accounts
+            print(f"Fetching the mails of {account_name} failed: {error}", file=sys.stderr)
+            self.failed_accounts.append(account_name)
+        finally:
+            # Tells receive() that this account is done
+            self.batches.put(None)
+
+    def receive(self, dedup_cache: DedupCache | None = None) -> Iterator[EmailBatch]:
+        """This yields the batches of all accounts in the order they arrive, the dedup cache is shared by all accounts"""
+
+        self.dedup_cache = dedup_cache
+        with ThreadPoolExecutor(self.max_concurrent_accounts, thread_name_prefix="account") as executor:
+            for account_name, mailbox_configs in self.accounts.items():
+                executor.submit(self.fetch_account, account_name, mailbox_configs)
+
+            try:
+                accounts_done: int = 0
+                while accounts_done < len(self.accounts):
+                    email_batch: EmailBatch | None = self.batches.get()
+                    if email_batch is None:
+                        accounts_done += 1
+                        continue
+                    yield email_batch
+            finally:
+                # If the consumer stopped early no thread may wait for its acknowledgement forever
+                self.stopping = accounts_done < len(self.accounts)
+                for acknowledged in list(self.acknowledged.values()):
+                    acknowledged.set()
+
+    def acknowledge(self, email_batch: EmailBatch) -> None:
+        """This lets the thread of the account acknowledge the batch on the server once it's saved"""
+
+        self.acknowledged.pop(id(email_batch)).set()
+
+
+def main() -> tuple[int, int]:
+    """This saves the new mails of all accounts in the state store and returns
+    how many were saved and how many were dropped as duplicates"""
+
+    start_run()
     mail_config: SectionProxy = read_config()
-    imap_server: IMAPServer = connect_to_imap_server(mail_config)
-    imap_server: IMAPServer = login_to_imap(imap_server, mail_config)
-    message_number_list: list[str] = get_message_numbers_from_inbox(imap_server, mail_config)
-    emails: list[Email] = get_messages_from_message_nums(message_number_list, imap_server)
-    mails_saved: int = save_emails_as_plaintext(emails)
-    move_emails(imap_server, message_number_list, mail_config)
+    sync_state: dict[str, dict[str, int]] | None = read_sync_state() if mail_config.getboolean("incremental_sync", True) else None
+    subject_index: SubjectIndex | None = build_subject_index() if mail_config.getboolean("headers_first", True) else None
 
-    logout_from_imap_server(imap_server)
-    return mails_saved
+    store = StateStore()
+    dedup_cache: DedupCache | None = build_dedup_cache(store.get_seen_mails(), mail_config)
+    account_receiver = AccountReceiver(read_account_configs(), sync_state, subject_index, mail_config.getint("max_concurrent_accounts", 4))
 
-if __name__ == "__main__":
-    main()
+    mails_saved: int = 0
+    duplicates_skipped: int = 0
+    # Every batch is acknowledged as soon as it's saved
+    for email_batch in account_receiver.receive(dedup_cache):
+        mails_saved += save_emails(email_batch.emails, store)
+        duplicates_skipped += email_batch.duplicate_count
+        if dedup_cache is not None:
+            dedup_cache.add(get_message_id_key(email) for email in email_batch.emails)
+        account_receiver.acknowledge(email_batch)
+
+    if dedup_cache is not None:
+        store.save_seen_mails(dedup_cache.get_entries())
+    store.close()
 
+    return mails_saved, duplicates_skipped
+
+if __name__ == "__main__":
+    # main.py already holds the lock when it calls main(), on its own the script has to take it
+    with hold_run_lock():
+        main()
@@ -1,18 +1,185 @@
 # This is the entry point of the program which
 # executes every module in order
+#
+# By default the stages run in one process and pass the emails in memory,
+# only the emails without service and the services are saved in the state store.
+# With in_memory_pipeline = False every module runs on its own like its __main__
+#
+# Only one run works at a time, a run that starts while another one still holds the lock
+# prints the output of the last complete run instead of waiting for it, see runlock.py
+#
+# Usage: python main.py [--profile [state/profile.pstats]] [--import-time]
+
+import cProfile
+from argparse import ArgumentParser
+from configparser import SectionProxy
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Iterator
 
 import prepare
 import mail2text
 import textmail2service
 import service2checkmk
+from archive import MailArchive, build_mail_archive
+from configfile import read_config_section
+from dedup import DedupCache, build_dedup_cache
+from instrumentation import get_import_times, start_run
+from mail2text import IMAPServer
+from models import EmailBatch
+from rules import RuleGuard, SubjectIndex, build_rule_guard, build_subject_index
+from runlock import RunLock, get_lock_service_line
+from statestore import StateStore
 
 
 
-def main() -> None:
+def save_dedup_cache(dedup_cache: DedupCache | None, store: StateStore) -> None:
+    """This saves the entries of the dedup cache that didn't expire in the state store for the next run"""
+
+    if dedup_cache is not None:
+        store.save_seen_mails(dedup_cache.get_entries())
+
+
+def run_pipeline(receive_batches: Callable[[DedupCache | None], Iterator[EmailBatch]], acknowledge: Callable[[EmailBatch], None], mail_config: SectionProxy,
+                 store: StateStore, subject_index: SubjectIndex, rule_guard: RuleGuard, failed_accounts: list[str] | None = None) -> None:
+    """This runs the stages as a chain of generators: receive_batches() fetches and decodes one batch with the dedup cache of the run,
+    textmail2service routes, evaluates and saves it and only then the batch is passed to acknowledge().
+    At most one batch of fetch_batch_size mails per mailbox is in flight, a crash fetches the unacknowledged batches again.
+    failed_accounts is the list the receiver adds the accounts it couldn't fetch to, they are reported in the stats."""
+
+    start_run()
+    run_stats = textmail2service.RunStats()
+    dedup_cache: DedupCache | None = build_dedup_cache(store.get_seen_mails(), mail_config)
+    mail_archive: MailArchive | None = build_mail_archive(store)
+
+    textmail2service.process_stored_emails(store, subject_index, rule_guard, run_stats, mail_config.getint("fetch_batch_size", 500), dedup_cache, mail_archive)
+    for email_batch in textmail2service.process_email_batches(receive_batches(dedup_cache), store, subject_index, rule_guard, run_stats, dedup_cache, mail_archive):
+        acknowledge(email_batch)
+    run_stats.failed_accounts = failed_accounts if failed_accounts is not None else []
+
+    with store.transaction():
+        save_dedup_cache(dedup_cache, store)
+        textmail2service.maintain_mail_archive(store, mail_archive)
+        textmail2service.save_run_stats(run_stats, rule_guard, store)
+
+
+def run_mailbox_pipeline(imap_server: IMAPServer, mailbox_config: SectionProxy, sync_state: dict[str, dict[str, int]] | None,
+                         store: StateStore, subject_index: SubjectIndex, rule_guard: RuleGuard) -> None:
+    """This runs the pipeline for one mailbox over the passed connection"""
+
+    run_pipeline(lambda dedup_cache: mail2text.receive_emails(imap_server, mailbox_config, sync_state, subject_index, dedup_cache),
+                 lambda email_batch: mail2text.acknowledge_emails(imap_server, mailbox_config, sync_state, email_batch),
+                 mailbox_config, store, subject_index, rule_guard)
+
+
+def run_accounts_pipeline(account_configs: list[SectionProxy], mail_config: SectionProxy, sync_state: dict[str, dict[str, int]] | None,
+                          store: StateStore, subject_index: SubjectIndex, rule_guard: RuleGuard) -> None:
+    """This runs the pipeline for every configured account and mailbox. The accounts are fetched concurrently
+    by mail2text.AccountReceiver, at most max_concurrent_accounts at a time, and all of them feed the same service evaluation in this thread."""
+
+    account_receiver = mail2text.AccountReceiver(account_configs, sync_state, subject_index, mail_config.getint("max_concurrent_accounts", 4))
+    run_pipeline(account_receiver.receive, account_receiver.acknowledge, mail_config, store, subject_index, rule_guard, account_receiver.failed_accounts)
+
+
+def run_in_memory(cache_interval: int = 0) -> None:
+    """This runs all stages in one process with run_accounts_pipeline() and prints the services"""
+
+    mail_config: SectionProxy = mail2text.read_config()
+    sync_state: dict[str, dict[str, int]] | None = mail2text.read_sync_state() if mail_config.getboolean("incremental_sync", True) else None
+
+    store = StateStore()
+    # The subject index is shared by both stages
+    subject_index: SubjectIndex = build_subject_index()
+    rule_guard: RuleGuard = build_rule_guard()
+
+    run_accounts_pipeline(mail2text.read_account_configs(), mail_config, sync_state, store, subject_index, rule_guard)
+    rule_guard.close()
+
+    service2checkmk.send_and_clean_up(store, cache_interval)
+    store.close()
+
+
+# How many of the slowest imports the --import-time report lists
+IMPORT_TIME_REPORT_LENGTH = 25
+
+
+def print_startup_report() -> None:
+    """This prints what a cold start of the local check costs before the first mail is fetched:
+    the slowest imports of main in a fresh interpreter and the time the service rules take to load"""
+
+    import_times: list[tuple[str, int, int]] = get_import_times("main")
+    main_microseconds: int = next(cumulative for module_name, own, cumulative in import_times if module_name == "main")
+
+    print(f"import main: {main_microseconds / 1000:.1f} ms")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    slowest_imports = sorted((import_time for import_time in import_times if import_time[0] != "main"), key=lambda import_time: import_time[2], reverse=True)
+    for module_name, own, cumulative in slowest_imports[:IMPORT_TIME_REPORT_LENGTH]:
+        print(f"{cumulative / 1000:9.1f} ms {own / 1000:7.1f} ms  {module_name}")
+
     prepare.main()
-    emails_saved: int = mail2text.main()
-    textmail2service.main(emails_saved)
-    service2checkmk.main()
+    start: float = perf_counter()
+    build_subject_index()
+    print(f"service rules: {(perf_counter() - start) * 1000:.1f} ms")
+
+
+def run_locked(cache_interval: int) -> None:
+    """This runs the stages, in one process or every module on its own"""
+
+    if mail2text.read_config().getboolean("in_memory_pipeline", True):
+        run_in_memory(cache_interval)
+        return
+
+    emails_saved, duplicates_skipped = mail2text.main()
+    textmail2service.main(emails_saved, duplicates_skipped)
+    service2checkmk.main(cache_interval)
+
+
+def run() -> None:
+    prepare.main()
+    run_config: SectionProxy = read_config_section("Run")
+    cache_interval: int = run_config.getint("cache_interval", 0)
+
+    # Within the cache interval the output of the last run is still valid, the mails are fetched less often than the agent polls
+    snapshot_age: float | None = service2checkmk.get_snapshot_age()
+    if cache_interval > 0 and snapshot_age is not None and snapshot_age < cache_interval:
+        service2checkmk.send_snapshot(cache_interval)
+        return
+
+    run_lock = RunLock()
+    if not run_lock.acquire():
+        service2checkmk.send_snapshot(cache_interval)
+        service2checkmk.send_to_checkmk(get_lock_service_line(run_lock.get_holder(), run_config.getfloat("stale_lock_seconds", 1800.0)))
+        return
+
+    try:
+        run_locked(cache_interval)
+    finally:
+        run_lock.release()
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Fetches the mails, turns them into services and prints them for CheckMK")
+    argument_parser.add_argument("--profile", nargs="?", type=Path, const=Path("state/profile.pstats"),
+                                 help="write a cProfile dump of the run, open it with python -m pstats. Relative paths are relative to "
+                                      "the Mail2CheckMk directory like every other path (default: state/profile.pstats)")
+    argument_parser.add_argument("--import-time", action="store_true",
+                                 help="print the slowest imports and the time the service rules take to load instead of running")
+    arguments = argument_parser.parse_args()
+
+    if arguments.import_time:
+        print_startup_report()
+        return
+
+    if arguments.profile is None:
+        run()
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run)
+    finally:
+        arguments.profile.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(arguments.profile)
 
 
 
@@ -0,0 +1,70 @@
+# This module contains the data classes that are passed between the modules,
+# it has no dependencies so every module can import it cheaply
+
+from dataclasses import dataclass, field
+
+# The body of mails whose subject didn't match any service config when they were fetched with headers_first
+BODY_NOT_DOWNLOADED = "(body not downloaded, no service config matches the subject)"
+
+
+@dataclass
+class Email:
+    """A Email object must have the from-field, the subject and the email body defined"""
+
+    from_field: str
+    subject: str
+    body: str
+    # True if only the beginning of the body was downloaded because of max_body_bytes
+    truncated: bool = False
+    # The Message-ID header, it's only known for mails fetched in this run and isn't saved in the state store
+    message_id: str = ""
+
+
+@dataclass
+class EmailBatch:
+    """Emails that are fetched, processed and acknowledged on the server together"""
+
+    emails: list[Email]
+    # The UIDs of the batch, this includes mails that couldn't be parsed
+    message_nums: list[str]
+    # The name of the account section the batch was fetched from
+    account: str = "Mail"
+    # The mails of the batch that were dropped because the dedup cache already knew their Message-ID
+    duplicate_count: int = 0
+    # The UIDs of the mails whose body wasn't downloaded, they are left on the server when the batch is acknowledged
+    headers_only_nums: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Service:
+    delete: bool
+    send: bool
+    status: int
+    name: str
+    values: dict
+    status_details: str
+    # The unix times the service goes WARN and CRIT if no newer mail arrives, None if it can't
+    warn_deadline: float | None = None
+    crit_deadline: float | None = None
+    # The status details of the service after these deadlines passed
+    warn_cycle_details: str = ""
+    crit_cycle_details: str = ""
+
+    def get_checkmk_output(self, status: int | None = None, status_details: str | None = None) -> str:
+        """This returns the local check line that is sent to CheckMK for this service,
+        with another status and status details if they are passed"""
+
+        formatted_dict: str = ""
+        if len(self.values) != 0:
+            for key, value in self.values.items():
+                if formatted_dict == "":
+                    formatted_dict += f" {key}={value}"
+                else:
+                    formatted_dict += f"|{key}={value}"
+        else:
+            formatted_dict = " -"
+
+        status = self.status if status is None else status
+        status_details = self.status_details if status_details is None else status_details
+
+        return f"{str(status)} {self.name}{formatted_dict} {status_details}"
@@ -1,14 +1,20 @@
 # This module makes sure that the needed directory structure
-# for the other modules exists
+# for the other modules exists and imports the spool directories
+# of older versions into the state store
 
 from pathlib import Path
 from os import chdir
 
+from statestore import StateStore, migrate_spool
+
 def main() -> None:
 
     chdir("/opt/Mail2CheckMk")
-    Path("plaintext-emails/without-service").mkdir(parents=True, exist_ok=True)
-    Path("service-files").mkdir(parents=True, exist_ok=True)
+    Path("state").mkdir(parents=True, exist_ok=True)
+
+    store = StateStore()
+    migrate_spool(store)
+    store.close()
 
 
 
@@ -0,0 +1,184 @@
+# This module runs every service config in ./config/services against the emails
+# in the state store (including the ones without service) and reports how long every RegEx
+# takes, how often it matches, the slowest input and RegEx that could backtrack catastrophically
+#
+# Usage: python profile_rules.py [--time-budget 2.0] [--archive-days 7] [--json]
+
+import json
+import sys
+from argparse import ArgumentParser
+from dataclasses import dataclass, field, asdict
+from multiprocessing import Pool, TimeoutError as PoolTimeoutError
+from multiprocessing.pool import Pool as PoolType
+from re import Pattern
+from time import perf_counter, time
+
+from archive import DAY_SECONDS, MailArchive
+from configfile import read_config_section
+from models import Email
+from rules import BodyPattern, BodyScan, ServiceRule, find_backtracking_risks, load_service_rules, read_service_configs
+from statestore import StateStore, StoredMail
+
+
+@dataclass
+class PatternProfile:
+    """The profiling results of one RegEx of a service config"""
+
+    source: str
+    kind: str
+    regex: str
+    risks: list[str]
+    calls: int = 0
+    matches: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    worst_input: str = ""
+    over_budget: list[str] = field(default_factory=list)
+
+
+def time_pattern(pattern: Pattern | BodyPattern, texts: list[str]) -> list[tuple[float, bool]]:
+    """This runs in the worker process and returns the duration and if it matched for every text.
+    Body patterns are searched like at runtime, subject patterns with a plain search()."""
+
+    results: list[tuple[float, bool]] = []
+
+    for text in texts:
+        start: float = perf_counter()
+        if isinstance(pattern, BodyPattern):
+            pattern_match = pattern.search(BodyScan(text))
+        else:
+            pattern_match = pattern.search(text)
+        results.append((perf_counter() - start, pattern_match is not None))
+
+    return results
+
+
+class ProfilingWorker:
+    """This runs time_pattern() in a worker process that is replaced if it has to be killed"""
+
+    def __init__(self) -> None:
+        self.worker_pool: PoolType = Pool(1)
+
+    def run(self, pattern: Pattern | BodyPattern, texts: list[str], timeout: float) -> list[tuple[float, bool]] | None:
+        """This returns the results of time_pattern() or None if it took longer than the timeout"""
+
+        try:
+            return self.worker_pool.apply_async(time_pattern, (pattern, texts)).get(timeout)
+        except PoolTimeoutError:
+            self.worker_pool.terminate()
+            self.worker_pool = Pool(1)
+            return None
+
+    def close(self) -> None:
+        self.worker_pool.close()
+        self.worker_pool.join()
+
+
+def profile_pattern(worker: ProfilingWorker, pattern_profile: PatternProfile, pattern: Pattern | BodyPattern,
+                    texts: list[str], text_names: list[str], time_budget: float, chunk_size: int) -> None:
+    """This profiles the pattern over all texts in chunks. If a chunk goes over its budget
+    every text of it is run on its own to find the inputs that are over the time budget."""
+
+    for chunk_start in range(0, len(texts), chunk_size):
+        chunk: list[str] = texts[chunk_start:chunk_start + chunk_size]
+        chunk_names: list[str] = text_names[chunk_start:chunk_start + chunk_size]
+
+        results: list[tuple[float, bool] | None] | None = worker.run(pattern, chunk, time_budget * len(chunk))
+        if results is None:
+            results = []
+            for text in chunk:
+                single_result = worker.run(pattern, [text], time_budget)
+                results.append(single_result[0] if single_result else None)
+
+        for text_name, result in zip(chunk_names, results):
+            pattern_profile.calls += 1
+            if result is None:
+                pattern_profile.over_budget.append(text_name)
+                pattern_profile.worst_input = text_name
+                pattern_profile.max_time = max(pattern_profile.max_time, time_budget)
+                pattern_profile.total_time += time_budget
+                continue
+
+            duration, matched = result
+            pattern_profile.total_time += duration
+            pattern_profile.matches += matched
+            if duration > pattern_profile.max_time and not pattern_profile.over_budget:
+                pattern_profile.max_time = duration
+                pattern_profile.worst_input = text_name
+
+
+def profile_rules(service_rules: list[ServiceRule], emails: list[Email], email_names: list[str], time_budget: float, chunk_size: int = 50) -> list[PatternProfile]:
+    """This profiles the subject RegEx of every rule against all subjects
+    and the body RegEx against all bodies and returns the profiles"""
+
+    subjects: list[str] = [email.subject for email in emails]
+    bodies: list[str] = [email.body for email in emails]
+    pattern_profiles: list[PatternProfile] = []
+    worker = ProfilingWorker()
+
+    for service_rule in service_rules:
+        subject_profile = PatternProfile(service_rule.source, "email_subject_regex", service_rule.subject_regex.pattern,
+                                         find_backtracking_risks(service_rule.subject_regex.pattern))
+        profile_pattern(worker, subject_profile, service_rule.subject_regex, subjects, email_names, time_budget, chunk_size)
+        pattern_profiles.append(subject_profile)
+
+        for kind, body_pattern in zip(("crit_regex", "warn_regex", "ok_regex"), service_rule.get_body_patterns()):
+            if body_pattern is None:
+                continue
+            body_profile = PatternProfile(service_rule.source, kind, body_pattern.regex.pattern, body_pattern.risks)
+            profile_pattern(worker, body_profile, body_pattern, bodies, email_names, time_budget, chunk_size)
+            pattern_profiles.append(body_profile)
+
+    worker.close()
+
+    return sorted(pattern_profiles, key=lambda pattern_profile: pattern_profile.total_time, reverse=True)
+
+
+def print_report(pattern_profiles: list[PatternProfile]) -> None:
+    """This prints the profiles as a table, slowest RegEx first"""
+
+    print(f"{'service config':<40} {'regex':<20} {'calls':>6} {'match %':>8} {'total ms':>10} {'max ms':>9}  worst input")
+    for pattern_profile in pattern_profiles:
+        match_rate: float = pattern_profile.matches / pattern_profile.calls * 100 if pattern_profile.calls else 0.0
+        print(f"{pattern_profile.source:<40} {pattern_profile.kind:<20} {pattern_profile.calls:>6} {match_rate:>8.1f} "
+              f"{pattern_profile.total_time * 1000:>10.3f} {pattern_profile.max_time * 1000:>9.3f}  {pattern_profile.worst_input}")
+        for risk in pattern_profile.risks:
+            print(f"    RISK: {risk}")
+        for over_budget_input in pattern_profile.over_budget:
+            print(f"    OVER TIME BUDGET: {over_budget_input}")
+
+
+def main() -> int:
+    argument_parser = ArgumentParser(description="Profiles the RegEx of all service configs against the stored emails")
+    argument_parser.add_argument("--time-budget", type=float, default=read_config_section("Rules").getfloat("time_budget", 2.0),
+                                 help="seconds a RegEx may take per email (default: time_budget from the 'Rules' section)")
+    argument_parser.add_argument("--archive-days", type=float, default=0.0,
+                                 help="also profile the archived emails received in the last days (default: none)")
+    argument_parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    arguments = argument_parser.parse_args()
+
+    store = StateStore()
+    stored_emails: list[StoredMail] = store.get_mails()
+    emails: list[Email] = [stored_email.email for stored_email in stored_emails]
+    # Emails are named by their id and subject in the report, archived ones by their position in the archive
+    email_names: list[str] = [f"#{stored_email.id} {stored_email.email.subject}" for stored_email in stored_emails]
+    if arguments.archive_days > 0:
+        for archive_number, archived_mail in enumerate(MailArchive(store).iter_mails(time() - arguments.archive_days * DAY_SECONDS)):
+            emails.append(archived_mail.email)
+            email_names.append(f"archive #{archive_number} {archived_mail.email.subject}")
+    store.close()
+    service_rules: list[ServiceRule] = load_service_rules(read_service_configs())
+
+    pattern_profiles: list[PatternProfile] = profile_rules(service_rules, emails, email_names, arguments.time_budget)
+
+    if arguments.json:
+        print(json.dumps([asdict(pattern_profile) for pattern_profile in pattern_profiles], indent=2))
+    else:
+        print_report(pattern_profiles)
+
+    # A non zero exit code lets scripts notice RegEx that went over the budget
+    return 1 if any(pattern_profile.over_budget for pattern_profile in pattern_profiles) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+# This module evaluates the emails without service in the state store again with the current service configs,
+# e.g. after a new service config was added, without waiting for the next run of main.py.
+# Large backlogs are evaluated by a pool of processes, see backlog_workers in the 'Rules' section.
+#
+# Usage: python reprocess.py [--all] [--workers 4] [--batch-size 500]
+
+from argparse import ArgumentParser
+
+from archive import MailArchive, build_mail_archive
+from rules import RuleGuard, SubjectIndex, build_rule_guard, build_subject_index
+from runlock import hold_run_lock
+from statestore import StateStore
+from textmail2service import RunStats, process_backlog
+
+
+def main() -> None:
+    argument_parser = ArgumentParser(description="Evaluates the emails without service again with the current service configs")
+    argument_parser.add_argument("--all", action="store_true",
+                                 help="evaluate every email without service, also the ones already evaluated with the current service configs")
+    argument_parser.add_argument("--workers", type=int, default=None,
+                                 help="processes that evaluate the emails, 0 evaluates them in this process (default: backlog_workers from the 'Rules' section)")
+    argument_parser.add_argument("--batch-size", type=int, default=500)
+    arguments = argument_parser.parse_args()
+
+    store = StateStore()
+    subject_index: SubjectIndex = build_subject_index()
+    rule_guard: RuleGuard = build_rule_guard()
+    mail_archive: MailArchive | None = build_mail_archive(store)
+    run_stats = RunStats()
+
+    emails_evaluated: int = process_backlog(store, subject_index, rule_guard, run_stats, arguments.batch_size, arguments.all, arguments.workers, mail_archive)
+    rule_guard.close()
+
+    print(f"{emails_evaluated} emails evaluated, {run_stats.service_files_created} services created, "
+          f"{store.count_mails(('without-service',))} emails without service left")
+    headers_only_count: int = store.count_mails(("without-service",), headers_only=True)
+    if headers_only_count:
+        print(f"{headers_only_count} emails without service weren't evaluated because only their headers were downloaded (headers_first)")
+    for source in rule_guard.rules_over_budget:
+        print(f"OVER TIME BUDGET: {source}")
+    store.close()
+
+
+if __name__ == "__main__":
+    with hold_run_lock():
+        main()
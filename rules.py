@@ -0,0 +1,748 @@
+# This module reads the service configs in ./config/services and compiles them
+# into rules and an index, so an email subject is only matched against the RegEx
+# of service configs that can possibly apply to it. The compiled index is cached
+# in ./state/service-rules.cache until a service config changes
+
+import hashlib
+import os
+import pickle
+from bisect import bisect_left
+from collections import deque
+from io import BytesIO
+from configparser import ConfigParser, SectionProxy
+from dataclasses import dataclass
+from pathlib import Path
+from re import compile as compile_regex, Match, Pattern
+from re import _parser as sre_parse
+from re import _constants as sre_constants
+from typing import TYPE_CHECKING
+
+from configfile import read_config_section
+
+if TYPE_CHECKING:
+    from multiprocessing.pool import Pool as PoolType
+
+RULES_CACHE_PATH = Path("state/service-rules.cache")
+# This must be increased whenever the cached classes or the way they are built change, so older caches are rebuilt
+RULES_CACHE_VERSION = 3
+
+
+def flatten_literals(parsed_pattern: sre_parse.SubPattern) -> list[str | None]:
+    """This flattens a parsed pattern into the characters it must match in order,
+    every part that isn't a plain literal becomes None"""
+
+    flattened: list[str | None] = []
+
+    for op, av in parsed_pattern:
+        if op is sre_constants.LITERAL:
+            flattened.append(chr(av))
+        elif op is sre_constants.SUBPATTERN:
+            group, add_flags, del_flags, sub_pattern = av
+            if add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                flattened.append(None)
+            else:
+                # Groups must be matched completely, so their literals are required as well
+                flattened.extend(flatten_literals(sub_pattern))
+        else:
+            flattened.append(None)
+
+    return flattened
+
+
+def get_required_literal(regex: str) -> str:
+    """This returns the longest literal string that any subject matched by the regex must contain
+    e.g. '] Einige Plugins' for '(\\[.+\\]) Einige Plugins', or "" if there is none"""
+
+    try:
+        parsed_pattern = sre_parse.parse(regex)
+    except Exception:
+        return ""
+
+    if parsed_pattern.state.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return ""
+
+    longest_literal: str = ""
+    current_literal: str = ""
+    for character in flatten_literals(parsed_pattern):
+        if character is None:
+            current_literal = ""
+            continue
+        current_literal += character
+        if len(current_literal) > len(longest_literal):
+            longest_literal = current_literal
+
+    return longest_literal
+
+
+def read_service_configs() -> list[tuple[str, SectionProxy]]:
+    """This returns the file name and the parsed config of every service config file"""
+
+    service_configs: list[tuple[str, SectionProxy]] = []
+    config_directory = Path("config/services")
+    for config_file in sorted(config_directory.glob("*.cfg")):
+        cfgparser = ConfigParser()
+        cfgparser.read(config_file)
+        service_configs.append((config_file.name, cfgparser["Service"]))
+
+    return service_configs
+
+
+def get_service_configs() -> list[SectionProxy]:
+    """This returns a list of all service config files as parsed configs"""
+
+    return [service_config for config_name, service_config in read_service_configs()]
+
+
+def get_first_characters(parsed_pattern: sre_parse.SubPattern) -> set[str] | None:
+    """This returns the characters a match of the pattern can start with,
+    None means that it could be (almost) any character"""
+
+    for op, av in parsed_pattern:
+        match op:
+            case sre_constants.LITERAL:
+                return {chr(av)}
+            case sre_constants.IN:
+                characters: set[str] = set()
+                for set_op, set_av in av:
+                    if set_op is sre_constants.LITERAL:
+                        characters.add(chr(set_av))
+                    elif set_op is sre_constants.RANGE and set_av[1] - set_av[0] < 256:
+                        characters.update(chr(codepoint) for codepoint in range(set_av[0], set_av[1] + 1))
+                    else:
+                        return None
+                return characters
+            case sre_constants.SUBPATTERN:
+                return get_first_characters(av[3])
+            case sre_constants.BRANCH:
+                branch_characters: set[str] = set()
+                for branch in av[1]:
+                    characters = get_first_characters(branch)
+                    if characters is None:
+                        return None
+                    branch_characters |= characters
+                return branch_characters
+            case sre_constants.MAX_REPEAT | sre_constants.MIN_REPEAT if av[0] > 0:
+                return get_first_characters(av[2])
+            case sre_constants.AT:
+                continue
+            case _:
+                return None
+
+    return set()
+
+
+def characters_overlap(first_characters: set[str] | None, second_characters: set[str] | None) -> bool:
+    """This checks if two sets from get_first_characters() can match the same character"""
+
+    if first_characters is None or second_characters is None:
+        return True
+
+    return bool(first_characters & second_characters)
+
+
+def check_backtracking(parsed_pattern: sre_parse.SubPattern, risks: list[str], inside_repeat: bool) -> None:
+    """This walks the parsed pattern and appends a description of every construct
+    that can make the RegEx engine backtrack exponentially or quadratically"""
+
+    previous_repeat: set[str] | None | bool = False
+
+    for op, av in parsed_pattern:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            min_repeat, max_repeat, repeated_pattern = av
+            unbounded: bool = max_repeat == sre_constants.MAXREPEAT
+            repeated_characters: set[str] | None = get_first_characters(repeated_pattern)
+
+            if unbounded and inside_repeat:
+                risks.append("nested unbounded quantifier, e.g. (a+)* or (?:.*x)*")
+            if unbounded and previous_repeat is not False and characters_overlap(previous_repeat, repeated_characters):
+                risks.append("adjacent unbounded quantifiers that match the same characters, e.g. .*.*")
+
+            check_backtracking(repeated_pattern, risks, inside_repeat or unbounded)
+            previous_repeat = repeated_characters if unbounded else False
+            continue
+
+        if op is sre_constants.SUBPATTERN:
+            check_backtracking(av[3], risks, inside_repeat)
+        elif op is sre_constants.BRANCH:
+            branch_characters: list[set[str] | None] = [get_first_characters(branch) for branch in av[1]]
+            if inside_repeat and any(characters_overlap(branch_characters[first], branch_characters[second])
+                                     for first in range(len(branch_characters))
+                                     for second in range(first + 1, len(branch_characters))):
+                risks.append("alternatives that start with the same characters inside a quantifier, e.g. (a|ab)*")
+            for branch in av[1]:
+                check_backtracking(branch, risks, inside_repeat)
+        previous_repeat = False
+
+
+def find_backtracking_risks(regex: str) -> list[str]:
+    """This returns the reasons why the regex is likely to backtrack catastrophically on long input"""
+
+    try:
+        parsed_pattern = sre_parse.parse(regex)
+    except Exception:
+        return []
+
+    risks: list[str] = []
+    check_backtracking(parsed_pattern, risks, False)
+
+    # Every reason is only reported once
+    return list(dict.fromkeys(risks))
+
+
+def get_literal_string(regex: str) -> str | None:
+    """This returns the string the regex matches if it only consists of literals, otherwise None"""
+
+    try:
+        parsed_pattern = sre_parse.parse(regex)
+    except Exception:
+        return None
+
+    if parsed_pattern.state.flags & ~sre_constants.SRE_FLAG_UNICODE:
+        return None
+
+    literal: str = ""
+    for op, av in parsed_pattern:
+        if op is not sre_constants.LITERAL:
+            return None
+        literal += chr(av)
+
+    return literal
+
+
+def get_literal_prefix(regex: str) -> str:
+    """This returns the literals every match of the regex starts with"""
+
+    try:
+        parsed_pattern = sre_parse.parse(regex)
+    except Exception:
+        return ""
+
+    literal_prefix: str = ""
+    for character in flatten_literals(parsed_pattern):
+        if character is None:
+            break
+        literal_prefix += character
+
+    return literal_prefix
+
+
+def is_self_contained(parsed_pattern: sre_parse.SubPattern) -> bool:
+    """This checks that a pattern doesn't use anchors, lookarounds or backreferences,
+    which could behave differently when it is matched on its own at a position"""
+
+    for op, av in parsed_pattern:
+        if op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT,
+                  sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return False
+        sub_patterns: list = []
+        if op is sre_constants.SUBPATTERN:
+            sub_patterns = [av[3]]
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, sre_constants.POSSESSIVE_REPEAT):
+            sub_patterns = [av[2]]
+        elif op is sre_constants.BRANCH:
+            sub_patterns = av[1]
+        elif op is sre_constants.ATOMIC_GROUP:
+            sub_patterns = [av]
+        if not all(is_self_contained(sub_pattern) for sub_pattern in sub_patterns):
+            return False
+
+    return True
+
+
+class LazyRegex:
+    """This is the base class of the objects in the rules cache. The compiled RegEx in their regex_attributes
+    aren't pickled, only their source is, and they are compiled again the first time they are used.
+    So loading the cache only compiles the RegEx of the rules a subject or body is actually matched with."""
+
+    regex_attributes: tuple[str, ...] = ()
+
+    def __getstate__(self) -> dict:
+        state: dict = self.__dict__.copy()
+        for attribute in self.regex_attributes:
+            if attribute in state:
+                regex: Pattern = state.pop(attribute)
+                state[f"{attribute}_source"] = (regex.pattern, regex.flags)
+
+        return state
+
+    def __getattr__(self, name: str) -> Pattern:
+        # This is only called for missing attributes, i.e. RegEx that weren't used since they were unpickled
+        regex_source: tuple[str, int] | None = self.__dict__.get(f"{name}_source")
+        if regex_source is None:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+        regex: Pattern = compile_regex(*regex_source)
+        setattr(self, name, regex)
+
+        return regex
+
+
+# A list RegEx like 'neuesten Stand:\n- (?:.*\n- )*Plugin \((.+)\)' from the WordPress template
+LIST_REGEX_SHAPE = compile_regex(r"(?s)(?P<head>.*?)\(\?:\.\*(?P<separator>\\n.*?)\)\*(?P<tail>.*)")
+
+
+@dataclass
+class ListShape(LazyRegex):
+    """A RegEx of the form '<head>(?:.*<separator>)*<tail>' with literal head and separator.
+    Because '.' doesn't match newlines every repetition consumes exactly one line, so the
+    positions the tail can start at only depend on head and separator and not on the tail."""
+
+    head: str
+    separator: str
+    tail: Pattern
+    tail_prefix: str
+
+    regex_attributes = ("tail",)
+
+
+def get_list_shape(regex: str) -> ListShape | None:
+    """This returns the ListShape of the regex or None if it doesn't have this form"""
+
+    shape_match: Match | None = LIST_REGEX_SHAPE.fullmatch(regex)
+    if shape_match is None:
+        return None
+
+    head: str | None = get_literal_string(shape_match.group("head"))
+    separator: str | None = get_literal_string(shape_match.group("separator"))
+    if not head or not separator or not separator.startswith("\n"):
+        return None
+
+    try:
+        parsed_pattern = sre_parse.parse(regex)
+        tail: Pattern = compile_regex(shape_match.group("tail"))
+    except Exception:
+        return None
+
+    # Flags would change what '.' matches and the tail's groups must be the only ones. Without a group
+    # the rules use the whole match, which starts at the head and not where the tail matched
+    if parsed_pattern.state.flags & ~sre_constants.SRE_FLAG_UNICODE or parsed_pattern.state.groups != tail.groups + 1 or not tail.groups:
+        return None
+    if not is_self_contained(sre_parse.parse(shape_match.group("tail"))):
+        return None
+
+    return ListShape(head, separator, tail, get_literal_prefix(shape_match.group("tail")))
+
+
+class BodyScan:
+    """This holds the results of scanning one email body, so every rule that looks at the same
+    body shares them instead of scanning the whole body again"""
+
+    def __init__(self, body: str) -> None:
+        self.body: str = body
+        self.list_items: dict[tuple[str, str], list[tuple[list[int], list[tuple[str, int]]]]] = {}
+
+    def get_list_items(self, head: str, separator: str) -> list[tuple[list[int], list[tuple[str, int]]]]:
+        """This returns the lists that start with head and continue with separator in the body.
+        Every list is returned as the positions of its items and the sorted (line, item number) pairs."""
+
+        cache_key: tuple[str, str] = (head, separator)
+        if cache_key in self.list_items:
+            return self.list_items[cache_key]
+
+        body: str = self.body
+        found_lists: list[tuple[list[int], list[tuple[str, int]]]] = []
+
+        head_position: int = body.find(head)
+        while head_position != -1:
+            positions: list[int] = [head_position + len(head)]
+            while True:
+                newline_position: int = body.find("\n", positions[-1])
+                if newline_position == -1 or not body.startswith(separator, newline_position):
+                    break
+                positions.append(newline_position + len(separator))
+
+            lines: list[tuple[str, int]] = []
+            for item_number, position in enumerate(positions):
+                line_end: int = body.find("\n", position)
+                lines.append((body[position:line_end if line_end != -1 else len(body)], item_number))
+            lines.sort()
+
+            found_lists.append((positions, lines))
+            head_position = body.find(head, head_position + 1)
+
+        self.list_items[cache_key] = found_lists
+        return found_lists
+
+
+class BodyPattern(LazyRegex):
+    """A compiled ok/warn/crit RegEx. List RegEx are answered from the shared BodyScan
+    with the same result as a search() of the whole RegEx, everything else is searched directly."""
+
+    regex_attributes = ("regex",)
+
+    def __init__(self, regex: str) -> None:
+        self.regex: Pattern = compile_regex(regex)
+        self.list_shape: ListShape | None = get_list_shape(regex)
+        # List RegEx only run their tail through the RegEx engine
+        self.risks: list[str] = find_backtracking_risks(self.list_shape.tail.pattern if self.list_shape else regex)
+
+    def search(self, body_scan: BodyScan) -> Match | None:
+        """This returns the match of the RegEx in the body or None"""
+
+        if self.list_shape is None:
+            return self.regex.search(body_scan.body)
+
+        list_shape: ListShape = self.list_shape
+        tail_prefix: str = list_shape.tail_prefix
+
+        # search() returns the first head with a match, and the greedy repetition prefers the last item
+        for positions, lines in body_scan.get_list_items(list_shape.head, list_shape.separator):
+            if tail_prefix and "\n" not in tail_prefix:
+                item_numbers: list[int] = []
+                for line, item_number in lines[bisect_left(lines, (tail_prefix,)):]:
+                    if not line.startswith(tail_prefix):
+                        break
+                    item_numbers.append(item_number)
+            else:
+                item_numbers = list(range(len(positions)))
+
+            for item_number in sorted(item_numbers, reverse=True):
+                tail_match: Match | None = list_shape.tail.match(body_scan.body, positions[item_number])
+                if tail_match is not None:
+                    return tail_match
+
+        return None
+
+
+def get_regex_group(regex_match: Match) -> str:
+    """This returns the first capture group of the match, or the whole match if there is none"""
+
+    return regex_match.group(1) if regex_match.re.groups else regex_match.group(0)
+
+
+def evaluate_body_patterns(body_patterns: tuple[BodyPattern | None, BodyPattern | None, BodyPattern | None], body_scan: BodyScan) -> tuple[int, str] | None:
+    """This checks the body for the crit, warn and then ok pattern and stops at the first match.
+    It returns the status with the capture group of the match or None if nothing matches."""
+
+    for status, body_pattern in zip((2, 1, 0), body_patterns):
+        if body_pattern is None:
+            continue
+        body_match: Match | None = body_pattern.search(body_scan)
+        if body_match is not None:
+            return status, get_regex_group(body_match)
+
+    return None
+
+
+def evaluate_body_patterns_in_worker(body_patterns: tuple[BodyPattern | None, BodyPattern | None, BodyPattern | None], body: str) -> tuple[int, str] | None:
+    """This is evaluate_body_patterns() for the RuleGuard worker process, which only gets the body"""
+
+    return evaluate_body_patterns(body_patterns, BodyScan(body))
+
+
+@dataclass
+class ServiceRule(LazyRegex):
+    """A service config with everything needed for matching it read and compiled once"""
+
+    # The file name of the service config
+    source: str
+    config: SectionProxy
+    subject_regex: Pattern
+    # The literal every matching subject contains, "" if there is none
+    subject_literal: str
+    max_body_bytes: int | None
+    ok_pattern: BodyPattern | None
+    warn_pattern: BodyPattern | None
+    crit_pattern: BodyPattern | None
+    name: str
+    ok_details: str
+    warn_details: str
+    crit_details: str
+    warn_cycle: int
+    crit_cycle: int
+    value_name: str | None
+    value_regex: str | None
+
+    regex_attributes = ("subject_regex",)
+
+    def get_body_patterns(self) -> tuple[BodyPattern | None, BodyPattern | None, BodyPattern | None]:
+        """This returns the crit, warn and ok pattern in the order they are checked"""
+
+        return self.crit_pattern, self.warn_pattern, self.ok_pattern
+
+    def get_risks(self) -> list[str]:
+        """This returns the backtracking risks of all body patterns of the rule"""
+
+        return [risk for body_pattern in self.get_body_patterns() if body_pattern is not None for risk in body_pattern.risks]
+
+    def evaluate(self, body_scan: BodyScan) -> tuple[int, str] | None:
+        """This checks the body for crit, warn and then ok and stops at the first match.
+        It returns the status with the capture group of the match or None if nothing matches."""
+
+        return evaluate_body_patterns(self.get_body_patterns(), body_scan)
+
+
+class RuleGuard:
+    """This enforces a time budget per rule evaluation by running the rules in a worker process,
+    which is killed if a RegEx takes longer than the budget. Depending on guard_mode 'all' rules,
+    only the 'risky' ones with backtracking risks or no rules ('off') are guarded.
+    A rule that went over the budget is skipped for the rest of the run."""
+
+    def __init__(self, time_budget: float, guard_mode: str) -> None:
+        self.time_budget: float = time_budget
+        self.guard_mode: str = guard_mode
+        self.worker_pool: "PoolType | None" = None
+        self.rules_over_budget: list[str] = []
+
+    def is_guarded(self, service_rule: ServiceRule) -> bool:
+        """This checks if the rule has to be evaluated in the worker process"""
+
+        match self.guard_mode:
+            case "all":
+                return True
+            case "risky":
+                return bool(service_rule.get_risks())
+            case _:
+                return False
+
+    def evaluate(self, service_rule: ServiceRule, body_scan: BodyScan) -> tuple[int, str] | None:
+        """This evaluates the rule like ServiceRule.evaluate() but within the time budget,
+        None is returned if the rule doesn't match or went over the budget"""
+
+        if not self.is_guarded(service_rule):
+            return service_rule.evaluate(body_scan)
+
+        if service_rule.source in self.rules_over_budget:
+            return None
+
+        # multiprocessing is only imported once a guarded rule is evaluated
+        from multiprocessing import TimeoutError as PoolTimeoutError, get_context
+
+        if self.worker_pool is None:
+            # A forked worker could inherit a lock held by one of the AccountReceiver threads, so it's spawned.
+            # It only gets the picklable body patterns and the body and evaluates them with this module's functions.
+            self.worker_pool = get_context("spawn").Pool(1)
+            # The worker starts and imports this module before the first rule is timed, so the start-up
+            # of a slow host doesn't count against the time budget of the rule
+            self.worker_pool.apply(evaluate_body_patterns_in_worker, ((None, None, None), ""))
+
+        evaluation = self.worker_pool.apply_async(evaluate_body_patterns_in_worker, (service_rule.get_body_patterns(), body_scan.body))
+        try:
+            return evaluation.get(self.time_budget)
+        except PoolTimeoutError:
+            # The only way to stop a running RegEx is to kill the process
+            self.worker_pool.terminate()
+            self.worker_pool = None
+            self.rules_over_budget.append(service_rule.source)
+            return None
+
+    def close(self) -> None:
+        """This stops the worker process"""
+
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+            self.worker_pool.join()
+            self.worker_pool = None
+
+
+def build_rule_guard() -> RuleGuard:
+    """This creates the RuleGuard with the time budget and guard mode from the 'Rules' section"""
+
+    rules_config: SectionProxy = read_config_section("Rules")
+
+    return RuleGuard(rules_config.getfloat("time_budget", 2.0), rules_config.get("guard_rules", "risky"))
+
+
+def load_service_rules(service_configs: list[tuple[str, SectionProxy]]) -> list[ServiceRule]:
+    """This compiles the passed service configs with their file names into ServiceRule objects"""
+
+    service_rules: list[ServiceRule] = []
+
+    for config_name, service_config in service_configs:
+        email_subject_regex: str = service_config.get("email_subject_regex")
+        ok_regex: str | None = service_config.get("ok_regex")
+        warn_regex: str | None = service_config.get("warn_regex")
+        crit_regex: str | None = service_config.get("crit_regex")
+
+        service_rules.append(ServiceRule(
+            source=config_name,
+            config=service_config,
+            subject_regex=compile_regex(email_subject_regex),
+            subject_literal=get_required_literal(email_subject_regex),
+            max_body_bytes=service_config.getint("max_body_bytes"),
+            ok_pattern=BodyPattern(ok_regex) if ok_regex else None,
+            warn_pattern=BodyPattern(warn_regex) if warn_regex else None,
+            crit_pattern=BodyPattern(crit_regex) if crit_regex else None,
+            name=service_config.get("name", ""),
+            ok_details=service_config.get("ok_details", ""),
+            warn_details=service_config.get("warn_details", ""),
+            crit_details=service_config.get("crit_details", ""),
+            warn_cycle=service_config.getint("warn_cycle", 0),
+            crit_cycle=service_config.getint("crit_cycle", 0),
+            value_name=service_config.get("value_name"),
+            value_regex=service_config.get("value_regex"),
+        ))
+
+    return service_rules
+
+
+class AhoCorasick:
+    """An Aho-Corasick automaton that finds all of its literals in a text in one pass,
+    no matter how many literals there are"""
+
+    def __init__(self, literals: list[str]) -> None:
+        self.transitions: list[dict[str, int]] = [{}]
+        self.fail_states: list[int] = [0]
+        self.outputs: list[list[int]] = [[]]
+
+        # Build the trie of all literals
+        for literal_index, literal in enumerate(literals):
+            state: int = 0
+            for character in literal:
+                next_state: int | None = self.transitions[state].get(character)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions.append({})
+                    self.fail_states.append(0)
+                    self.outputs.append([])
+                    self.transitions[state][character] = next_state
+                state = next_state
+            self.outputs[state].append(literal_index)
+
+        # Link every state to the longest proper suffix that is also in the trie (breadth first)
+        queue: deque[int] = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.transitions[state].items():
+                queue.append(next_state)
+
+                fail_state: int = self.fail_states[state]
+                while fail_state and character not in self.transitions[fail_state]:
+                    fail_state = self.fail_states[fail_state]
+                fallback_state: int = self.transitions[fail_state].get(character, 0)
+
+                self.fail_states[next_state] = fallback_state if fallback_state != next_state else 0
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail_states[next_state]]
+
+    def find(self, text: str) -> set[int]:
+        """This returns the indexes of all literals that occur in the text"""
+
+        found: set[int] = set()
+        state: int = 0
+
+        for character in text:
+            while state and character not in self.transitions[state]:
+                state = self.fail_states[state]
+            state = self.transitions[state].get(character, 0)
+            if self.outputs[state]:
+                found.update(self.outputs[state])
+
+        return found
+
+
+def get_rule_set_hash(service_rules: list[ServiceRule]) -> str:
+    """This returns a hash of the file names and the options of all service configs,
+    it changes whenever a service config is added, removed or changed"""
+
+    rule_set_hash = hashlib.sha256()
+    for service_rule in service_rules:
+        rule_set_hash.update(repr((service_rule.source, sorted(service_rule.config.items()))).encode("utf-8", "surrogatepass"))
+
+    return rule_set_hash.hexdigest()
+
+
+class SubjectIndex:
+    """This groups the service rules by the literal their subject regex requires. A subject is scanned
+    once for all literals and only the rules of the found literals and the rules without a literal
+    are matched with their full RegEx, so the cost scales with the candidates instead of all rules."""
+
+    def __init__(self, service_rules: list[ServiceRule]) -> None:
+        self.service_rules: list[ServiceRule] = service_rules
+        # Emails without service only have to be evaluated again if this changes
+        self.rule_set_hash: str = get_rule_set_hash(service_rules)
+
+        literal_rules: dict[str, list[int]] = {}
+        self.rules_without_literal: list[int] = []
+        for rule_index, service_rule in enumerate(service_rules):
+            if service_rule.subject_literal:
+                literal_rules.setdefault(service_rule.subject_literal, []).append(rule_index)
+            else:
+                self.rules_without_literal.append(rule_index)
+
+        self.literals: list[str] = list(literal_rules)
+        self.literal_rules: list[list[int]] = list(literal_rules.values())
+        self.automaton: AhoCorasick = AhoCorasick(self.literals)
+
+    def get_candidates(self, subject: str) -> list[ServiceRule]:
+        """This returns the rules that could match the subject in the order of the service configs"""
+
+        candidate_indexes: list[int] = list(self.rules_without_literal)
+        for literal_index in self.automaton.find(subject):
+            candidate_indexes += self.literal_rules[literal_index]
+
+        return [self.service_rules[rule_index] for rule_index in sorted(candidate_indexes)]
+
+    def match(self, subject: str) -> list[tuple[ServiceRule, Match]]:
+        """This returns every rule whose subject regex matches the subject with its match"""
+
+        matches: list[tuple[ServiceRule, Match]] = []
+
+        for service_rule in self.get_candidates(subject):
+            subject_match: Match | None = service_rule.subject_regex.search(subject)
+            if subject_match is not None:
+                matches.append((service_rule, subject_match))
+
+        return matches
+
+
+def get_service_configs_fingerprint() -> list[tuple[str, int, int]]:
+    """This returns the file name, modification time and size of every service config file,
+    the cached rules are only used as long as the fingerprint doesn't change"""
+
+    fingerprint: list[tuple[str, int, int]] = []
+    for config_file in sorted(Path("config/services").glob("*.cfg")):
+        config_stat: os.stat_result = config_file.stat()
+        fingerprint.append((config_file.name, config_stat.st_mtime_ns, config_stat.st_size))
+
+    return fingerprint
+
+
+def read_rules_cache(fingerprint: list[tuple[str, int, int]]) -> SubjectIndex | None:
+    """This loads the subject index from the rules cache in one read,
+    None is returned if there is no cache or it was written for other service configs"""
+
+    try:
+        cache_file = BytesIO(RULES_CACHE_PATH.read_bytes())
+        unpickler = pickle.Unpickler(cache_file)
+        # The header is checked before the rules are unpickled
+        if unpickler.load() != (RULES_CACHE_VERSION, fingerprint):
+            return None
+        subject_index = unpickler.load()
+    except Exception:
+        # A missing, truncated or incompatible cache is simply rebuilt
+        return None
+
+    return subject_index if isinstance(subject_index, SubjectIndex) else None
+
+
+def write_rules_cache(fingerprint: list[tuple[str, int, int]], subject_index: SubjectIndex) -> None:
+    """This replaces the rules cache atomically, if the state directory isn't writable the rules
+    are compiled again in the next run"""
+
+    cache_file = BytesIO()
+    pickler = pickle.Pickler(cache_file, pickle.HIGHEST_PROTOCOL)
+    pickler.dump((RULES_CACHE_VERSION, fingerprint))
+    pickler.dump(subject_index)
+
+    temporary_path: Path = RULES_CACHE_PATH.with_name(f"{RULES_CACHE_PATH.name}.{os.getpid()}.tmp")
+    try:
+        temporary_path.write_bytes(cache_file.getvalue())
+        os.replace(temporary_path, RULES_CACHE_PATH)
+    except OSError:
+        temporary_path.unlink(missing_ok=True)
+
+
+def build_subject_index() -> SubjectIndex:
+    """This returns the subject index over all service configs. It is loaded from the rules cache
+    if no service config changed since the cache was written, otherwise the service configs are
+    read and compiled again and the cache is replaced."""
+
+    # The fingerprint is taken first, so a config that changes while it is read invalidates the cache
+    fingerprint: list[tuple[str, int, int]] = get_service_configs_fingerprint()
+
+    subject_index: SubjectIndex | None = read_rules_cache(fingerprint)
+    if subject_index is None:
+        subject_index = SubjectIndex(load_service_rules(read_service_configs()))
+        write_rules_cache(fingerprint, subject_index)
+
+    return subject_index
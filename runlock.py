@@ -0,0 +1,94 @@
+# This module makes sure only one run of Mail2CheckMk fetches the mails and changes the state store at a time.
+# A run holds an exclusive flock on ./state/run.lock, which the kernel releases when the run ends or dies,
+# so a crashed run never blocks the next one. The lock file names the PID and the start of the run holding it,
+# a run that holds the lock longer than stale_lock_seconds is reported as hanging.
+
+import fcntl
+import os
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+from typing import Iterator, TextIO
+
+LOCK_PATH = Path("state/run.lock")
+
+
+class RunLock:
+    """The lock of the run, acquire() doesn't wait for a run that already holds it"""
+
+    def __init__(self, path: Path = LOCK_PATH) -> None:
+        self.path: Path = path
+        self.lock_file: TextIO | None = None
+
+    def acquire(self) -> bool:
+        """This takes the lock and writes the PID and start time of this run to it, False is returned if another run holds it"""
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lock_file: TextIO = self.path.open("a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        lock_file.truncate(0)
+        lock_file.write(f"{os.getpid()} {time()}\n")
+        lock_file.flush()
+        self.lock_file = lock_file
+
+        return True
+
+    def release(self) -> None:
+        if self.lock_file is None:
+            return
+
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+    def get_holder(self) -> tuple[int, float] | None:
+        """This returns the PID and start time of the run holding the lock, None if the lock file doesn't name one (yet)"""
+
+        try:
+            pid, started = self.path.read_text().split()
+            return int(pid), float(started)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+def acquire_or_exit(run_lock: RunLock) -> None:
+    """This takes the lock for an entry point that can't wait for the other run, if that holds it the process exits with a message"""
+
+    if not run_lock.acquire():
+        holder: tuple[int, float] | None = run_lock.get_holder()
+        print(f"Another run of Mail2CheckMk (PID {holder[0] if holder else 'unknown'}) holds {run_lock.path}, exiting", file=sys.stderr)
+        raise SystemExit(1)
+
+
+@contextmanager
+def hold_run_lock() -> Iterator[RunLock]:
+    """This holds the lock while a script that changes the state store runs on its own, see acquire_or_exit()"""
+
+    run_lock = RunLock()
+    acquire_or_exit(run_lock)
+    try:
+        yield run_lock
+    finally:
+        run_lock.release()
+
+
+def get_lock_service_line(holder: tuple[int, float] | None, stale_lock_seconds: float, now: float | None = None) -> str:
+    """This returns the local check line that reports the run holding the lock, CRIT if it holds it longer than stale_lock_seconds"""
+
+    if holder is None:
+        return "0 Mail2CheckMK-000Run-lock - Another run is starting, the output of the last complete run is shown\n"
+
+    now = time() if now is None else now
+    pid, started = holder
+    run_seconds: int = max(0, int(now - started))
+    if run_seconds > stale_lock_seconds:
+        return (f"2 Mail2CheckMK-000Run-lock run_seconds={run_seconds} The run with PID {pid} has been holding the lock for {run_seconds} seconds, "
+                f"it probably hangs and the output of the last complete run is shown\n")
+
+    return f"0 Mail2CheckMK-000Run-lock run_seconds={run_seconds} The run with PID {pid} is still running, the output of the last complete run is shown\n"
@@ -1,127 +1,154 @@
-# This module prints the contents of the service files in ./service-files
-# to standard out to send them to Checkmk
+# This module prints the latest state of the services in the state store
+# to standard out to send them to Checkmk or writes it to the output file of the daemon.
+# Every printed output is also saved as a snapshot, which is printed instead
+# while another run holds the lock or the last run is younger than cache_interval
 
 import os
+import sys
 from pathlib import Path
-from re import sub
+from time import time
 
+from statestore import StateStore, StoredService
+from runlock import hold_run_lock
 
-def get_service_files() -> list[Path]:
-    """This returns a sorted list of every text file in service-files/ as Path objects"""
-    service_files_with_timestamp: list[tuple[Path, float]] = []
+SNAPSHOT_PATH = Path("state/last-output.txt")
 
-    for file in Path("service-files").glob("*.txt"):
-        # This gets the timestamp from the filename
-        timestamp: float = float(file.stem.split("_")[-1].replace(",", "."))
-        service_files_with_timestamp.append((file, timestamp))
-    
-    sorted_service_files = sorted(service_files_with_timestamp, key=lambda x: x[1])
 
-    # This returns the first element of the tuple t[0] for every tuple in sorted_service_files_with_timestamps
-    return [t[0] for t in sorted_service_files]
+def get_services(store: StateStore) -> list[StoredService]:
+    """This returns the latest state of every service, sorted by the time they were updated"""
 
+    return store.get_services()
 
-def mark_for_deletion(service_file_path: Path):
-    """This marks a service file for deletion"""
-    
-    lines: list[str] = []
-    with open(service_file_path, "r") as f:
-        lines = f.readlines()
 
-    lines[0] = lines[0].replace("False", "True")
-    with open(service_file_path, "w") as f:
-        f.writelines(lines)
+def mark_for_deletion(services: list[StoredService], store: StateStore) -> None:
+    """This marks the services for deletion"""
 
+    store.set_service_flags([service.name for service in services], delete=True)
 
 
-def filter_duplicate_services(service_files: list[Path]) -> list[Path]:
-    """This makes sure that only the latest service file exists"""
+def update_stale_services(store: StateStore) -> None:
+    """This sets the services that didn't get a new mail within their warn_cycle or crit_cycle to WARN or CRIT"""
 
-    filtered_service_files: list[Path] = []
-    seen_service_names: list[str] = []
-    
+    store.expire_service_deadlines()
 
-    for service in reversed(service_files):
-        service_name = sub(r"_\d{10,},\d*", "", service.stem)
-        
-        if service_name in seen_service_names:
-            # os.remove(service)
-            service.unlink()
-        else:
-            filtered_service_files.append(service)
 
-        seen_service_names.append(service_name)
+def send_to_checkmk(output: str) -> None:
+    """This writes the rendered checkmk output to standard out in one call"""
 
-    filtered_service_files.reverse()
+    sys.stdout.write(output)
+    sys.stdout.flush()
 
-    return filtered_service_files
 
+def write_output_file(output: str, output_path: Path) -> None:
+    """This atomically replaces the output file, so mail2checkmk.sh never prints a half written file"""
 
-def send_to_checkmk(service_files: list[Path]) -> None:
-    """This prints the checkmk output line to standard out if send (second line) is set to True"""
+    temporary_path: Path = output_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as output_file:
+        output_file.write(output)
+        output_file.flush()
+        os.fsync(output_file.fileno())
+    os.replace(temporary_path, output_path)
 
-    for file in service_files:
-        lines: list[str] = file.read_text().splitlines()
-        if "True" in lines[1]:
-            checkmk_output: str = lines[2]
-            print(checkmk_output)
 
+def add_cached_headers(output: str, timestamp: float, cache_interval: int) -> str:
+    """This prefixes every line with the cached(<timestamp>,<interval>) header of Checkmk local checks,
+    so Checkmk knows the services were checked at timestamp and only become stale after the interval"""
 
-def mark_services_with_ok_status_for_deletion(filtered_service_files: list[Path]) -> None:
-    """This sends any service file that has a 0 status code to mark_for_deletion()"""
-    
-    for file in filtered_service_files:
-        lines: list[str] = []
-        with open(file, "r") as f:
-            lines = f.readlines()
-        # The status code of a service file is saved in the first position of the second line
-        if lines[2][0] == "0":
-            mark_for_deletion(file)
+    if cache_interval <= 0:
+        return output
 
+    header: str = f"cached({int(timestamp)},{cache_interval}) "
 
-def delete_service_files(service_files: list[Path]) -> None:
-    """This deletes every file that has been marked for deletion"""
+    return "".join(f"{header}{line}" for line in output.splitlines(keepends=True))
 
-    for file in service_files:
-        lines: list[str] = []
-        with open(file, "r") as f:
-            lines: list[str] = f.readlines()
-        if "True" in lines[0]:
-            os.remove(file.absolute().as_posix())
 
-def delete_mail2checkmk_services(service_files: list[Path]) -> None:
-    "This deletes any service file that has Mail2CheckMK in it's name."
+def get_snapshot_age(snapshot_path: Path = SNAPSHOT_PATH) -> float | None:
+    """This returns how many seconds ago the snapshot was written, None if there is none"""
 
-    for service in service_files:
-        if "[Mail2CheckMK]" in service.stem:
-            service.unlink()
+    try:
+        return time() - snapshot_path.stat().st_mtime
+    except FileNotFoundError:
+        return None
 
 
-def dont_send_anymore(service_files: list[Path]) -> None:
-    """This marks any remaining files to not send to CheckMK anymore
+def send_snapshot(cache_interval: int = 0, snapshot_path: Path = SNAPSHOT_PATH) -> None:
+    """This sends the output of the last complete run to Checkmk without touching the state store.
+    With a cache interval it's marked with the time it was written, nothing is sent if there is no snapshot."""
+
+    try:
+        output: str = snapshot_path.read_text()
+        written: float = snapshot_path.stat().st_mtime
+    except FileNotFoundError:
+        return
+
+    send_to_checkmk(add_cached_headers(output, written, cache_interval))
+
+
+def mark_services_with_ok_status_for_deletion(services: list[StoredService], store: StateStore) -> None:
+    """This sends any service that has a 0 status code to mark_for_deletion()"""
+
+    mark_for_deletion([service for service in services if service.status == 0], store)
+
+
+def delete_services(services: list[StoredService], store: StateStore) -> None:
+    """This deletes every service that has been marked for deletion"""
+
+    store.delete_services([service.name for service in services if service.delete])
+
+
+def delete_mail2checkmk_services(store: StateStore) -> None:
+    "This deletes any service that has Mail2CheckMK in it's name."
+
+    store.delete_services_containing("[Mail2CheckMK]")
+
+
+def dont_send_anymore(services: list[StoredService], store: StateStore) -> None:
+    """This marks any remaining services to not send to CheckMK anymore
     to prevent the same error flooding checkmk"""
 
-    for file in service_files:
-        if file.exists():
-            lines: list[str] = []
-            with open(file, "r") as f:
-                lines = f.readlines()
-            lines[1] = lines[1].replace("True", "False")
-            with open(file, "w") as f:
-                f.writelines(lines)
+    store.set_service_flags([service.name for service in services], send=False)
 
 
-def main() -> None:
-    service_files: list[Path] = get_service_files()
-    filtered_service_files: list[Path] = filter_duplicate_services(service_files)
-    send_to_checkmk(filtered_service_files)
-    # mark_services_with_ok_status_for_deletion(filtered_service_files)
-    # delete_service_files(filtered_service_files)
-    delete_mail2checkmk_services(filtered_service_files)
-    # dont_send_anymore(service_files)
+def clean_up(store: StateStore) -> None:
+    """This cleans up the services after they were sent, the disabled steps need every service
+    and read them with get_services() once if they are enabled again"""
 
+    # services: list[StoredService] = get_services(store)
+    # mark_services_with_ok_status_for_deletion(services, store)
+    # delete_services(services, store)
+    delete_mail2checkmk_services(store)
+    # dont_send_anymore(services, store)
 
 
-if __name__ == "__main__":
-    main()
+def send_and_clean_up(store: StateStore, cache_interval: int = 0) -> None:
+    """This sends the latest state of every service to CheckMK, saves it as the snapshot and cleans up the services afterwards.
+    The changes are committed together after the output was sent, if sending fails the services stay as they were."""
+
+    with store.transaction():
+        update_stale_services(store)
+        output: str = store.render_services()
+        write_output_file(output, SNAPSHOT_PATH)
+        send_to_checkmk(add_cached_headers(output, time(), cache_interval))
+        clean_up(store)
+
+
+def write_and_clean_up(store: StateStore, output_path: Path) -> None:
+    """This writes the latest state of every service to the output file and cleans up the services afterwards"""
+
+    with store.transaction():
+        update_stale_services(store)
+        write_output_file(store.render_services(), output_path)
+        clean_up(store)
 
+
+def main(cache_interval: int = 0) -> None:
+    store = StateStore()
+    send_and_clean_up(store, cache_interval)
+    store.close()
+
+
+
+if __name__ == "__main__":
+    # main.py already holds the lock when it calls main(), on its own the script has to take it
+    with hold_run_lock():
+        main()
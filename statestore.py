@@ -0,0 +1,441 @@
+# This module keeps the state of Mail2CheckMk in a single SQLite database in ./state:
+# the downloaded emails that still have to be processed or have no service,
+# the latest state of every service with its send and delete flags,
+# the keys of the processed mails the dedup cache remembers
+# and the index of the mail archive in ./state/archive, see archive.py
+
+import os
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+from time import time
+
+from models import BODY_NOT_DOWNLOADED, Email, Service
+
+STATE_STORE_PATH = Path("state/mail2checkmk.sqlite3")
+
+# Every entry upgrades the schema by one version, PRAGMA user_version holds the current version
+SCHEMA_MIGRATIONS: list[str] = [
+    """
+    CREATE TABLE mails (
+        id INTEGER PRIMARY KEY,
+        received REAL NOT NULL,
+        from_field TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        truncated INTEGER NOT NULL DEFAULT 0,
+        -- 'pending' until it was processed once, 'without-service' if no service applied
+        state TEXT NOT NULL DEFAULT 'pending'
+    );
+    CREATE INDEX mails_by_state ON mails (state, received);
+
+    CREATE TABLE services (
+        name TEXT PRIMARY KEY,
+        status INTEGER NOT NULL,
+        output TEXT NOT NULL,
+        send INTEGER NOT NULL,
+        delete_flag INTEGER NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE INDEX services_by_updated ON services (updated);
+    """,
+    # The output only contains the services that are still sent, rendering it reads only them
+    """
+    CREATE INDEX services_to_send ON services (updated) WHERE send = 1;
+    """,
+    # The deadlines of warn_cycle and crit_cycle with the output lines the service gets after them
+    """
+    ALTER TABLE services ADD COLUMN warn_deadline REAL;
+    ALTER TABLE services ADD COLUMN crit_deadline REAL;
+    ALTER TABLE services ADD COLUMN warn_output TEXT;
+    ALTER TABLE services ADD COLUMN crit_output TEXT;
+    -- The earliest deadline that hasn't passed yet, NULL if the service can't go stale anymore
+    ALTER TABLE services ADD COLUMN next_deadline REAL;
+    CREATE INDEX services_by_deadline ON services (next_deadline) WHERE next_deadline IS NOT NULL;
+    """,
+    # The entries of the dedup cache, see dedup.py
+    """
+    CREATE TABLE seen_mails (
+        key TEXT PRIMARY KEY,
+        first_seen REAL NOT NULL,
+        last_seen REAL NOT NULL
+    );
+    """,
+    # The hash of the service configs an email without service was last evaluated with, see SubjectIndex.rule_set_hash
+    """
+    ALTER TABLE mails ADD COLUMN rule_set TEXT;
+    """,
+    # The segments of the mail archive and where every archived email is in them
+    """
+    CREATE TABLE archive_segments (
+        name TEXT PRIMARY KEY,
+        started REAL NOT NULL,
+        newest REAL NOT NULL,
+        size INTEGER NOT NULL
+    );
+
+    CREATE TABLE archived_mails (
+        segment TEXT NOT NULL,
+        -- The offset of the gzip member with the email in the segment and its line in the member
+        member_offset INTEGER NOT NULL,
+        line INTEGER NOT NULL,
+        received REAL NOT NULL,
+        state TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        -- One row per service the email set, NULL if it had none
+        service TEXT
+    );
+    CREATE INDEX archived_mails_by_segment ON archived_mails (segment);
+    CREATE INDEX archived_mails_by_received ON archived_mails (received);
+    CREATE INDEX archived_mails_by_subject ON archived_mails (subject);
+    CREATE INDEX archived_mails_by_service ON archived_mails (service) WHERE service IS NOT NULL;
+    """,
+]
+
+
+def build_mail_filter(states: tuple[str, ...], skip_rule_set: str | None, received_before: float | None = None, headers_only: bool | None = None) -> tuple[str, tuple]:
+    """This returns the WHERE condition and its parameters for the mails in the states,
+    without the mails without service that were already evaluated with the skip_rule_set hash
+    and only with the mails received before received_before if it's passed.
+    headers_only True only keeps the mails whose body wasn't downloaded, False leaves them out."""
+
+    condition: str = f"state IN ({', '.join('?' for _ in states)})"
+    parameters: tuple = states
+    if skip_rule_set is not None:
+        condition += " AND (state != 'without-service' OR rule_set IS NOT ?)"
+        parameters += (skip_rule_set,)
+    if headers_only is not None:
+        condition += " AND body = ?" if headers_only else " AND body != ?"
+        parameters += (BODY_NOT_DOWNLOADED,)
+    if received_before is not None:
+        condition += " AND received < ?"
+        parameters += (received_before,)
+
+    return condition, parameters
+
+
+@dataclass
+class StoredMail:
+    """An email in the state store with the time it was received,
+    emails that were passed in memory and aren't saved yet have no id"""
+
+    id: int | None
+    received: float
+    email: Email
+    state: str
+
+
+@dataclass
+class StoredService:
+    """The latest state of a service in the state store"""
+
+    name: str
+    status: int
+    output: str
+    send: bool
+    delete: bool
+    updated: float
+
+
+@dataclass
+class ArchiveSegment:
+    """A segment file of the mail archive with the time it was started,
+    the time the newest email in it was archived and its size in bytes"""
+
+    name: str
+    started: float
+    newest: float
+    size: int
+
+
+class StateStore:
+    """This wraps the SQLite database, every method that changes something runs in one transaction.
+    Within transaction() the changes of several methods are committed together."""
+
+    def __init__(self, path: Path = STATE_STORE_PATH) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection: sqlite3.Connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # With WAL this is still crash safe, only the last transactions can be lost on power loss
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.transaction_depth: int = 0
+        self.migrate_schema()
+
+    def migrate_schema(self) -> None:
+        """This applies every schema migration the database doesn't have yet"""
+
+        schema_version: int = self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+        for version, migration in enumerate(SCHEMA_MIGRATIONS[schema_version:], start=schema_version + 1):
+            self.connection.executescript(f"BEGIN; {migration}; PRAGMA user_version = {version}; COMMIT;")
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """This commits every change made in the block at once at its end or none of them if it raises.
+        A transaction inside another one joins it, so the methods can be grouped without committing early."""
+
+        if self.transaction_depth > 0:
+            self.transaction_depth += 1
+            try:
+                yield
+            finally:
+                self.transaction_depth -= 1
+            return
+
+        self.transaction_depth = 1
+        try:
+            with self.connection:
+                yield
+        finally:
+            self.transaction_depth = 0
+
+    def add_mails(self, emails: list[Email], received: float | None = None, state: str = "pending", rule_set: str | None = None) -> int:
+        """This saves the emails in the passed state and returns how many were saved,
+        emails without service are saved with the hash of the service configs they were evaluated with"""
+
+        received = time() if received is None else received
+        with self.transaction():
+            self.connection.executemany(
+                "INSERT INTO mails (received, from_field, subject, body, truncated, state, rule_set) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(received, email.from_field, email.subject, email.body, email.truncated, state, rule_set) for email in emails])
+
+        return len(emails)
+
+    def get_mails(self, states: tuple[str, ...] = ("pending", "without-service")) -> list[StoredMail]:
+        """This returns the mails in the passed states, oldest first"""
+
+        placeholders: str = ", ".join("?" for _ in states)
+        rows = self.connection.execute(
+            f"SELECT id, received, from_field, subject, body, truncated, state FROM mails WHERE state IN ({placeholders}) ORDER BY received, id",
+            states)
+
+        return [StoredMail(mail_id, received, Email(from_field, subject, body, bool(truncated)), state)
+                for mail_id, received, from_field, subject, body, truncated, state in rows]
+
+    def iter_mails(self, states: tuple[str, ...] = ("pending", "without-service"), batch_size: int = 500, skip_rule_set: str | None = None,
+                   received_before: float | None = None, headers_only: bool | None = None) -> Iterator[list[StoredMail]]:
+        """This yields the mails in the passed states in batches of batch_size, oldest first.
+        The batches are read one after another, so mails of a yielded batch can be changed or deleted.
+        Mails without service that were already evaluated with the skip_rule_set hash are left out, see build_mail_filter()."""
+
+        mail_filter, filter_parameters = build_mail_filter(states, skip_rule_set, received_before, headers_only)
+        last_id: int = 0
+
+        while True:
+            rows = self.connection.execute(
+                f"SELECT id, received, from_field, subject, body, truncated, state FROM mails WHERE {mail_filter} AND id > ? ORDER BY id LIMIT ?",
+                (*filter_parameters, last_id, batch_size)).fetchall()
+            if not rows:
+                return
+
+            last_id = rows[-1][0]
+            yield [StoredMail(mail_id, received, Email(from_field, subject, body, bool(truncated)), state)
+                   for mail_id, received, from_field, subject, body, truncated, state in rows]
+
+    def count_mails(self, states: tuple[str, ...] = ("pending", "without-service"), skip_rule_set: str | None = None, headers_only: bool | None = None) -> int:
+        """This returns how many mails iter_mails() would yield with the same arguments"""
+
+        mail_filter, filter_parameters = build_mail_filter(states, skip_rule_set, headers_only=headers_only)
+
+        return self.connection.execute(f"SELECT count(*) FROM mails WHERE {mail_filter}", filter_parameters).fetchone()[0]
+
+    def delete_mails(self, mail_ids: list[int]) -> None:
+        """This deletes the mails, e.g. because a service was created from them"""
+
+        with self.transaction():
+            self.connection.executemany("DELETE FROM mails WHERE id = ?", [(mail_id,) for mail_id in mail_ids])
+
+    def mark_mails_without_service(self, mail_ids: list[int], rule_set: str | None = None) -> None:
+        """This marks the mails as having no service with the service configs of the rule_set hash"""
+
+        with self.transaction():
+            self.connection.executemany("UPDATE mails SET state = 'without-service', rule_set = ? WHERE id = ?", [(rule_set, mail_id) for mail_id in mail_ids])
+
+    def save_services(self, services: list[Service], updated: float | None = None) -> None:
+        """This replaces the latest state of every passed service, if a name is passed more than once
+        only its last service is written, at the position it would have had after replacing the others"""
+
+        updated = time() if updated is None else updated
+        latest_services: dict[str, Service] = {}
+        for service in services:
+            latest_services.pop(service.name, None)
+            latest_services[service.name] = service
+
+        rows: list[tuple] = []
+        for service in latest_services.values():
+            deadlines: list[float] = [deadline for deadline in (service.warn_deadline, service.crit_deadline) if deadline is not None]
+            rows.append((service.name, service.status, service.get_checkmk_output(), service.send, service.delete, updated,
+                         service.warn_deadline, service.crit_deadline,
+                         service.get_checkmk_output(1, service.warn_cycle_details) if service.warn_deadline is not None else None,
+                         service.get_checkmk_output(2, service.crit_cycle_details) if service.crit_deadline is not None else None,
+                         min(deadlines, default=None)))
+
+        with self.transaction():
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO services (name, status, output, send, delete_flag, updated, warn_deadline, crit_deadline, warn_output, crit_output, next_deadline) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def get_services(self) -> list[StoredService]:
+        """This returns the latest state of every service, least recently updated first"""
+
+        rows = self.connection.execute("SELECT name, status, output, send, delete_flag, updated FROM services ORDER BY updated, rowid")
+
+        return [StoredService(name, status, output, bool(send), bool(delete_flag), updated)
+                for name, status, output, send, delete_flag, updated in rows]
+
+    def expire_service_deadlines(self, now: float | None = None) -> list[str]:
+        """This sets every service whose next deadline passed to the status of that deadline and returns their names.
+        Only the services with a passed deadline are read, with the index on next_deadline."""
+
+        now = time() if now is None else now
+        with self.transaction():
+            rows = self.connection.execute(
+                "SELECT name, crit_deadline, warn_output, crit_output FROM services WHERE next_deadline <= ? ORDER BY next_deadline",
+                (now,)).fetchall()
+
+            updates: list[tuple] = []
+            for name, crit_deadline, warn_output, crit_output in rows:
+                if crit_deadline is not None and crit_deadline <= now:
+                    updates.append((2, crit_output, None, now, name))
+                else:
+                    # Only the warn deadline passed, the crit deadline (if any) is the next one
+                    updates.append((1, warn_output, crit_deadline, now, name))
+            self.connection.executemany("UPDATE services SET status = ?, output = ?, next_deadline = ?, updated = ? WHERE name = ?", updates)
+
+        return [name for name, *_ in rows]
+
+    def render_services(self) -> str:
+        """This returns the output lines of every service that has send set, least recently updated first, as one string"""
+
+        rows = self.connection.execute("SELECT output FROM services WHERE send = 1 ORDER BY updated, rowid")
+
+        return "".join(f"{output}\n" for (output,) in rows)
+
+    def set_service_flags(self, names: list[str], send: bool | None = None, delete: bool | None = None) -> None:
+        """This sets the send and/or delete flag of the named services"""
+
+        with self.transaction():
+            if send is not None:
+                self.connection.executemany("UPDATE services SET send = ? WHERE name = ?", [(send, name) for name in names])
+            if delete is not None:
+                self.connection.executemany("UPDATE services SET delete_flag = ? WHERE name = ?", [(delete, name) for name in names])
+
+    def delete_services(self, names: list[str]) -> None:
+        """This deletes the named services"""
+
+        with self.transaction():
+            self.connection.executemany("DELETE FROM services WHERE name = ?", [(name,) for name in names])
+
+    def delete_services_containing(self, text: str) -> None:
+        """This deletes every service that has the text in its name"""
+
+        with self.transaction():
+            self.connection.execute("DELETE FROM services WHERE instr(name, ?) > 0", (text,))
+
+    def get_seen_mails(self) -> dict[str, tuple[float, float]]:
+        """This returns the entries of the dedup cache with the time they were first and last seen"""
+
+        rows = self.connection.execute("SELECT key, first_seen, last_seen FROM seen_mails")
+
+        return {key: (first_seen, last_seen) for key, first_seen, last_seen in rows}
+
+    def save_seen_mails(self, entries: dict[str, tuple[float, float]]) -> None:
+        """This replaces the entries of the dedup cache"""
+
+        with self.transaction():
+            self.connection.execute("DELETE FROM seen_mails")
+            self.connection.executemany("INSERT INTO seen_mails (key, first_seen, last_seen) VALUES (?, ?, ?)",
+                                        [(key, first_seen, last_seen) for key, (first_seen, last_seen) in entries.items()])
+
+    def get_archive_segments(self) -> list[ArchiveSegment]:
+        """This returns the segments of the mail archive, oldest first"""
+
+        rows = self.connection.execute("SELECT name, started, newest, size FROM archive_segments ORDER BY started, name")
+
+        return [ArchiveSegment(*row) for row in rows]
+
+    def save_archive_member(self, segment: ArchiveSegment, member_offset: int, entries: list[tuple[int, float, str, str, str | None]]) -> None:
+        """This saves the segment and indexes the emails of the gzip member at member_offset in it,
+        every entry is the line, the received time, the state, the subject and a service of an email"""
+
+        with self.transaction():
+            self.connection.execute("INSERT OR REPLACE INTO archive_segments (name, started, newest, size) VALUES (?, ?, ?, ?)",
+                                    (segment.name, segment.started, segment.newest, segment.size))
+            self.connection.executemany(
+                "INSERT INTO archived_mails (segment, member_offset, line, received, state, subject, service) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(segment.name, member_offset, *entry) for entry in entries])
+
+    def find_archived_mails(self, subject: str | None = None, service: str | None = None,
+                            received_after: float | None = None, received_before: float | None = None) -> list[tuple[str, int, int]]:
+        """This returns the segment, member offset and line of the archived emails with the subject,
+        that set the service and were received in the time range, in the order they were archived"""
+
+        conditions: list[str] = ["1"]
+        parameters: list = []
+        for condition, parameter in (("subject = ?", subject), ("service = ?", service),
+                                     ("received >= ?", received_after), ("received < ?", received_before)):
+            if parameter is not None:
+                conditions.append(condition)
+                parameters.append(parameter)
+
+        rows = self.connection.execute(
+            f"SELECT DISTINCT archived_mails.segment, member_offset, line FROM archived_mails JOIN archive_segments ON archive_segments.name = archived_mails.segment "
+            f"WHERE {' AND '.join(conditions)} ORDER BY archive_segments.started, archived_mails.segment, member_offset, line", parameters)
+
+        return rows.fetchall()
+
+    def delete_archive_segments(self, names: list[str]) -> None:
+        """This deletes the segments and the index of their emails"""
+
+        with self.transaction():
+            self.connection.executemany("DELETE FROM archived_mails WHERE segment = ?", [(name,) for name in names])
+            self.connection.executemany("DELETE FROM archive_segments WHERE name = ?", [(name,) for name in names])
+
+
+def read_plaintext_email(email_path: Path) -> Email:
+    """This reads a plaintext email file of the old spool directory"""
+
+    email_text: str = email_path.read_text()
+    # We keepends here because we want them for the mail body but strip them from the From field and the subject
+    email_line_list: list[str] = email_text.splitlines(keepends=True)
+
+    return Email(email_line_list[0].strip(), email_line_list[2].strip(), "".join(email_line_list[4:]))
+
+
+def get_spool_timestamp(spool_file: Path) -> float:
+    """This returns the unix timestamp the old spool saved in the filename with a ',' as the seperator"""
+
+    return float(spool_file.stem.split("_")[-1].replace(",", "."))
+
+
+def migrate_spool(store: StateStore, plaintext_email_directory: Path = Path("plaintext-emails"), service_file_directory: Path = Path("service-files")) -> None:
+    """This imports the plaintext-emails and service-files directories of older versions into the store once
+    and renames them to '<directory>.migrated' afterwards, so nothing is imported twice"""
+
+    if plaintext_email_directory.is_dir():
+        with store.connection:
+            for email_path in sorted(plaintext_email_directory.rglob("*.txt"), key=get_spool_timestamp):
+                email: Email = read_plaintext_email(email_path)
+                store.connection.execute(
+                    "INSERT INTO mails (received, from_field, subject, body, state) VALUES (?, ?, ?, ?, ?)",
+                    (get_spool_timestamp(email_path), email.from_field, email.subject, email.body,
+                     "without-service" if email_path.parent.name == "without-service" else "pending"))
+        os.rename(plaintext_email_directory, plaintext_email_directory.with_name(f"{plaintext_email_directory.name}.migrated"))
+
+    if service_file_directory.is_dir():
+        with store.connection:
+            # Older files come first, so the latest file of every service wins
+            for service_file in sorted(service_file_directory.glob("*.txt"), key=get_spool_timestamp):
+                lines: list[str] = service_file.read_text().splitlines()
+                if len(lines) < 3:
+                    continue
+                status, name = lines[2].split(" ", 2)[:2]
+                store.connection.execute(
+                    "INSERT OR REPLACE INTO services (name, status, output, send, delete_flag, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, int(status) if status.isdigit() else 3, lines[2], "True" in lines[1], "True" in lines[0], get_spool_timestamp(service_file)))
+        os.rename(service_file_directory, service_file_directory.with_name(f"{service_file_directory.name}.migrated"))
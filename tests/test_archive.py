@@ -0,0 +1,107 @@
+# These tests check that the mail archive finds the emails through its index in the state store,
+# rotates and deletes its segments and survives a write that was cut off by a crash
+
+from pathlib import Path
+
+from archive import DAY_SECONDS, ArchivedMail, MailArchive, read_segment
+from models import Email
+from statestore import StateStore
+
+
+def build_mail(received: float, subject: str, services: list[str]) -> ArchivedMail:
+    return ArchivedMail(received, "processed" if services else "without-service", Email("nas@example.com", subject, f"Body of {subject}\n"), services)
+
+
+def describe(archived_mails) -> list[tuple[float, str, list[str]]]:
+    return [(archived_mail.received, archived_mail.email.subject, archived_mail.services) for archived_mail in archived_mails]
+
+
+def test_emails_are_found_through_the_index(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        mail_archive = MailArchive(store, tmp_path / "archive")
+        mail_archive.append([build_mail(100, "Backup NAS1", ["NAS1", "NAS1-Disk"]), build_mail(200, "Newsletter", [])], now=1000)
+        mail_archive.append([build_mail(300, "Backup NAS2", ["NAS2"]), build_mail(400, "Backup NAS1", ["NAS1"])], now=1100)
+
+        # Both members are appended to the same segment
+        assert len(store.get_archive_segments()) == 1
+        assert describe(mail_archive.find_mails(subject="Backup NAS1")) == [(100, "Backup NAS1", ["NAS1", "NAS1-Disk"]), (400, "Backup NAS1", ["NAS1"])]
+        assert describe(mail_archive.find_mails(service="NAS1-Disk")) == [(100, "Backup NAS1", ["NAS1", "NAS1-Disk"])]
+        assert describe(mail_archive.find_mails(received_after=200, received_before=400)) == [(200, "Newsletter", []), (300, "Backup NAS2", ["NAS2"])]
+        assert [archived_mail.received for archived_mail in mail_archive.iter_mails()] == [100, 200, 300, 400]
+        assert [archived_mail.received for archived_mail in mail_archive.iter_mails(received_after=250)] == [300, 400]
+    finally:
+        store.close()
+
+
+def test_lookup_only_decompresses_the_member_it_needs(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        mail_archive = MailArchive(store, tmp_path / "archive")
+        mail_archive.append([build_mail(100, "Backup NAS1", ["NAS1"])], now=1000)
+        first_member_size: int = store.get_archive_segments()[0].size
+        mail_archive.append([build_mail(200, "Backup NAS2", ["NAS2"])], now=1100)
+
+        # The first member can't be decompressed anymore, the second is still found at its offset
+        segment_path: Path = tmp_path / "archive" / store.get_archive_segments()[0].name
+        segment_bytes: bytes = segment_path.read_bytes()
+        segment_path.write_bytes(bytes(first_member_size) + segment_bytes[first_member_size:])
+
+        assert describe(mail_archive.find_mails(service="NAS2")) == [(200, "Backup NAS2", ["NAS2"])]
+    finally:
+        store.close()
+
+
+def test_segments_are_rotated_at_their_size_and_age(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        mail_archive = MailArchive(store, tmp_path / "archive", segment_bytes=10 ** 6, segment_seconds=DAY_SECONDS)
+        mail_archive.append([build_mail(100, "Backup NAS1", ["NAS1"])], now=1000)
+        mail_archive.append([build_mail(200, "Backup NAS1", ["NAS1"])], now=1000 + DAY_SECONDS)
+        mail_archive.segment_bytes = 1
+        mail_archive.append([build_mail(300, "Backup NAS1", ["NAS1"])], now=2000 + DAY_SECONDS)
+
+        assert len(store.get_archive_segments()) == 3
+        assert [archived_mail.received for archived_mail in mail_archive.find_mails(service="NAS1")] == [100, 200, 300]
+    finally:
+        store.close()
+
+
+def test_retention_deletes_old_segments_but_not_the_current_one(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        mail_archive = MailArchive(store, tmp_path / "archive", segment_bytes=1, retention_seconds=10 * DAY_SECONDS, max_bytes=0)
+        for day in range(3):
+            mail_archive.append([build_mail(day * DAY_SECONDS, "Backup NAS1", ["NAS1"])], now=day * DAY_SECONDS)
+        first_segment, second_segment, current_segment = (segment.name for segment in store.get_archive_segments())
+
+        assert mail_archive.apply_retention(now=10.5 * DAY_SECONDS) == [first_segment]
+        assert mail_archive.apply_retention(now=100 * DAY_SECONDS) == [second_segment]
+        assert [segment.name for segment in store.get_archive_segments()] == [current_segment]
+        assert sorted(path.name for path in (tmp_path / "archive").iterdir()) == [current_segment]
+        assert describe(mail_archive.find_mails(service="NAS1")) == [(2 * DAY_SECONDS, "Backup NAS1", ["NAS1"])]
+
+        # Over max_bytes the oldest segments are deleted whatever their age
+        mail_archive.append([build_mail(101 * DAY_SECONDS, "Backup NAS1", ["NAS1"])], now=101 * DAY_SECONDS)
+        mail_archive.retention_seconds, mail_archive.max_bytes = 0, 1
+        assert mail_archive.apply_retention(now=101 * DAY_SECONDS) == [current_segment]
+    finally:
+        store.close()
+
+
+def test_member_cut_off_by_a_crash_ends_the_segment(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        mail_archive = MailArchive(store, tmp_path / "archive")
+        mail_archive.append([build_mail(100, "Backup NAS1", ["NAS1"])], now=1000)
+        segment_path: Path = tmp_path / "archive" / store.get_archive_segments()[0].name
+        with segment_path.open("ab") as segment_file:
+            segment_file.write(b"\x1f\x8b\x08\x00")
+
+        assert [ArchivedMail.from_json(line).received for line in read_segment(segment_path)] == [100]
+        # The segment doesn't have the size of the index anymore, so the next emails go to a new one
+        mail_archive.append([build_mail(200, "Backup NAS1", ["NAS1"])], now=1100)
+        assert len(store.get_archive_segments()) == 2
+        assert [archived_mail.received for archived_mail in mail_archive.iter_mails()] == [100, 200]
+    finally:
+        store.close()
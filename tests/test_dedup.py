@@ -0,0 +1,117 @@
+# These tests check that the dedup cache only drops copies of mails that wouldn't change a service
+
+from configparser import ConfigParser
+
+from dedup import DedupCache, build_dedup_cache, get_content_hash, get_content_key, get_message_id_key
+from models import Email
+from rules import SubjectIndex, load_service_rules
+from statestore import StoredMail
+from textmail2service import process_emails
+
+SERVICE_CONFIG = """
+[Service]
+email_subject_regex = Backup (\\w+)
+name = EMAIL_SUBJECT_REGEX
+ok_regex = Status: (UP)
+crit_regex = Status: (DOWN)
+"""
+
+
+def test_entries_expire_their_ttl_after_they_were_first_seen() -> None:
+    dedup_cache = build_cache()
+    dedup_cache.add(["message-id:<a@example.com>"], now=1000)
+
+    # A hit doesn't extend the TTL, and adding the key again keeps its first seen time
+    assert dedup_cache.contains("message-id:<a@example.com>", now=4000)
+    dedup_cache.add(["message-id:<a@example.com>"], now=4500)
+    assert dedup_cache.get_entries(now=4500) == {"message-id:<a@example.com>": (1000, 4500)}
+    assert not dedup_cache.contains("message-id:<a@example.com>", now=4600)
+    assert dedup_cache.get_entries(now=4600) == {}
+
+
+def test_content_keys_have_the_shorter_ttl() -> None:
+    dedup_cache = build_cache()
+    dedup_cache.add([get_content_key("NAS1", "0" * 64), "message-id:<a@example.com>"], now=1000)
+
+    assert dedup_cache.get_entries(now=1900) == {"message-id:<a@example.com>": (1000, 1000)}
+
+
+def test_least_recently_seen_entries_are_evicted() -> None:
+    dedup_cache = DedupCache({}, max_entries=2, message_id_ttl=3600, content_ttl=900)
+    dedup_cache.add(["message-id:1", "message-id:2"], now=1000)
+    assert dedup_cache.contains("message-id:1", now=1010)
+    dedup_cache.add(["message-id:3"], now=1020)
+
+    assert list(dedup_cache.get_entries(now=1030)) == ["message-id:1", "message-id:3"]
+
+
+def test_new_content_of_a_service_replaces_its_old_one() -> None:
+    old_key, new_key, other_key = get_content_key("NAS1", "1" * 64), get_content_key("NAS1", "2" * 64), get_content_key("NAS2", "1" * 64)
+    # The saved entries are loaded in the order they were last seen
+    dedup_cache = DedupCache({old_key: (900, 900), other_key: (950, 950)}, max_entries=100, message_id_ttl=3600, content_ttl=900)
+    dedup_cache.add([new_key], now=1000)
+
+    assert not dedup_cache.contains(old_key, now=1010)
+    assert dedup_cache.contains(new_key, now=1010)
+    assert dedup_cache.contains(other_key, now=1010)
+
+
+def test_dedup_cache_is_built_from_the_mail_config() -> None:
+    config = ConfigParser()
+    config.read_string("[Mail]\ndedup_message_id_hours = 2\ndedup_content_minutes = 0\n")
+    dedup_cache = build_dedup_cache({}, config["Mail"])
+
+    assert dedup_cache is not None and (dedup_cache.max_entries, dedup_cache.message_id_ttl) == (10000, 7200)
+    # A TTL of 0 turns the content check off
+    dedup_cache.add([get_content_key("NAS1", "0" * 64)], now=1000)
+    assert dedup_cache.get_entries(now=1000) == {}
+
+    config.read_string("[Mail]\ndedup_cache_size = 0\n")
+    assert build_dedup_cache({}, config["Mail"]) is None
+
+
+def test_message_id_key_is_only_built_for_mails_with_one() -> None:
+    assert get_message_id_key(Email("nas@example.com", "Backup NAS1", "", message_id=" <a@example.com>")) == "message-id:a@example.com"
+    assert get_message_id_key(Email("nas@example.com", "Backup NAS1", "")) is None
+
+
+def test_content_hash_ignores_reformatted_whitespace() -> None:
+    content_hash: str = get_content_hash(Email("nas@example.com", "Backup NAS1", "Status: DOWN\nDisk 2\n"))
+
+    assert get_content_hash(Email("nas@example.com", "Backup  NAS1", "Status: DOWN\r\n Disk 2")) == content_hash
+    assert get_content_hash(Email("nas@example.com", "Backup NAS1", "Status: UP\nDisk 2\n")) != content_hash
+
+
+def build_index() -> SubjectIndex:
+    config = ConfigParser(interpolation=None)
+    config.read_string(SERVICE_CONFIG)
+
+    return SubjectIndex(load_service_rules([("backup.cfg", config["Service"])]))
+
+
+def build_cache() -> DedupCache:
+    return DedupCache({}, max_entries=100, message_id_ttl=3600, content_ttl=900)
+
+
+def run(subject_index: SubjectIndex, dedup_cache: DedupCache, received: float, status: str) -> tuple[list[tuple[str, int]], int]:
+    """This processes one mail of NAS1 with the status and returns the states it set and the number of duplicates"""
+
+    stored_email = StoredMail(None, received, Email("nas@example.com", "Backup NAS1", f"Status: {status}\n"), "pending")
+    service_objects, _, _, _, duplicate_emails, _ = process_emails([stored_email], subject_index, dedup_cache=dedup_cache)
+
+    return [(service.name, service.status) for service in service_objects], len(duplicate_emails)
+
+
+def test_copy_of_the_latest_result_is_a_duplicate() -> None:
+    subject_index, dedup_cache = build_index(), build_cache()
+
+    assert run(subject_index, dedup_cache, 1000, "DOWN") == ([("NAS1", 2)], 0)
+    assert run(subject_index, dedup_cache, 1060, "DOWN") == ([], 1)
+
+
+def test_earlier_result_after_a_change_is_not_a_duplicate() -> None:
+    subject_index, dedup_cache = build_index(), build_cache()
+
+    assert run(subject_index, dedup_cache, 1000, "DOWN") == ([("NAS1", 2)], 0)
+    assert run(subject_index, dedup_cache, 1060, "UP") == ([("NAS1", 0)], 0)
+    assert run(subject_index, dedup_cache, 1120, "DOWN") == ([("NAS1", 2)], 0)
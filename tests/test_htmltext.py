@@ -0,0 +1,64 @@
+# These tests check that the html.parser tokenizer returns exactly the text Beautiful Soup returns
+
+import pytest
+
+from htmltext import extract_text, extract_text_with_bs4
+
+ENTITY_CASES = [
+    "<p>Veeam Backup &amp; Replication &copy; Veeam Software</p>",
+    "<p>caf&eacute; &#233; &#xE9; &#X41;</p>",
+    # Numeric references below 256 are Windows-1252, &#150; is an en dash
+    "<p>1&#150;2 &#128; &#151;</p>",
+    "<p>&unknown; &amp &lt;tag&gt; AT&T</p>",
+    "<p>&nbsp;</p><p>a&nbsp;b</p>",
+    "<p>&#0; &#x110000; &#99999999999;</p>",
+    '<meta charset="iso-8859-1"><p>&#233;t&#233;</p>',
+]
+
+WHITESPACE_CASES = [
+    "<p>  leading and trailing  </p>",
+    "<p>one\n\n   two\tthree</p>",
+    "<p>split <b>by</b> inline <i>tags</i></p>",
+    "<table>\n  <tr>\n    <td> a </td>\n    <td>\n</td>\n  </tr>\n</table>",
+    "<p> </p><p>\n</p><p>\xa0</p>",
+    "text before any tag <p>and after</p> and at the end",
+    "",
+]
+
+BR_CASES = [
+    "<p>Dear user,<br>Backup task Daily-1 has completed.</p>",
+    "<p>Start time: 01:00<br/>End time: 01:05</p>",
+    "<p>a<br />b<br></br>c</br>d</p>",
+    "<p>a<br><br><br>b</p>",
+    "<td>Sincerely,<BR>Synology DiskStation</td>",
+]
+
+MARKUP_CASES = [
+    "<html><head><style>td { font-family: Arial; }</style></head><body>text</body></html>",
+    '<script>var tracking = "<p>not text</p>";</script><p>text</p>',
+    "<!DOCTYPE html><!-- a comment --><p>text</p><?php echo 1 ?>",
+    "<p><![CDATA[ cdata text ]]></p>",
+    "<ul><li>one<li>two</ul><p>unclosed <b>bold",
+    "<div><p>nested</div>after</p>",
+    "<template><p>hidden</p></template><ruby>kanji<rp>(</rp><rt>kana</rt><rp>)</rp></ruby>",
+]
+
+
+@pytest.mark.parametrize("html", ENTITY_CASES + WHITESPACE_CASES + BR_CASES + MARKUP_CASES)
+def test_extract_text_matches_bs4(html: str) -> None:
+    payload: bytes = html.encode("utf-8")
+
+    assert extract_text(payload) == extract_text_with_bs4(payload)
+
+
+@pytest.mark.parametrize("payload", [
+    "<p>Gr\xfcsse aus Z\xfcrich</p>".encode("windows-1252"),
+    '<meta charset="utf-8"><p>Grüsse</p>'.encode("utf-8"),
+    "<p>Grüsse</p>".encode("utf-16"),
+])
+def test_extract_text_detects_the_encoding_like_bs4(payload: bytes) -> None:
+    assert extract_text(payload) == extract_text_with_bs4(payload)
+
+
+def test_extract_text_returns_one_string_per_line() -> None:
+    assert extract_text(b"<p>Dear user,<br>Backup &amp; restore</p><p>  done  </p>") == "Dear user,\nBackup & restore\ndone"
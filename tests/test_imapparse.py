@@ -0,0 +1,113 @@
+# These tests parse UID FETCH responses in the form imaplib returns them: every literal is a
+# (b'<line up to the literal> {<size>}', literal) tuple and the rest of the line is plain bytes
+
+from imapparse import TextPart, decode_transfer_encoding, get_fetch_item, get_text_parts, parse_fetch_items
+
+HEADERS = b"Subject: Backup done\r\nFrom: nas@example.org\r\n\r\n"
+
+
+def test_literals_of_several_messages() -> None:
+    data = [
+        (b"1 (UID 17 BODY[HEADER.FIELDS (SUBJECT FROM)] {%d}" % len(HEADERS), HEADERS),
+        b")",
+        (b"2 (UID 18 BODY[HEADER.FIELDS (SUBJECT FROM)] {5}", b"a)b(c"),
+        b")",
+    ]
+
+    fetched_items = parse_fetch_items(data)
+
+    assert list(fetched_items) == ["17", "18"]
+    assert get_fetch_item(fetched_items["17"], "BODY[HEADER.FIELDS") == HEADERS
+    # Parentheses in a literal are data and not lists
+    assert get_fetch_item(fetched_items["18"], "BODY[HEADER.FIELDS") == b"a)b(c"
+
+
+def test_items_after_a_literal() -> None:
+    data = [(b"3 (UID 20 RFC822 {4}", b"body"), b" FLAGS (\\Seen))"]
+
+    fetched_items = parse_fetch_items(data)
+
+    assert fetched_items["20"]["RFC822"] == b"body"
+    assert fetched_items["20"]["FLAGS"] == [b"\\Seen"]
+
+
+def test_partial_fetch_is_found_by_its_section() -> None:
+    # Servers echo BODY.PEEK[1]<0.1024> as BODY[1]<0>
+    data = [(b"1 (UID 5 BODY[1]<0> {10}", b"0123456789"), b" BODY[2] NIL)"]
+
+    items = parse_fetch_items(data)["5"]
+
+    assert get_fetch_item(items, "BODY[1]") == b"0123456789"
+    assert get_fetch_item(items, "BODY[2]") is None
+    assert get_fetch_item(items, "BODY[3]") is None
+
+
+def test_quoted_strings_and_nil() -> None:
+    data = [b'1 (UID 9 BODY[HEADER.FIELDS (SUBJECT)] "Subject: \\"quoted\\" (x)" BODY[TEXT] NIL)']
+
+    items = parse_fetch_items(data)["9"]
+
+    assert get_fetch_item(items, "BODY[HEADER.FIELDS") == b'Subject: "quoted" (x)'
+    assert get_fetch_item(items, "BODY[TEXT]") is None
+
+
+def test_multipart_bodystructure() -> None:
+    data = [b'1 (UID 7 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL)'
+            b'("TEXT" "HTML" ("charset" "ISO-8859-1") NIL NIL "BASE64" 2048 30 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b1") NIL NIL)'
+            b'("APPLICATION" "PDF" ("NAME" "report.pdf") NIL NIL "BASE64" 40000 NIL ("ATTACHMENT" ("FILENAME" "report.pdf")) NIL)'
+            b'("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1 NIL ("ATTACHMENT" ("FILENAME" "log.txt")) NIL) "MIXED" ("BOUNDARY" "b0") NIL NIL))']
+
+    text_parts = get_text_parts(parse_fetch_items(data)["7"]["BODYSTRUCTURE"])
+
+    # The attached text file is left out like the PDF
+    assert text_parts == [TextPart("1.1", "text/plain", "utf-8", "quoted-printable", 120),
+                          TextPart("1.2", "text/html", "iso-8859-1", "base64", 2048)]
+
+
+def test_single_part_bodystructure_is_section_one() -> None:
+    data = [b'1 (UID 8 BODYSTRUCTURE ("TEXT" "HTML" NIL NIL NIL "8BIT" 300 12 NIL NIL NIL))']
+
+    assert get_text_parts(parse_fetch_items(data)["8"]["BODYSTRUCTURE"]) == [TextPart("1", "text/html", None, "8bit", 300)]
+
+
+def test_bodystructure_with_a_literal() -> None:
+    # Servers send strings with special characters, e.g. a file name, as literals within the BODYSTRUCTURE
+    data = [(b'1 (UID 11 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 42 2 NIL NIL NIL)'
+             b'("APPLICATION" "OCTET-STREAM" ("NAME" {12}', b'bericht".zip'),
+            b') NIL NIL "BASE64" 900 NIL ("ATTACHMENT" NIL) NIL) "MIXED" NIL NIL NIL))']
+
+    text_parts = get_text_parts(parse_fetch_items(data)["11"]["BODYSTRUCTURE"])
+
+    assert text_parts == [TextPart("1", "text/plain", "utf-8", "7bit", 42)]
+
+
+def test_attached_message_is_walked() -> None:
+    data = [b'1 (UID 12 BODYSTRUCTURE (("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1 NIL NIL NIL)'
+            b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 500 (NIL "inner" NIL NIL NIL NIL NIL NIL NIL NIL)'
+            b' ("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 80 2 NIL NIL NIL) 20 NIL NIL NIL) "MIXED" NIL NIL NIL))']
+
+    text_parts = get_text_parts(parse_fetch_items(data)["12"]["BODYSTRUCTURE"])
+
+    assert [text_part.section for text_part in text_parts] == ["1", "2.1"]
+
+
+def test_truncated_bodystructure_keeps_the_complete_parts() -> None:
+    # The closing parentheses of the response are missing
+    data = [b'1 (UID 13 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 42 2 NIL NIL NIL)("TEXT" "HTML"']
+
+    text_parts = get_text_parts(parse_fetch_items(data)["13"]["BODYSTRUCTURE"])
+
+    assert text_parts == [TextPart("1", "text/plain", "utf-8", "7bit", 42)]
+
+
+def test_missing_bodystructure_has_no_text_parts() -> None:
+    assert get_text_parts(None) == []
+    assert get_text_parts([]) == []
+
+
+def test_decode_truncated_base64_and_quoted_printable() -> None:
+    # A partial fetch can end within a base64 quantum or a quoted-printable escape
+    assert decode_transfer_encoding(b"R3L8c3Nl\r\nIGF1cyBa", "base64", False) == b"Gr\xfcsse aus Z"
+    assert decode_transfer_encoding(b"R3L8c3Nl\r\nIGF1cyB", "base64", True) == b"Gr\xfcsse au"
+    assert decode_transfer_encoding(b"Gr=FCsse=\r\n aus =F", "quoted-printable", True) == b"Gr\xfcsse aus "
+    assert decode_transfer_encoding(b"plain text", "7bit", False) == b"plain text"
@@ -0,0 +1,99 @@
+# These tests check that list RegEx answered through their ListShape return what a search()
+# of the whole RegEx returns
+
+import random
+from re import Match, compile as compile_regex
+
+import pytest
+
+from rules import BodyPattern, BodyScan, get_list_shape, get_regex_group
+
+LIST_REGEXES = [
+    r"neuesten Stand:\n- (?:.*\n- )*Plugin \((.+)\)",
+    r"nicht aktualisiert werden:\n- (?:.*\n- )*(Plugin-\d+) \((\d+)\.0\)",
+    r"Stand:\n- (?:.*\n- )*(.+)",
+    r"Stand:\n- (?:.*\n- )*(Plugin-1 .*)",
+    r"Stand:\n- (?:.*\n  - )*Plugin-(\d)\n",
+]
+
+BODIES = [
+    "",
+    "neuesten Stand:\n- Plugin (Foo)\n",
+    "neuesten Stand:\n- x\n- y\n- Plugin (Bar)\n- z\n",
+    "neuesten Stand:\n- Plugin (Erstes)\n- Plugin (Letztes)",
+    "neuesten Stand:\nPlugin (kein Listenpunkt)\n",
+    "nicht aktualisiert werden:\n- Plugin-3 (3.0)\n- Plugin-12 (4.0)\n\nneuesten Stand:\n- Plugin (Foo)\n",
+    "Stand:\n- Plugin-1\n  - Plugin-2\n  - Plugin-3\n",
+    "Stand:\n- Plugin-10 (1.0)\n- Plugin-1 (2.0)\nStand:\n- Plugin-1\n",
+    "Stand:\n- \n- \n",
+]
+
+
+def generate_bodies(count: int, seed: int = 1) -> list[str]:
+    """This returns WordPress like bodies with random lists, some of them with several lists or none"""
+
+    rng = random.Random(seed)
+    bodies: list[str] = []
+    for _ in range(count):
+        parts: list[str] = []
+        for _ in range(rng.randrange(0, 3)):
+            head: str = rng.choice(["neuesten Stand:\n- ", "nicht aktualisiert werden:\n- ", "Stand:\n- ", "Stand:\n"])
+            items: list[str] = [rng.choice([f"Plugin-{rng.randrange(15)} ({rng.randrange(5)}.0)", f"Plugin ({rng.randrange(9)})", "", "x"])
+                                for _ in range(rng.randrange(0, 6))]
+            parts.append(head + rng.choice(["\n- ", "\n  - "]).join(items))
+        bodies.append("\n".join(parts) + rng.choice(["", "\n"]))
+
+    return bodies
+
+
+def search_without_shape(regex: str, body: str) -> Match | None:
+    return compile_regex(regex).search(body)
+
+
+def describe_match(regex_match: Match | None) -> tuple[str, int] | None:
+    """This returns what the rules use of a match, its first group, and where it ends"""
+
+    return None if regex_match is None else (get_regex_group(regex_match), regex_match.end())
+
+
+@pytest.mark.parametrize("regex", LIST_REGEXES)
+def test_list_regexes_have_a_shape(regex: str) -> None:
+    assert BodyPattern(regex).list_shape is not None
+
+
+@pytest.mark.parametrize("regex", [
+    r"(?i)Stand:\n- (?:.*\n- )*(.+)",
+    r"(Stand):\n- (?:.*\n- )*(.+)",
+    r"Stand:\n- (?:.*, )*(.+)",
+    r"Stand:\n- (?:.*\n- )*(.+)\1",
+    # The rules use the whole match of a RegEx without a group, which the tail alone doesn't return
+    r"Stand:\n- (?:.*\n- )*Plugin-1 .*",
+    # Anchors in the tail could behave differently when the tail is matched on its own
+    r"Stand:\n- (?:.*\n- )*Plugin-1\b.*",
+    r"Sta.d:\n- (?:.*\n- )*(.+)",
+])
+def test_other_regexes_have_no_shape(regex: str) -> None:
+    assert get_list_shape(regex) is None
+
+
+@pytest.mark.parametrize("regex", LIST_REGEXES + [r"Stand:\n- (?:.*\n- )*Plugin-1 .*"])
+@pytest.mark.parametrize("body", BODIES)
+def test_shape_search_matches_regex_search(regex: str, body: str) -> None:
+    body_pattern = BodyPattern(regex)
+
+    assert describe_match(body_pattern.search(BodyScan(body))) == describe_match(search_without_shape(regex, body))
+
+
+@pytest.mark.parametrize("regex", LIST_REGEXES + [r"Stand:\n- (?:.*\n- )*Plugin-1 .*"])
+def test_shape_search_matches_regex_search_on_generated_bodies(regex: str) -> None:
+    body_pattern = BodyPattern(regex)
+    for body in generate_bodies(20):
+        assert describe_match(body_pattern.search(BodyScan(body))) == describe_match(search_without_shape(regex, body)), body
+
+
+def test_shape_search_with_a_shared_scan() -> None:
+    # Every rule that looks at the same body shares one scan, the cached lists must not change the results
+    for body in generate_bodies(10, seed=2):
+        body_scan = BodyScan(body)
+        for regex in LIST_REGEXES + LIST_REGEXES:
+            assert describe_match(BodyPattern(regex).search(body_scan)) == describe_match(search_without_shape(regex, body))
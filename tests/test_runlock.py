@@ -0,0 +1,68 @@
+# These tests check that only one run holds the lock at a time and that a run that died doesn't block the next one
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from runlock import RunLock, acquire_or_exit, get_lock_service_line
+
+# A run that takes the lock passed as its argument and then hangs
+CHILD_RUN = """
+import sys, time
+from pathlib import Path
+from runlock import RunLock
+run_lock = RunLock(Path(sys.argv[1]))
+assert run_lock.acquire()
+print("locked", flush=True)
+time.sleep(60)
+"""
+
+
+def test_second_run_does_not_get_the_lock(tmp_path: Path) -> None:
+    run_lock, other_lock = RunLock(tmp_path / "state" / "run.lock"), RunLock(tmp_path / "state" / "run.lock")
+    assert run_lock.acquire()
+    try:
+        assert not other_lock.acquire()
+        assert other_lock.get_holder()[0] == os.getpid()
+    finally:
+        run_lock.release()
+
+    assert other_lock.acquire()
+    other_lock.release()
+
+
+def test_lock_of_a_run_that_died_is_released(tmp_path: Path) -> None:
+    lock_path: Path = tmp_path / "run.lock"
+    holding_run = subprocess.Popen([sys.executable, "-c", CHILD_RUN, str(lock_path)], cwd=Path(__file__).parent.parent,
+                                   stdout=subprocess.PIPE, text=True)
+    try:
+        assert holding_run.stdout.readline() == "locked\n"
+        assert not RunLock(lock_path).acquire()
+    finally:
+        # The run is killed without releasing the lock, like a run that crashed
+        holding_run.kill()
+        holding_run.wait()
+        holding_run.stdout.close()
+
+    run_lock = RunLock(lock_path)
+    assert run_lock.acquire()
+    run_lock.release()
+
+
+def test_entry_point_exits_while_another_run_holds_the_lock(tmp_path: Path, capsys: pytest.CaptureFixture) -> None:
+    run_lock = RunLock(tmp_path / "run.lock")
+    assert run_lock.acquire()
+    try:
+        with pytest.raises(SystemExit):
+            acquire_or_exit(RunLock(tmp_path / "run.lock"))
+        assert f"PID {os.getpid()}" in capsys.readouterr().err
+    finally:
+        run_lock.release()
+
+
+@pytest.mark.parametrize("holder, expected_status", [(None, "0"), ((4242, 1000.0), "0"), ((4242, 100.0), "2")])
+def test_lock_service_goes_crit_for_a_hanging_run(holder: tuple[int, float] | None, expected_status: str) -> None:
+    assert get_lock_service_line(holder, stale_lock_seconds=600, now=1000.0 + 300).startswith(f"{expected_status} Mail2CheckMK-000Run-lock ")
@@ -0,0 +1,72 @@
+# These tests check that the end of a run sends the output and commits its changes to the services together
+
+from pathlib import Path
+
+import pytest
+
+import service2checkmk
+from models import Service
+from statestore import StateStore
+
+
+def build_store(path: Path) -> StateStore:
+    store = StateStore(path / "state" / "mail2checkmk.sqlite3")
+    store.save_services([Service(False, True, 0, "NAS1", {}, "fresh", 2000, None, "stale"),
+                         Service(False, True, 0, "[Mail2CheckMK]-Stats", {}, "stats")], updated=1000)
+
+    return store
+
+
+def count_commits(store: StateStore) -> list[str]:
+    """This returns a list that gets every COMMIT the store runs from now on"""
+
+    commits: list[str] = []
+    store.connection.set_trace_callback(lambda statement: commits.append(statement) if statement.strip().upper().startswith("COMMIT") else None)
+
+    return commits
+
+
+def test_output_is_sent_and_committed_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture) -> None:
+    monkeypatch.chdir(tmp_path)
+    store = build_store(tmp_path)
+    try:
+        commits: list[str] = count_commits(store)
+        service2checkmk.send_and_clean_up(store)
+
+        assert len(commits) == 1
+        # The stale service is sent WARN, the own services once and the output is kept as the snapshot
+        assert capsys.readouterr().out == "0 [Mail2CheckMK]-Stats - stats\n1 NAS1 - stale\n"
+        assert service2checkmk.SNAPSHOT_PATH.read_text() == "0 [Mail2CheckMK]-Stats - stats\n1 NAS1 - stale\n"
+        assert store.render_services() == "1 NAS1 - stale\n"
+    finally:
+        store.close()
+
+
+def test_services_stay_as_they_were_if_sending_fails(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    store = build_store(tmp_path)
+    try:
+        def fail(output: str) -> None:
+            raise BrokenPipeError
+
+        monkeypatch.setattr(service2checkmk, "send_to_checkmk", fail)
+        with pytest.raises(BrokenPipeError):
+            service2checkmk.send_and_clean_up(store)
+
+        assert store.render_services() == "0 NAS1 - fresh\n0 [Mail2CheckMK]-Stats - stats\n"
+    finally:
+        store.close()
+
+
+def test_daemon_output_file_is_written_and_committed_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    store = build_store(tmp_path)
+    try:
+        commits: list[str] = count_commits(store)
+        service2checkmk.write_and_clean_up(store, tmp_path / "output.txt")
+
+        assert len(commits) == 1
+        assert (tmp_path / "output.txt").read_text() == "0 [Mail2CheckMK]-Stats - stats\n1 NAS1 - stale\n"
+        assert not (tmp_path / "output.tmp").exists()
+    finally:
+        store.close()
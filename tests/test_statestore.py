@@ -0,0 +1,126 @@
+# These tests check the schema migrations of the state store, the import of the old spool directories
+# and that services go stale when their warn_cycle and crit_cycle deadlines pass
+
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from models import Service
+from statestore import SCHEMA_MIGRATIONS, StateStore, migrate_spool
+
+
+def build_service(name: str, status: int, warn_deadline: float | None = None, crit_deadline: float | None = None) -> Service:
+    return Service(False, True, status, name, {}, "fresh", warn_deadline, crit_deadline, "stale", "dead")
+
+
+def get_schema_version(path: Path) -> int:
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("schema_version", range(1, len(SCHEMA_MIGRATIONS) + 1))
+def test_every_schema_version_is_migrated_to_the_latest(tmp_path: Path, schema_version: int) -> None:
+    path: Path = tmp_path / "state.sqlite3"
+    connection = sqlite3.connect(path)
+    for version, migration in enumerate(SCHEMA_MIGRATIONS[:schema_version], start=1):
+        connection.executescript(f"BEGIN; {migration}; PRAGMA user_version = {version}; COMMIT;")
+    with connection:
+        connection.execute("INSERT INTO mails (received, from_field, subject, body) VALUES (1000, 'nas@example.com', 'Backup NAS1', 'Status: UP')")
+        connection.execute("INSERT INTO services (name, status, output, send, delete_flag, updated) VALUES ('NAS1', 0, '0 NAS1 - fresh', 1, 0, 1000)")
+    connection.close()
+
+    store = StateStore(path)
+    try:
+        # The rows of older versions are kept and have no values in the newer columns
+        assert [(mail.email.subject, mail.state) for mail in store.get_mails()] == [("Backup NAS1", "pending")]
+        assert store.count_mails(skip_rule_set="rules") == 1
+        assert store.render_services() == "0 NAS1 - fresh\n"
+        assert store.expire_service_deadlines(now=10 ** 10) == []
+        assert store.get_seen_mails() == {} and store.get_archive_segments() == []
+    finally:
+        store.close()
+    assert get_schema_version(path) == len(SCHEMA_MIGRATIONS)
+
+    # Opening a migrated store again doesn't change it
+    StateStore(path).close()
+    assert get_schema_version(path) == len(SCHEMA_MIGRATIONS)
+
+
+def test_old_spool_directories_are_imported_once(tmp_path: Path) -> None:
+    email_directory: Path = tmp_path / "plaintext-emails"
+    service_directory: Path = tmp_path / "service-files"
+    (email_directory / "without-service").mkdir(parents=True)
+    service_directory.mkdir()
+    (email_directory / "Backup_NAS1_1000,5.txt").write_text("nas@example.com\n\nBackup NAS1\n\nStatus: UP\nDisk 2\n")
+    (email_directory / "without-service" / "Newsletter_900,25.txt").write_text("news@example.com\n\nNewsletter\n\nHallo\n")
+    (service_directory / "NAS1_1000,0.txt").write_text("Delete Service File: False\nSend to CheckMK: True\n2 NAS1 - down")
+    (service_directory / "NAS1_2000,0.txt").write_text("Delete Service File: True\nSend to CheckMK: False\n0 NAS1 - up")
+    (service_directory / "broken_3000,0.txt").write_text("Delete Service File: False\n")
+
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        migrate_spool(store, email_directory, service_directory)
+
+        assert [(mail.received, mail.email.from_field, mail.email.subject, mail.email.body, mail.state) for mail in store.get_mails()] == [
+            (900.25, "news@example.com", "Newsletter", "Hallo\n", "without-service"),
+            (1000.5, "nas@example.com", "Backup NAS1", "Status: UP\nDisk 2\n", "pending"),
+        ]
+        # The newest file of a service wins, with its flags
+        assert [(service.name, service.status, service.output, service.send, service.delete, service.updated) for service in store.get_services()] == [
+            ("NAS1", 0, "0 NAS1 - up", False, True, 2000.0),
+        ]
+        assert not email_directory.exists() and (tmp_path / "plaintext-emails.migrated").is_dir()
+        assert not service_directory.exists() and (tmp_path / "service-files.migrated").is_dir()
+
+        migrate_spool(store, email_directory, service_directory)
+        assert len(store.get_mails()) == 2
+    finally:
+        store.close()
+
+
+def test_services_go_warn_and_then_crit_when_their_deadlines_pass(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        store.save_services([build_service("NAS1", 0, warn_deadline=2000, crit_deadline=3000), build_service("NAS2", 0)], updated=1000)
+
+        assert store.expire_service_deadlines(now=1999) == []
+        assert store.expire_service_deadlines(now=2000) == ["NAS1"]
+        assert store.render_services() == "0 NAS2 - fresh\n1 NAS1 - stale\n"
+        # Every deadline passes only once
+        assert store.expire_service_deadlines(now=2500) == []
+        assert store.expire_service_deadlines(now=3000) == ["NAS1"]
+        assert store.render_services() == "0 NAS2 - fresh\n2 NAS1 - dead\n"
+        assert store.expire_service_deadlines(now=10 ** 10) == []
+    finally:
+        store.close()
+
+
+def test_service_whose_deadlines_both_passed_goes_crit(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        store.save_services([build_service("NAS1", 0, warn_deadline=2000, crit_deadline=3000),
+                             build_service("NAS2", 1, crit_deadline=2500)], updated=1000)
+
+        assert store.expire_service_deadlines(now=4000) == ["NAS1", "NAS2"]
+        assert [(service.name, service.status, service.output) for service in store.get_services()] == [
+            ("NAS1", 2, "2 NAS1 - dead"), ("NAS2", 2, "2 NAS2 - dead")]
+    finally:
+        store.close()
+
+
+def test_newer_mail_replaces_the_deadlines_of_a_service(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        store.save_services([build_service("NAS1", 0, warn_deadline=2000, crit_deadline=3000)], updated=1000)
+        assert store.expire_service_deadlines(now=2000) == ["NAS1"]
+        store.save_services([build_service("NAS1", 0, warn_deadline=4000, crit_deadline=5000)], updated=2100)
+
+        assert store.expire_service_deadlines(now=3000) == []
+        assert store.render_services() == "0 NAS1 - fresh\n"
+        assert store.expire_service_deadlines(now=4000) == ["NAS1"]
+    finally:
+        store.close()
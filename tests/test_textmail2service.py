@@ -0,0 +1,151 @@
+# These tests check that evaluating the mails of a batch newest first saves the same services
+# as evaluating every mail oldest first would and that the results of a batch are saved in one transaction
+
+from configparser import ConfigParser
+from pathlib import Path
+from time import time
+
+import pytest
+
+from models import Email
+from rules import SubjectIndex, load_service_rules
+from statestore import StateStore, StoredMail
+from textmail2service import CYCLE_SECONDS, RunStats, process_emails, save_batch_results
+
+SERVICE_CONFIGS = """
+[Status]
+email_subject_regex = Backup (\\w+)
+name = EMAIL_SUBJECT_REGEX
+ok_regex = Status: (UP)
+crit_regex = Status: (DOWN)
+warn_cycle = 1
+crit_cycle = 2
+
+[Disk]
+email_subject_regex = Backup (\\w+)
+name = EMAIL_SUBJECT_REGEX-Disk
+ok_regex = Disk: (OK)
+"""
+
+
+def build_index(sections: tuple[str, ...] = ("Status", "Disk")) -> SubjectIndex:
+    config = ConfigParser(interpolation=None)
+    config.read_string(SERVICE_CONFIGS)
+
+    return SubjectIndex(load_service_rules([(f"{section}.cfg", config[section]) for section in sections]))
+
+
+def build_mail(received: float, device: str, body: str) -> StoredMail:
+    return StoredMail(None, received, Email(f"{device.lower()}@example.com", f"Backup {device}", body), "pending")
+
+
+def test_only_the_newest_state_of_every_service_is_saved() -> None:
+    now: float = time()
+    stored_emails = [build_mail(now - 300, "NAS1", "Status: UP\n"),
+                     build_mail(now - 200, "NAS2", "Status: DOWN\n"),
+                     build_mail(now - 100, "NAS1", "Status: DOWN\n"),
+                     build_mail(now - 250, "NAS1", "Status: UP\n")]
+    service_objects, processed_emails, emails_without_service, service_files_created, _, processed_services = process_emails(stored_emails, build_index())
+
+    # The services and emails are returned oldest first
+    assert [(service.name, service.status) for service in service_objects] == [("NAS2", 2), ("NAS1", 2)]
+    assert service_files_created == 2
+    assert processed_emails == [stored_emails[0], stored_emails[3], stored_emails[1], stored_emails[2]]
+    assert processed_services == [["NAS1"], ["NAS1"], ["NAS2"], ["NAS1"]]
+    assert emails_without_service == []
+
+
+def test_cycle_deadlines_start_at_the_newest_email() -> None:
+    now: float = time()
+    stored_emails = [build_mail(now - 100, "NAS1", "Status: UP\n"), build_mail(now - 300, "NAS1", "Status: UP\n")]
+    service_objects = process_emails(stored_emails, build_index())[0]
+
+    assert [(service.warn_deadline, service.crit_deadline) for service in service_objects] == [(now - 100 + CYCLE_SECONDS, now - 100 + 2 * CYCLE_SECONDS)]
+
+
+def test_older_emails_of_resolved_services_are_not_evaluated() -> None:
+    now: float = time()
+    # The older body matches no rule, it is processed because a newer email already set its only service
+    stored_emails = [build_mail(now - 200, "NAS1", "unreadable"), build_mail(now - 100, "NAS1", "Status: UP\n")]
+    _, processed_emails, emails_without_service, _, _, processed_services = process_emails(stored_emails, build_index(("Status",)))
+
+    assert processed_emails == stored_emails
+    assert processed_services == [["NAS1"], ["NAS1"]]
+    assert emails_without_service == []
+
+
+def test_older_emails_still_set_the_services_a_newer_email_did_not() -> None:
+    now: float = time()
+    stored_emails = [build_mail(now - 200, "NAS1", "Status: DOWN\nDisk: OK\n"), build_mail(now - 100, "NAS1", "Status: UP\n")]
+    service_objects = process_emails(stored_emails, build_index())[0]
+
+    assert [(service.name, service.status) for service in service_objects] == [("NAS1-Disk", 0), ("NAS1", 0)]
+
+
+def test_older_emails_with_an_unresolved_service_are_evaluated() -> None:
+    now: float = time()
+    # Evaluated oldest first the older email had no service, so it still has none
+    stored_emails = [build_mail(now - 200, "NAS1", "unreadable"), build_mail(now - 100, "NAS1", "Status: UP\n")]
+    _, processed_emails, emails_without_service, _, _, _ = process_emails(stored_emails, build_index())
+
+    assert (processed_emails, emails_without_service) == (stored_emails[1:], stored_emails[:1])
+
+
+def test_emails_without_any_matching_rule_have_no_service() -> None:
+    stored_emails = [build_mail(time() - 100, "NAS1", "unreadable")]
+    _, processed_emails, emails_without_service, service_files_created, _, _ = process_emails(stored_emails, build_index())
+
+    assert (service_files_created, processed_emails, emails_without_service) == (0, [], stored_emails)
+
+
+def count_commits(store: StateStore) -> list[str]:
+    """This returns a list that gets every COMMIT the store runs from now on"""
+
+    commits: list[str] = []
+    store.connection.set_trace_callback(lambda statement: commits.append(statement) if statement.strip().upper().startswith("COMMIT") else None)
+
+    return commits
+
+
+def save_pending_mails(store: StateStore) -> list[StoredMail]:
+    now: float = time()
+    store.add_mails([Email("nas1@example.com", "Backup NAS1", "Status: UP\n")], received=now - 200)
+    store.add_mails([Email("nas2@example.com", "Backup NAS2", "unreadable")], received=now - 100)
+
+    return store.get_mails(("pending",))
+
+
+def test_results_of_a_batch_are_committed_once(tmp_path: Path) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        batch_results = process_emails(save_pending_mails(store), build_index())
+        commits: list[str] = count_commits(store)
+        run_stats = RunStats()
+        save_batch_results(batch_results, store, run_stats, "rules")
+
+        assert len(commits) == 1
+        assert store.render_services() == "0 NAS1 - \n"
+        assert [(mail.email.subject, mail.state) for mail in store.get_mails()] == [("Backup NAS2", "without-service")]
+        assert (run_stats.service_files_created, run_stats.email_without_service_count) == (1, 1)
+    finally:
+        store.close()
+
+
+def test_results_of_a_batch_are_not_saved_if_saving_fails(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    store = StateStore(tmp_path / "state.sqlite3")
+    try:
+        stored_emails: list[StoredMail] = save_pending_mails(store)
+        batch_results = process_emails(stored_emails, build_index())
+
+        def fail(*args, **kwargs) -> None:
+            raise OSError("disk full")
+
+        monkeypatch.setattr(store, "mark_mails_without_service", fail)
+        with pytest.raises(OSError):
+            save_batch_results(batch_results, store, RunStats(), "rules")
+
+        # The service and the deleted email are rolled back, the batch is evaluated again by the next run
+        assert store.render_services() == ""
+        assert store.get_mails() == stored_emails
+    finally:
+        store.close()
@@ -1,191 +1,269 @@
-# This module parses all the files in ./plaintext-emails with RegEx
+# This module parses all the emails in the state store with RegEx
 # like the service configuration file in ./config/services say
-# and then saves these services as plaintext-files in ./service-files
+# and then saves these services in the state store
+
+from collections import deque
+from concurrent.futures import Future
+from configparser import SectionProxy
+from dataclasses import dataclass, field
+from re import sub, Match
+from time import perf_counter, time
+from typing import Iterable, Iterator
+
+import instrumentation
+from archive import MailArchive, archive_old_mails_without_service, archive_stored_mails, build_mail_archive
+from configfile import read_config_section
+from dedup import DedupCache, build_dedup_cache, get_content_hash, get_content_key, get_message_id_key
+from instrumentation import RunMetrics, STAGES, add_rule_time, get_peak_rss_bytes, timed
+from models import Email, EmailBatch, Service
+from statestore import StateStore, StoredMail
+from rules import BodyScan, RuleGuard, ServiceRule, SubjectIndex, build_rule_guard, build_subject_index
+from runlock import hold_run_lock
+from workerpool import create_process_pool, get_pool_settings
+
+# warn_cycle and crit_cycle are set in hours
+CYCLE_SECONDS = 3600
+
+# The results process_emails() returns for a batch
+BatchResults = tuple[list[Service], list[StoredMail], list[StoredMail], int, list[StoredMail], list[list[str]]]
+
+# The service configs and the rule guard of a backlog worker process, set by init_backlog_worker()
+worker_subject_index: SubjectIndex | None = None
+worker_rule_guard: RuleGuard | None = None
 
-import os
-from pathlib import Path
-from configparser import ConfigParser, SectionProxy
-from dataclasses import dataclass
-from re import search, sub, Match
-from time import time
 
-from mail2text import Email
-
-
-
-def get_plaintext_emails() -> list[Path]:
-    """This returns a sorted list of all Path objects of the text files in the plaintext-emails directory"""
-
-    plaintext_email_directory = Path("plaintext-emails")
-    plaintext_email_list = list(plaintext_email_directory.rglob("*.txt"))
-    # This sorts the list with the unix timestamp from the filename
-    return sorted(plaintext_email_list, key=lambda p: float(p.stem.split("_")[-1].replace(",", ".")))
-
-
-def get_service_configs() -> list[SectionProxy]:
-    """This returns a list of all service config files as parsed configs"""
-
-    service_configs: list[SectionProxy] = []
-    config_directory = Path("config/services")
-    for config_file in config_directory.glob("*.cfg"):
-        cfgparser = ConfigParser()
-        cfgparser.read(config_file)
-        service_config = cfgparser["Service"]
-
-        service_configs.append(service_config)
-
-
-    return service_configs
-
-
-def get_email_from_path(email_path: Path) -> Email:
-    """This reads the plaintext email from the path and returns
-    it in the form on an Email object from mail2text"""
-
-    email_text: str = email_path.read_text()
-    # We keepends here because we want them for the mail body but strip them from the From field and the subject
-    email_line_list : list[str] = email_text.splitlines(keepends=True)
-    email_from = email_line_list[0].strip()
-    subject = email_line_list[2].strip()
+@dataclass
+class RunStats:
+    """The counts of a run over all batches that are reported in the Mail2CheckMK services"""
 
-    email_body: str = ""
+    emails_processed: int = 0
+    service_files_created: int = 0
+    # The emails without service of the batches evaluated in this run
+    email_without_service_count: int = 0
+    # The mails that were dropped because the dedup cache knew their Message-ID or content
+    duplicates_skipped: int = 0
+    failed_accounts: list[str] = field(default_factory=list)
 
-    for email_line in range(4, len(email_line_list)):
-        email_body += email_line_list[email_line]
 
-    email_object = Email(email_from, subject, email_body)
-    return email_object
+def get_stored_emails(store: StateStore, batch_size: int = 500) -> Iterator[list[StoredMail]]:
+    """This yields every pending email from the state store in batches, oldest first"""
 
+    return store.iter_mails(("pending",), batch_size)
 
-@dataclass
-class Service:
-    delete: bool
-    send: bool
-    status: int
-    name: str
-    values: dict
-    status_details: str
 
+def get_backlog_emails(store: StateStore, subject_index: SubjectIndex, batch_size: int = 500, reevaluate_all: bool = False) -> Iterator[list[StoredMail]]:
+    """This yields the emails without service that weren't evaluated with the current service configs yet
+    in batches, oldest first. With reevaluate_all every email without service is yielded.
+    Emails whose body wasn't downloaded are left out, their placeholder body can't match a new service config."""
 
+    return store.iter_mails(("without-service",), batch_size, None if reevaluate_all else subject_index.rule_set_hash, headers_only=False)
 
-def create_service_object(service_config: SectionProxy, email_object: Email, subject_match: Match, timestamp: float) -> Service | None:
-    """This returns a Service object from the passed info that is fully parsed"""
 
-    status: int = 3
+def get_service_name(service_rule: ServiceRule, subject_match: Match) -> str:
+    """This returns the name of the service the rule creates for the subject match"""
 
-    ok_regex = service_config.get("ok_regex")
-    warn_regex = service_config.get("warn_regex")
-    crit_regex = service_config.get("crit_regex")
+    name: str = service_rule.name.replace("EMAIL_SUBJECT_REGEX", subject_match.group(1))
 
-    value_name = service_config.get("value_name")
-    value_regex = service_config.get("value_regex")
+    return sub(r"[^\w-]", "", name) # replace any non-word character e.g. a-z, A-Z, 0-9 and _ with "" for legacy checkmk support
 
 
-    ok_match = search(ok_regex, email_object.body) if ok_regex else None
-    warn_match = search(warn_regex, email_object.body) if warn_regex else None
-    crit_match = search(crit_regex, email_object.body) if crit_regex else None
-    relevant_match: Match = search("", email_object.body)
+def create_service_object(service_rule: ServiceRule, email_object: Email, subject_match: Match, timestamp: float, body_scan: BodyScan | None = None, rule_guard: RuleGuard | None = None) -> Service | None:
+    """This returns a Service object from the passed info that is fully parsed.
+    The body scan can be shared by every rule that matched the same email
+    and the rule guard enforces the time budget of the rule evaluation."""
 
+    if body_scan is None:
+        body_scan = BodyScan(email_object.body)
 
-    if crit_match is not None:
-        status = 2
-        relevant_match = crit_match
-    elif warn_match is not None:
-        status = 1
-        relevant_match = warn_match
-    elif ok_match is not None:
-        status = 0
-        relevant_match = ok_match
+    evaluation_start: float = perf_counter()
+    if rule_guard is not None:
+        evaluation: tuple[int, str] | None = rule_guard.evaluate(service_rule, body_scan)
     else:
+        evaluation = service_rule.evaluate(body_scan)
+    add_rule_time(service_rule.source, perf_counter() - evaluation_start)
+    if evaluation is None:
         # If no match is found this service doesn't apply so return None
         return None
 
-    warn_cycle: int = service_config.getint("warn_cycle")
-    crit_cycle: int = service_config.getint("crit_cycle")
-    time_difference: float = time() - timestamp
+    status, regex_group = evaluation
+
+    warn_deadline: float | None = timestamp + service_rule.warn_cycle * CYCLE_SECONDS if service_rule.warn_cycle != 0 else None
+    crit_deadline: float | None = timestamp + service_rule.crit_cycle * CYCLE_SECONDS if service_rule.crit_cycle != 0 else None
 
-    if crit_cycle != 0 and time_difference >= crit_cycle:
+    # Cycles that already passed raise the status right away, the others are left for service2checkmk
+    now: float = time()
+    if crit_deadline is not None and now >= crit_deadline:
         status = 2
-    elif warn_cycle != 0 and time_difference >= warn_cycle:
-        status = 1
+    elif warn_deadline is not None and now >= warn_deadline:
+        status = max(status, 1)
+    if status >= 1:
+        warn_deadline = None
+    if status >= 2:
+        crit_deadline = None
 
 
-    name: str = service_config.get("name").replace("EMAIL_SUBJECT_REGEX", subject_match.group(1))
-    name = sub(r"[^\w-]", "", name) # replace any non-word character e.g. a-z, A-Z, 0-9 and _ with "" for legacy checkmk support
+    name: str = get_service_name(service_rule, subject_match)
     
 
     values: dict = {}
-    if value_name is not None and value_regex is not None:
-        values[value_name] = value_regex
-
-
-    details: str = ""
-    match status:
-        case 0:
-            details = (service_config.get("ok_details")
-                       .replace("EMAIL_SUBJECT_REGEX", subject_match.group(1))
-                       .replace("REGEX_GROUP", relevant_match.group(1))
-                       )
-        case 1:
-            details = (service_config.get("warn_details")
-                       .replace("EMAIL_SUBJECT_REGEX", subject_match.group(1))
-                       .replace("REGEX_GROUP", relevant_match.group(1))
-                       )
-        case 2:
-            details = (service_config.get("crit_details")
-                       .replace("EMAIL_SUBJECT_REGEX", subject_match.group(1))
-                       .replace("REGEX_GROUP", relevant_match.group(1))
-                       )
+    if service_rule.value_name is not None and service_rule.value_regex is not None:
+        values[service_rule.value_name] = service_rule.value_regex
+
+
+    details_by_status: list[str] = [(details
+                                     .replace("EMAIL_SUBJECT_REGEX", subject_match.group(1))
+                                     .replace("REGEX_GROUP", regex_group)
+                                     )
+                                    for details in (service_rule.ok_details, service_rule.warn_details, service_rule.crit_details)]
+    details: str = details_by_status[status] if 0 <= status <= 2 else ""
 
     delete: bool = False
     send: bool = True
             
-    return Service(delete, send, status, name, values, details)
+    # If the status is reached with a cycle the capture group of the current status is used in the details
+    return Service(delete, send, status, name, values, details, warn_deadline, crit_deadline, details_by_status[1], details_by_status[2])
+
 
 
+def process_emails(stored_emails: list[StoredMail], subject_index: SubjectIndex, rule_guard: RuleGuard | None = None,
+                   dedup_cache: DedupCache | None = None) -> BatchResults:
+    """This checks if any service config applies to the email subject with the subject index, converts them
+    to Service objects with create_service_object() and returns a tuple with the Service object list,
+    the processed emails, the emails without service, the number of services created, the duplicates
+    and the names of the services every processed email set, in the order of the processed emails.
+    New emails with the same content as an email processed within the content TTL are duplicates
+    and aren't evaluated, the keys of the other emails are added to the dedup cache.
 
-def process_emails(plaintext_emails_paths: list[Path], service_config_list: list[SectionProxy]) -> tuple[list[Service], list[Path], int, int]:
-    """This checks if any service config applies to the email subject, converts them to Service objects with create_service_object()
-    and returns a tuple with the Service object list and a bunch of other useful information"""
+    Only the latest state of a service is saved, so the emails are evaluated newest first and a rule
+    isn't evaluated anymore once a newer email gave its service a state. Older emails whose services
+    all have a state are processed without evaluating their body. The services are returned oldest first,
+    they are the same ones, with the same cycle deadlines, that evaluating every email would save."""
 
     service_objects: list[Service] = []
     service_files_created: int = 0
-    files_to_be_deleted: list[Path] = []
-    email_without_service_count: int = 0
-
-    for email_path in plaintext_emails_paths:
-        email_object = get_email_from_path(email_path)
+    processed_emails: list[StoredMail] = []
+    emails_without_service: list[StoredMail] = []
+    duplicate_emails: list[StoredMail] = []
+    processed_services: list[list[str]] = []
+    # The services that already got their latest state from a newer email. A service is identified by the
+    # name template of its rule and the subject group, which is what its name is made of.
+    resolved_services: set[tuple[str, str]] = set()
+
+    newest_first: list[int] = sorted(range(len(stored_emails)), key=lambda position: (stored_emails[position].received, position), reverse=True)
+    for stored_email in (stored_emails[position] for position in newest_first):
+        email_object: Email = stored_email.email
         email_processed = False
-
-        for service_config in service_config_list:
-            email_subject_regex = service_config.get("email_subject_regex")
-            re_match: Match = search(email_subject_regex, email_object.subject)
-            if re_match is not None:
-                # We saved the timestamp in the filename with a "," as the seperator
-                timestamp: float = float(email_path.stem.split("_")[-1].replace(",", "."))
-                service_object: Service | None = create_service_object(service_config, email_object, re_match, timestamp)
-                if service_object is not None:
-                    service_objects.append(service_object)
-                    service_files_created += 1
-                    email_processed = True
+        # Every rule that matched the subject shares one scan of the body
+        body_scan = BodyScan(email_object.body)
+
+        with timed("routing"):
+            subject_matches: list[tuple[ServiceRule, Match]] = subject_index.match(email_object.subject)
+
+        # Emails without service were checked when they were new, they are evaluated again for new service configs.
+        # A copy is only dropped while its content is still the newest one of every service it matches,
+        # a mail that sets a service back to an earlier state is evaluated.
+        content_hash: str | None = None
+        if dedup_cache is not None and subject_matches and stored_email.state == "pending":
+            content_hash = get_content_hash(email_object)
+            if all(dedup_cache.contains(get_content_key(service_name, content_hash))
+                   for service_name in {get_service_name(service_rule, re_match) for service_rule, re_match in subject_matches}):
+                # A copy that is fetched again is then already dropped before its body is downloaded
+                dedup_cache.add([get_message_id_key(email_object)])
+                duplicate_emails.append(stored_email)
+                continue
+
+        # Within an email the last rule of a service name wins, so the rules are checked last first as well
+        skipped_matches: list[tuple[ServiceRule, Match]] = []
+        email_services: list[str] = []
+        # The evaluated services get the content of this email as their newest one, even if it gave them no state
+        evaluated_services: list[str] = []
+        for service_rule, re_match in reversed(subject_matches):
+            service_key: tuple[str, str] = (service_rule.name, re_match.group(1))
+            if service_key in resolved_services:
+                skipped_matches.append((service_rule, re_match))
+                continue
+            evaluated_services.append(get_service_name(service_rule, re_match))
+
+            service_object: Service | None = create_service_object(service_rule, email_object, re_match, stored_email.received, body_scan, rule_guard)
+            if service_object is not None:
+                service_objects.append(service_object)
+                email_services.append(service_object.name)
+                service_files_created += 1
+                resolved_services.add(service_key)
+                email_processed = True
+        email_created_service: bool = email_processed
+
+        # An email that only has services with a newer state is processed without evaluating it. If its other
+        # rules didn't match, the skipped ones decide if it is an email without service, like they did before.
+        if skipped_matches and not email_processed:
+            if len(skipped_matches) == len(subject_matches):
+                email_services = [get_service_name(service_rule, re_match) for service_rule, re_match in skipped_matches]
+            else:
+                email_services = next(([get_service_name(service_rule, re_match)] for service_rule, re_match in skipped_matches
+                                       if create_service_object(service_rule, email_object, re_match, stored_email.received, body_scan, rule_guard) is not None), [])
+            email_processed = bool(email_services)
         if email_processed:
-            files_to_be_deleted.append(email_path)
+            processed_emails.append(stored_email)
+            processed_services.append(email_services)
         else:
-            email_without_service_count += 1
+            emails_without_service.append(stored_email)
+        if dedup_cache is not None:
+            content_keys: list[str] = [get_content_key(service_name, content_hash) for service_name in evaluated_services] if content_hash and email_created_service else []
+            dedup_cache.add([get_message_id_key(email_object), *content_keys])
+
+    # Everything is returned in the order it would have had when the emails were evaluated oldest first
+    for results in (service_objects, processed_emails, emails_without_service, duplicate_emails, processed_services):
+        results.reverse()
 
-    return service_objects, files_to_be_deleted, service_files_created, email_without_service_count
+    return service_objects, processed_emails, emails_without_service, service_files_created, duplicate_emails, processed_services
 
 
 
-def checkmk_services(service_files: list[Service], emails_processed: int, service_files_created: int, email_without_service_count: int) -> list[Service]:
+def performance_service(run_metrics: RunMetrics, performance_config: SectionProxy) -> Service:
+    """This returns the service with the durations of the stages, the fetched bytes and the peak memory as perfdata.
+    It goes WARN or CRIT if the run took longer or the process used more memory than the thresholds."""
+
+    run_seconds: float = run_metrics.get_run_seconds()
+    peak_rss_bytes: int = get_peak_rss_bytes()
+    run_time_warn: float = performance_config.getfloat("run_time_warn", 60.0)
+    run_time_crit: float = performance_config.getfloat("run_time_crit", 300.0)
+    peak_memory_warn: int = performance_config.getint("peak_memory_warn", 512) * 1024 * 1024
+    peak_memory_crit: int = performance_config.getint("peak_memory_crit", 1024) * 1024 * 1024
+
+    status: int = 0
+    if run_seconds >= run_time_crit or peak_rss_bytes >= peak_memory_crit:
+        status = 2
+    elif run_seconds >= run_time_warn or peak_rss_bytes >= peak_memory_warn:
+        status = 1
+
+    values: dict = {"run_time": f"{run_seconds:.3f};{run_time_warn};{run_time_crit};0"}
+    for stage in STAGES:
+        values[f"{stage}_time"] = f"{run_metrics.stage_seconds[stage]:.3f};;;0"
+    values["fetch_bytes"] = f"{run_metrics.fetch_bytes};;;0"
+    values["peak_memory"] = f"{peak_rss_bytes};{peak_memory_warn};{peak_memory_crit};0"
+
+    slowest_rules: str = ", ".join(f"{source} {seconds:.3f}s" for source, seconds in run_metrics.rule_seconds.most_common(3))
+
+    return Service(True,
+                   True,
+                   status,
+                   "Mail2CheckMK-000Performance",
+                   values,
+                   f"Mail2CheckMK took {run_seconds:.1f}s ({', '.join(f'{stage} {run_metrics.stage_seconds[stage]:.2f}s' for stage in STAGES)}), "
+                   f"fetched {run_metrics.fetch_bytes / 1024 / 1024:.1f} MB and used at most {peak_rss_bytes / 1024 / 1024:.0f} MB memory"
+                   + (f", slowest service configs: {slowest_rules}" if slowest_rules else "")
+                   )
+
+
+def checkmk_services(service_files: list[Service], emails_processed: int, service_files_created: int, email_without_service_count: int, rules_over_budget: list[str] | None = None, failed_accounts: list[str] | None = None, run_metrics: RunMetrics | None = None, duplicates_skipped: int = 0) -> list[Service]:
     """This adds checkmk related services to the service list"""
 
     service_files.append(Service(True,
                                  True,
                                  0,
                                  "Mail2CheckMK-000Stats",
-                                 {"emails_processed":emails_processed, "service_files_created":service_files_created},
-                                 f"Mail2CheckMK processed {emails_processed} mails and created {service_files_created} service files this run."
+                                 {"emails_processed":emails_processed, "service_files_created":service_files_created, "duplicates_skipped":duplicates_skipped},
+                                 f"Mail2CheckMK processed {emails_processed} mails, created {service_files_created} service files and skipped {duplicates_skipped} duplicate mails this run."
                                  )
                          )
     
@@ -199,62 +277,213 @@ def checkmk_services(service_files: list[Service], emails_processed: int, servic
                                      )
                              )
 
+    if rules_over_budget:
+        service_files.append(Service(True,
+                                     True,
+                                     1,
+                                     "Mail2CheckMK-000Rule-time-budget",
+                                     {"rules_over_budget":len(rules_over_budget)},
+                                     f"Mail2CheckMK skipped {len(rules_over_budget)} service config(s) that took longer than the time budget: {', '.join(rules_over_budget)}"
+                                     )
+                             )
+
+    if failed_accounts:
+        service_files.append(Service(True,
+                                     True,
+                                     2,
+                                     "Mail2CheckMK-000Accounts",
+                                     {"failed_accounts":len(failed_accounts)},
+                                     f"Mail2CheckMK couldn't fetch the mails of {len(failed_accounts)} account(s): {', '.join(failed_accounts)}"
+                                     )
+                             )
+
+    if run_metrics is not None:
+        service_files.append(performance_service(run_metrics, read_config_section("Performance")))
+
     return service_files
 
 
-def save_service_files(service_objects: list[Service]) -> None:
+def save_services(service_objects: list[Service], store: StateStore) -> None:
+    """This saves the services as the latest state of their name in the state store"""
 
-    for service_object in service_objects:
-        filename: str = sub(r"[\/\0\n\r\s]", "_", service_object.name)
-        unix_time_string = str(time()).replace(".", ",")
-        filename += f"_{unix_time_string}"
+    store.save_services(service_objects)
 
-        formatted_dict: str = ""
-        if len(service_object.values) != 0:
-            for key, value in service_object.values.items():
-                if formatted_dict == "":
-                    formatted_dict += f" {key}={value}"
-                else:
-                    formatted_dict += f"|{key}={value}"
-        else:
-            formatted_dict = " -"
 
+def delete_emails(processed_emails: list[StoredMail], store: StateStore) -> None:
+    """This deletes every processed email from the state store,
+    emails that were passed in memory were never saved"""
 
-        with open(f"service-files/{filename}.txt", "w") as file:
-            file.write(f"Delete Service File: {service_object.delete}\n")
-            file.write(f"Send to CheckMK: {service_object.send}\n")
-            file.write(f'{str(service_object.status)} {service_object.name}{formatted_dict} {service_object.status_details}')
+    store.delete_mails([stored_email.id for stored_email in processed_emails if stored_email.id is not None])
 
 
-def delete_files(files_to_be_deleted: list[Path]) -> None:
-    """This deletes every file in the list"""
+def move_mails_without_service(emails_without_service: list[StoredMail], store: StateStore, rule_set_hash: str | None = None) -> None:
+    """This marks all remaining emails as without-service and saves the ones that were passed in memory,
+    but because the only remaining one's don't have services it's called like this.
+    The hash of the service configs they were evaluated with is saved with them."""
 
-    for file in files_to_be_deleted:
-        if file.exists():
-            os.remove(file.absolute().as_posix())
+    store.mark_mails_without_service([stored_email.id for stored_email in emails_without_service if stored_email.id is not None], rule_set_hash)
+    store.add_mails([stored_email.email for stored_email in emails_without_service if stored_email.id is None], state="without-service", rule_set=rule_set_hash)
 
-def move_mails_without_service(plaintext_email_paths: list[Path]) -> None:
-    """This moves all remaining plaintext-emails into the without-service subdirectory,
-    but because the only remaining one's don't have services it's called like this."""
 
-    without_service_path: Path = Path("plaintext-emails") / "without-service"
-    for file in plaintext_email_paths:
-        if file.exists() and "without" not in file.parent.name:
-            file.rename(without_service_path / file.name)
+def save_batch_results(batch_results: BatchResults, store: StateStore, run_stats: RunStats, rule_set_hash: str,
+                       mail_archive: MailArchive | None = None) -> None:
+    """This saves the services and emails without service of one processed batch in one transaction
+    and adds its counts to the run stats. Duplicates are deleted like processed emails,
+    the processed emails are appended to the mail archive with their services if there is one."""
 
+    service_objects, processed_emails, emails_without_service, service_files_created, duplicate_emails, processed_services = batch_results
+    run_stats.service_files_created += service_files_created
+    run_stats.email_without_service_count += len(emails_without_service)
+    run_stats.duplicates_skipped += len(duplicate_emails)
+    with timed("store"), store.transaction():
+        save_services(service_objects, store)
+        if mail_archive is not None:
+            archive_stored_mails(processed_emails, "processed", mail_archive, processed_services)
+        delete_emails(processed_emails + duplicate_emails, store)
+        move_mails_without_service(emails_without_service, store, rule_set_hash)
 
-def main(emails_saved: int = 0) -> None:
-    plaintext_emails_paths: list[Path] = get_plaintext_emails()
-    service_config_list: list[SectionProxy] = get_service_configs()
-    service_objects, files_to_be_deleted, service_files_created, email_without_service_count = process_emails(plaintext_emails_paths, service_config_list)
-    service_objects: list[Service] = checkmk_services(service_objects, emails_saved, service_files_created, email_without_service_count)
-    save_service_files(service_objects)
-    delete_files(files_to_be_deleted)
-    move_mails_without_service(plaintext_emails_paths)
 
+def process_and_save_batch(stored_emails: list[StoredMail], store: StateStore, subject_index: SubjectIndex, rule_guard: RuleGuard, run_stats: RunStats,
+                           dedup_cache: DedupCache | None = None, mail_archive: MailArchive | None = None) -> None:
+    """This processes one batch of emails and saves its results with save_batch_results()"""
 
-if __name__ == "__main__":
-    main()
+    save_batch_results(process_emails(stored_emails, subject_index, rule_guard, dedup_cache), store, run_stats, subject_index.rule_set_hash, mail_archive)
+
+
+def get_backlog_pool_settings() -> tuple[int, int]:
+    """This returns backlog_workers and backlog_pool_threshold from the 'Rules' section"""
+
+    return get_pool_settings(read_config_section("Rules"), "backlog_workers", "backlog_pool_threshold", 1000)
+
+
+def init_backlog_worker(subject_index: SubjectIndex, time_budget: float, guard_mode: str) -> None:
+    """This runs once in every backlog worker process and keeps the service configs for all of its batches"""
+
+    global worker_subject_index, worker_rule_guard
+
+    worker_subject_index = subject_index
+    worker_rule_guard = RuleGuard(time_budget, guard_mode)
+
+
+def evaluate_in_backlog_worker(stored_emails: list[StoredMail]) -> tuple[BatchResults, list[str]]:
+    """This processes one batch in a backlog worker and returns its results with the rules that went over the time budget"""
+
+    return process_emails(stored_emails, worker_subject_index, worker_rule_guard), worker_rule_guard.rules_over_budget
+
+
+def collect_backlog_results(evaluation: Future, rule_guard: RuleGuard) -> BatchResults:
+    """This waits for the evaluation of a batch in the backlog pool and adds the rules that went over the budget in the worker"""
+
+    batch_results, rules_over_budget = evaluation.result()
+    rule_guard.rules_over_budget.extend(source for source in rules_over_budget if source not in rule_guard.rules_over_budget)
+
+    return batch_results
+
+
+def evaluate_in_backlog_pool(email_batches: Iterator[list[StoredMail]], subject_index: SubjectIndex, rule_guard: RuleGuard, backlog_workers: int) -> Iterator[BatchResults]:
+    """This evaluates the batches in a pool of backlog_workers processes and yields their results in the order of the batches.
+    At most two batches per worker are read ahead, so the backlog is never loaded into memory at once."""
+
+    with create_process_pool(backlog_workers, init_backlog_worker, (subject_index, rule_guard.time_budget, rule_guard.guard_mode)) as backlog_pool:
+        evaluations: deque[Future] = deque()
+        for stored_emails in email_batches:
+            evaluations.append(backlog_pool.submit(evaluate_in_backlog_worker, stored_emails))
+            if len(evaluations) >= backlog_workers * 2:
+                yield collect_backlog_results(evaluations.popleft(), rule_guard)
 
+        while evaluations:
+            yield collect_backlog_results(evaluations.popleft(), rule_guard)
 
 
+def process_backlog(store: StateStore, subject_index: SubjectIndex, rule_guard: RuleGuard, run_stats: RunStats, batch_size: int = 500,
+                    reevaluate_all: bool = False, backlog_workers: int | None = None, mail_archive: MailArchive | None = None) -> int:
+    """This evaluates the emails without service again that weren't evaluated with the current service configs,
+    so the backlog is only read after a service config changed, and returns how many were evaluated.
+    A backlog of at least backlog_pool_threshold emails is evaluated by a pool of backlog_workers processes
+    in one pass, the results are saved in the order of the emails so newer states still win."""
+
+    backlog_count: int = store.count_mails(("without-service",), None if reevaluate_all else subject_index.rule_set_hash, headers_only=False)
+    default_backlog_workers, backlog_pool_threshold = get_backlog_pool_settings()
+    backlog_workers = default_backlog_workers if backlog_workers is None else backlog_workers
+
+    if backlog_workers < 1 or backlog_count < max(backlog_pool_threshold, 2):
+        for stored_emails in get_backlog_emails(store, subject_index, batch_size, reevaluate_all):
+            process_and_save_batch(stored_emails, store, subject_index, rule_guard, run_stats, mail_archive=mail_archive)
+        return backlog_count
+
+    # Smaller batches spread a backlog that is only a few batches large over all workers
+    pool_batch_size: int = max(1, min(batch_size, -(-backlog_count // (backlog_workers * 4))))
+    email_batches: Iterator[list[StoredMail]] = get_backlog_emails(store, subject_index, pool_batch_size, reevaluate_all)
+    for batch_results in evaluate_in_backlog_pool(email_batches, subject_index, rule_guard, backlog_workers):
+        save_batch_results(batch_results, store, run_stats, subject_index.rule_set_hash, mail_archive)
+
+    return backlog_count
+
+
+def process_stored_emails(store: StateStore, subject_index: SubjectIndex, rule_guard: RuleGuard, run_stats: RunStats, batch_size: int = 500,
+                          dedup_cache: DedupCache | None = None, mail_archive: MailArchive | None = None) -> None:
+    """This evaluates the backlog of emails without service if the service configs changed
+    and then processes the pending emails in the state store one batch at a time.
+    The backlog comes first because its emails are older, a newer state of a service has to win."""
+
+    process_backlog(store, subject_index, rule_guard, run_stats, batch_size, mail_archive=mail_archive)
+    for stored_emails in get_stored_emails(store, batch_size):
+        process_and_save_batch(stored_emails, store, subject_index, rule_guard, run_stats, dedup_cache, mail_archive)
+
+
+def process_email_batches(email_batches: Iterable[EmailBatch], store: StateStore, subject_index: SubjectIndex, rule_guard: RuleGuard, run_stats: RunStats,
+                          dedup_cache: DedupCache | None = None, mail_archive: MailArchive | None = None) -> Iterator[EmailBatch]:
+    """This processes the new emails passed in memory one batch at a time and yields every batch once
+    its result is saved, so the caller can acknowledge it on the server.
+    New emails only reach the store if no service applies to them."""
+
+    for email_batch in email_batches:
+        received: float = time()
+        process_and_save_batch([StoredMail(None, received, email, "pending") for email in email_batch.emails], store, subject_index, rule_guard, run_stats, dedup_cache, mail_archive)
+        run_stats.emails_processed += len(email_batch.emails)
+        run_stats.duplicates_skipped += email_batch.duplicate_count
+        yield email_batch
+
+
+def maintain_mail_archive(store: StateStore, mail_archive: MailArchive | None) -> None:
+    """This moves the old emails without service from the state store to the mail archive
+    and deletes the segments that are over the retention limits"""
+
+    if mail_archive is None:
+        return
+
+    with timed("store"):
+        archive_old_mails_without_service(store, mail_archive)
+        mail_archive.apply_retention()
+
+
+def save_run_stats(run_stats: RunStats, rule_guard: RuleGuard, store: StateStore) -> None:
+    """This saves the Mail2CheckMK services with the counts and the metrics of the whole run.
+    All emails without service are counted, also the ones that weren't evaluated again this run."""
+
+    save_services(checkmk_services([], run_stats.emails_processed, run_stats.service_files_created,
+                                   store.count_mails(("without-service",)), rule_guard.rules_over_budget, run_stats.failed_accounts,
+                                   instrumentation.run_metrics, run_stats.duplicates_skipped), store)
+
+
+def main(emails_saved: int = 0, duplicates_skipped: int = 0) -> None:
+    store = StateStore()
+    subject_index: SubjectIndex = build_subject_index()
+    rule_guard: RuleGuard = build_rule_guard()
+    dedup_cache: DedupCache | None = build_dedup_cache(store.get_seen_mails(), read_config_section("Mail"))
+    mail_archive: MailArchive | None = build_mail_archive(store)
+    run_stats = RunStats(emails_processed=emails_saved, duplicates_skipped=duplicates_skipped)
+    process_stored_emails(store, subject_index, rule_guard, run_stats, dedup_cache=dedup_cache, mail_archive=mail_archive)
+    rule_guard.close()
+    with store.transaction():
+        if dedup_cache is not None:
+            store.save_seen_mails(dedup_cache.get_entries())
+        maintain_mail_archive(store, mail_archive)
+        save_run_stats(run_stats, rule_guard, store)
+    store.close()
+
+
+if __name__ == "__main__":
+    # main.py already holds the lock when it calls main(), on its own the script has to take it
+    with hold_run_lock():
+        main()
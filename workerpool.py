@@ -0,0 +1,28 @@
+# This module creates the process pools that decode large batches of mails and evaluate large backlogs.
+# The workers are spawned, forked ones could inherit a lock held by one of the threads of the account receiver,
+# and multiprocessing is only imported once a pool is actually needed.
+
+import os
+from configparser import SectionProxy
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+
+def get_pool_settings(config: SectionProxy, workers_option: str, threshold_option: str, default_threshold: int) -> tuple[int, int]:
+    """This returns the number of workers and the pool threshold from the options of the section.
+    By default one core is left for the main process, on a single core machine there is no pool."""
+
+    default_workers: int = min(4, (os.cpu_count() or 1) - 1)
+
+    return config.getint(workers_option, default_workers), config.getint(threshold_option, default_threshold)
+
+
+def create_process_pool(workers: int, initializer: Callable[..., None] | None = None, initargs: tuple = ()) -> "ProcessPoolExecutor":
+    """This creates a pool of spawned worker processes, initializer runs once in every worker with initargs"""
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    return ProcessPoolExecutor(workers, mp_context=get_context("spawn"), initializer=initializer, initargs=initargs)